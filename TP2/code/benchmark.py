@@ -0,0 +1,348 @@
+import os
+import time
+import argparse
+import tempfile
+import sqlite3
+import multiprocessing
+from db import DB_manager
+from block_index import Block_index
+from snapshot import write_snapshot, read_snapshot, new_snapshot_id
+from codec_cases import make_codec_cases
+from udp_harness import Link, Relay, start_udp_node, start_udp_server, write_random_file, received_data, get_udp_file, run_udp_flows
+
+"""
+Tracker database ingestion benchmark
+"""
+
+def make_partial_update(n_blocks, division_size=512, blocks_per_file=30000, offset=1):
+    """
+    UPDATE_PARTIAL data with every other block of each file, so no blocks can be merged into ranges
+    (offset 2 sends the blocks in between, which merges everything)
+    """
+    files = []
+    i = 0
+    while n_blocks > 0:
+        n = min(n_blocks, blocks_per_file)
+        blocks = list(range(offset, 2 * n, 2))
+        files.append(("file_%d" % i, "%040x" % i, [(division_size, division_size, blocks)]))
+        n_blocks -= n
+        i += 1
+    return files
+
+
+def benchmark_db(sizes, db_file):
+    db = DB_manager(db_file)
+    
+    print("%10s %12s %14s %12s %14s %12s" % ("blocks", "insert (s)", "blocks/s", "merge (s)", "blocks/s", "delete (s)"))
+    
+    for n_blocks in sizes:
+        data = make_partial_update(n_blocks)
+        
+        start = time.perf_counter()
+        db.update_node_partial_files("benchmark", data)
+        insert_time = time.perf_counter() - start
+        
+        data = make_partial_update(n_blocks, offset=2)
+        
+        start = time.perf_counter()
+        db.update_node_partial_files("benchmark", data)
+        merge_time = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        db.delete_node("benchmark")
+        delete_time = time.perf_counter() - start
+        
+        print("%10d %12.3f %14.0f %12.3f %14.0f %12.3f" % (
+            n_blocks, insert_time, n_blocks / insert_time, merge_time, n_blocks / merge_time, delete_time
+        ))
+
+"""
+Wire codec benchmark
+"""
+
+def time_calls(function, duration):
+    """
+    Calls function repeatedly for about duration seconds; returns calls per second
+    """
+    n_calls = 0
+    batch = 1
+    start = time.perf_counter()
+    
+    while True:
+        for _ in range(batch):
+            function()
+        n_calls += batch
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return n_calls / elapsed
+        batch *= 2
+
+
+def benchmark_codec(duration):
+    print("%26s %8s %14s %12s %14s %12s" % ("message", "bytes", "encode/s", "MB/s", "decode/s", "MB/s"))
+    
+    failed = []
+    for name, encode, decode, expected in make_codec_cases():
+        message = encode()
+        
+        # round trip before timing anything
+        decoded = decode(message)
+        if decoded != expected:
+            print("%26s round trip failed: %r" % (name, decoded))
+            failed.append(name)
+            continue
+        
+        encode_rate = time_calls(encode, duration)
+        decode_rate = time_calls(lambda: decode(message), duration)
+        
+        print("%26s %8d %14.0f %12.1f %14.0f %12.1f" % (
+            name, len(message),
+            encode_rate, encode_rate * len(message) / 1e6,
+            decode_rate, decode_rate * len(message) / 1e6
+        ))
+        
+    if failed:
+        raise SystemExit("Round trip failed: " + ", ".join(failed))
+
+"""
+Tracker startup benchmark
+"""
+
+def fill_block_ranges(db_file, n_ranges, n_nodes, nodes_per_file, ranges_per_entry, division_size=512):
+    """
+    Writes n_ranges block ranges straight into the tables: every (file, node) has ranges_per_entry
+    one-block ranges (every other block), every file is held by nodes_per_file of the n_nodes nodes
+    """
+    n_entries = n_ranges // ranges_per_entry
+    n_files = (n_entries + nodes_per_file - 1) // nodes_per_file
+    
+    conn = sqlite3.connect(db_file)
+    conn.execute("BEGIN")
+    conn.executemany(
+        "INSERT INTO Node (host_name, last_seen) VALUES (?, ?)",
+        (("node_%d" % i, time.time()) for i in range(n_nodes))
+    )
+    conn.executemany(
+        "INSERT INTO File (hash, name) VALUES (?, ?)",
+        (("%040x" % i, "file_%d" % i) for i in range(n_files))
+    )
+    conn.executemany(
+        """
+        INSERT INTO Block_range (Node_host_name, File_hash, division_size, first_number, last_number, last_block_size)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        (
+            ("node_%d" % (entry % n_nodes), "%040x" % (entry // nodes_per_file), division_size, block, block, division_size)
+            for entry in range(n_entries)
+            for block in range(1, 2 * ranges_per_entry, 2)
+        )
+    )
+    conn.commit()
+    conn.close()
+    
+    return n_entries * ranges_per_entry
+
+
+def index_summary(index):
+    """
+    (files, nodes, entries, ranges, blocks) of a block index, to check that a restore rebuilt the same index
+    """
+    entries = [entry for host_names in index.files.values() for division_sizes in host_names.values() for entry in division_sizes.values()]
+    return (
+        len(index.files), len(index.nodes), len(entries),
+        sum(len(entry.blocks.starts) for entry in entries), sum(len(entry.blocks) for entry in entries)
+    )
+
+
+def benchmark_startup(n_ranges, n_nodes, nodes_per_file, ranges_per_entry, db_file):
+    snapshot_file = os.path.splitext(db_file)[0] + ".snapshot"
+    db = DB_manager(db_file, persistent=True)
+    
+    start = time.perf_counter()
+    n_ranges = fill_block_ranges(db_file, n_ranges, n_nodes, nodes_per_file, ranges_per_entry)
+    print("Filled the database with %d block ranges in %.1f s" % (n_ranges, time.perf_counter() - start))
+    
+    # what a warm restart without a snapshot does
+    index = Block_index()
+    start = time.perf_counter()
+    db.get_block_ranges(index.load)
+    files, _ = db.get_files()
+    index.load_names(files)
+    scan_time = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    write_snapshot(snapshot_file, index, new_snapshot_id())
+    write_time = time.perf_counter() - start
+    
+    summary = index_summary(index)
+    del index
+    
+    index = Block_index()
+    start = time.perf_counter()
+    _, files, entries = read_snapshot(snapshot_file)
+    index.restore(entries, files)
+    restore_time = time.perf_counter() - start
+    
+    if index_summary(index) != summary:
+        print("The restored index differs: %r != %r" % (index_summary(index), summary))
+    
+    print("%10s %12s %14s %12s %12s %12s %14s %9s" % (
+        "ranges", "scan (s)", "ranges/s", "write (s)", "size (MB)", "restore (s)", "ranges/s", "speedup"
+    ))
+    print("%10d %12.2f %14.0f %12.2f %12.1f %12.2f %14.0f %8.1fx" % (
+        n_ranges, scan_time, n_ranges / scan_time, write_time, os.path.getsize(snapshot_file) / 1e6,
+        restore_time, n_ranges / restore_time, scan_time / restore_time
+    ))
+    
+    db.close()
+
+"""
+UDP transfer benchmark
+"""
+
+def benchmark_udp(windows, size, delay, loss, block_size, ack_timeout, congestion_control, pacing, receiver_window, transfer_timeout, tmp_dir):
+    file_name = "benchmark.bin"
+    server_dir = os.path.join(tmp_dir, "server")
+    data, file_hash = write_random_file(os.path.join(server_dir, "files", file_name), size, 0)
+    n_blocks = (size + block_size - 1) // block_size
+        
+    client = start_udp_node(
+        os.path.join(tmp_dir, "client"), block_size, windows[0], ack_timeout, receiver_window=receiver_window
+    )
+    client_address = ("127.0.0.1", client.udp_port)
+    context = multiprocessing.get_context("spawn")
+    
+    print("%d blocks of %d bytes, %.1f ms each way, %.1f%% loss, receiver window %d" % (
+        n_blocks, block_size, delay * 1000, loss * 100, client.udp_receiver_window_size
+    ))
+    print("%8s %10s %14s %16s %10s %10s %10s" % (
+        "window", "time (s)", "goodput (KB/s)", "retransmissions", "srtt (ms)", "rto (ms)", "intact"
+    ))
+    
+    for window_size in windows:
+        server, server_address, stop, results = start_udp_server(
+            context, server_dir, block_size, window_size, ack_timeout, congestion_control, pacing
+        )
+        # each server binds its own port, the datagrams of the ones before go nowhere
+        relay = Relay(client_address, server_address, Link(delay, loss, seed=1), Link(delay, loss, seed=2))
+        
+        client.file_manager.reset_block_dir()
+        while not client.udp_response_queue.empty():  # the end of a transfer that failed before
+            client.udp_response_queue.get()
+        
+        elapsed = get_udp_file(client, relay, file_hash, block_size, max(ack_timeout, 4 * delay), transfer_timeout)
+        
+        stop.set()
+        rtt = results.get()
+        server.join()
+            
+        retransmissions = relay.received["server"] - n_blocks
+        if elapsed is None:
+            print("%8d transfer not over after %.0f s, %d datagrams sent" % (
+                window_size, transfer_timeout, relay.received["server"]
+            ))
+            continue
+        
+        intact = received_data(client, file_name, block_size) == data
+        print("%8d %10.2f %14.1f %16d %10s %10s %10s" % (
+            window_size, elapsed, size / elapsed / 1e3, retransmissions, rtt["srtt_ms"], rtt["rto_ms"], intact
+        ))
+        
+    client.shutdown()
+
+
+def benchmark_udp_flows(n_flows, size, delay, loss, rate, limit, block_size, window_size, ack_timeout, transfer_timeout, tmp_dir):
+    n_blocks = (size + block_size - 1) // block_size
+    print("%d flows of %d blocks of %d bytes, window %d, %.1f ms each way, %.1f KB/s bottleneck with %d datagrams of buffer, %.1f%% loss" % (
+        n_flows, n_blocks, block_size, window_size, delay * 1000, rate / 1e3, limit, loss * 100
+    ))
+    print("%24s %10s %12s %12s %16s %8s %16s %10s %8s" % (
+        "sender", "time (s)", "min (KB/s)", "max (KB/s)", "aggregate (KB/s)", "jain", "retransmissions", "dropped", "intact"
+    ))
+    
+    for run in run_udp_flows(n_flows, size, delay, loss, rate, limit, block_size, window_size, ack_timeout, transfer_timeout, tmp_dir):
+        if run["failed"]:
+            print("%24s %d of %d transfers failed, %d retransmissions, %d dropped" % (
+                run["mode"], run["failed"], n_flows, run["retransmissions"], run["dropped"]
+            ))
+            continue
+        
+        print("%24s %10.2f %12.1f %12.1f %16.1f %8.3f %16d %10d %8s" % (
+            run["mode"], run["elapsed"], min(run["rates"]), max(run["rates"]), run["aggregate"],
+            run["jain"], run["retransmissions"], run["dropped"], run["intact"]
+        ))
+"""
+Function to parse command line arguments
+"""
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='FS Tracker benchmarks')
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    
+    db_parser = subparsers.add_parser("db", help="UPDATE_PARTIAL ingestion into the tracker database")
+    db_parser.add_argument('-n', '--sizes', type=int, nargs="+", default=[1000, 100000, 1000000], help='Number of blocks per run')
+    db_parser.add_argument('-db', '--db', default=None, help='Database file name (temporary file by default)')
+    
+    codec_parser = subparsers.add_parser("codec", help="Encode / decode throughput of each wire message type")
+    codec_parser.add_argument('-t', '--time', type=float, default=1.0, help='Seconds spent timing each encoder and decoder')
+    
+    startup_parser = subparsers.add_parser("startup", help="Warm restart: index rebuilt from the database vs restored from a snapshot")
+    startup_parser.add_argument('-n', '--ranges', type=int, default=10000000, help='Number of block ranges stored')
+    startup_parser.add_argument('-N', '--nodes', type=int, default=1000, help='Number of nodes')
+    startup_parser.add_argument('-f', '--nodes_per_file', type=int, default=10, help='Number of nodes holding each file')
+    startup_parser.add_argument('-r', '--ranges_per_entry', type=int, default=16, help='Number of ranges a node has of a file')
+    startup_parser.add_argument('-db', '--db', default=None, help='Database file name (temporary file by default)')
+    
+    udp_parser = subparsers.add_parser("udp", help="Goodput of a UDP transfer through a delaying relay for each sender window size")
+    udp_parser.add_argument('-w', '--windows', type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64], help='Sender window sizes')
+    udp_parser.add_argument('-s', '--size', type=int, default=1000000, help='File size in bytes')
+    udp_parser.add_argument('-d', '--delay', type=float, default=1.0, help='Delay added in each direction (ms)')
+    udp_parser.add_argument('-l', '--loss', type=float, default=0.0, help='Probability of dropping a datagram')
+    udp_parser.add_argument('-b', '--block_size', type=int, default=512, help='Block size')
+    udp_parser.add_argument('-at', '--ack_timeout', type=float, default=0.4, help='UDP retransmission timeout until the round trip time is measured')
+    udp_parser.add_argument('-ncc', '--no_congestion_control', default=False, action='store_true', help='Always send a full window')
+    udp_parser.add_argument('-pc', '--pacing', default=False, action='store_true', help='Space the datagrams over a round trip')
+    udp_parser.add_argument('-rw', '--receiver_window', type=int, default=64, help='Datagrams the receiving node keeps ahead of a missing one (sent in its request)')
+    udp_parser.add_argument('-T', '--transfer_timeout', type=float, default=60.0, help='Seconds after which a transfer not over counts as failed')
+    
+    flows_parser = subparsers.add_parser("udp_flows", help="Concurrent UDP transfers sharing a bottleneck, with and without congestion control")
+    flows_parser.add_argument('-n', '--flows', type=int, default=4, help='Number of transfers')
+    flows_parser.add_argument('-s', '--size', type=int, default=200000, help='File size of each transfer in bytes')
+    flows_parser.add_argument('-d', '--delay', type=float, default=5.0, help='Delay added in each direction (ms)')
+    flows_parser.add_argument('-l', '--loss', type=float, default=0.0, help='Probability of dropping a datagram on the bottleneck')
+    flows_parser.add_argument('-r', '--rate', type=float, default=200.0, help='Bottleneck rate (KB/s)')
+    flows_parser.add_argument('-q', '--limit', type=int, default=20, help='Datagrams the bottleneck buffers before dropping')
+    flows_parser.add_argument('-b', '--block_size', type=int, default=512, help='Block size')
+    flows_parser.add_argument('-w', '--window', type=int, default=32, help='Sender window size')
+    flows_parser.add_argument('-at', '--ack_timeout', type=float, default=0.4, help='UDP retransmission timeout until the round trip time is measured')
+    flows_parser.add_argument('-T', '--transfer_timeout', type=float, default=60.0, help='Seconds after which the transfers not over count as failed')
+    
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    
+    if args.benchmark == "db":
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            benchmark_db(args.sizes, args.db or os.path.join(tmp_dir, "benchmark.sqlite3"))
+    elif args.benchmark == "codec":
+        benchmark_codec(args.time)
+    elif args.benchmark == "startup":
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            benchmark_startup(
+                args.ranges, args.nodes, args.nodes_per_file, args.ranges_per_entry,
+                args.db or os.path.join(tmp_dir, "benchmark.sqlite3")
+            )
+    elif args.benchmark == "udp":
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            benchmark_udp(
+                args.windows, args.size, args.delay / 1000, args.loss, args.block_size, args.ack_timeout,
+                not args.no_congestion_control, args.pacing, args.receiver_window, args.transfer_timeout, tmp_dir
+            )
+    elif args.benchmark == "udp_flows":
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            benchmark_udp_flows(
+                args.flows, args.size, args.delay / 1000, args.loss, args.rate * 1000, args.limit,
+                args.block_size, args.window, args.ack_timeout, args.transfer_timeout, tmp_dir
+            )
@@ -0,0 +1,221 @@
+import threading
+from utils import Interval_set, numbers_to_intervals
+from name_index import Name_index
+
+
+class Block_entry:
+    """
+    Blocks of a file that a node has for one division size
+    """
+    def __init__(self, division_size):
+        self.division_size = division_size
+        self.blocks = Interval_set()
+        self.last_block_size = division_size  # size of the highest numbered block
+        
+    def add(self, intervals, last_block_size):
+        current_max = self.blocks.max()
+        for first, last in intervals:
+            self.blocks.add(first, last)
+        if current_max is None or intervals[-1][1] >= current_max:
+            self.last_block_size = last_block_size
+            
+    def remove(self, intervals):
+        current_max = self.blocks.max()
+        for first, last in intervals:
+            self.blocks.remove(first, last)
+        # the size is only known for the block that was the last one (same as the database)
+        if self.blocks.max() != current_max:
+            self.last_block_size = self.division_size
+            
+
+class Block_index:
+    """
+    In-memory index of which blocks each node has (hash -> host name -> division size -> blocks),
+    used to answer LOCATE_HASH without querying the database, and of the names of the files
+    some node has, used to answer SEARCH_NAME
+    """
+    def __init__(self):
+        self.files = {}  # file_hash -> host_name -> division_size -> Block_entry
+        self.nodes = {}  # host_name -> set of file hashes
+        self.names = {}  # file_hash -> file name (the first one announced, like the database)
+        self.name_index = Name_index()  # names of the hashes in files
+        self.lock = threading.Lock()
+        
+    """
+    Updates (same data as the DB_manager functions with the same name)
+    """
+        
+    def add_blocks(self, host_name, file_hash, division_size, intervals, last_block_size):
+        if len(intervals) == 0:
+            return
+        
+        host_names = self.files.get(file_hash)
+        if host_names is None:
+            host_names = self.add_file(file_hash)
+        division_sizes = host_names.setdefault(host_name, {})
+        entry = division_sizes.get(division_size)
+        if entry is None:
+            entry = division_sizes[division_size] = Block_entry(division_size)
+            
+        entry.add(intervals, last_block_size)
+        self.nodes.setdefault(host_name, set()).add(file_hash)
+    
+    def add_file(self, file_hash):  # lock must be held
+        name = self.names.get(file_hash)
+        if name is not None:
+            self.name_index.add(name, file_hash)
+        host_names = self.files[file_hash] = {}
+        return host_names
+    
+    def remove_file(self, file_hash):  # lock must be held
+        del self.files[file_hash]
+        name = self.names.get(file_hash)
+        if name is not None:
+            self.name_index.remove(name, file_hash)
+    
+    def update_node_full_files(self, host_name, data):
+        with self.lock:
+            for file_hash, file_name, block_set_data in data:
+                self.names.setdefault(file_hash, file_name)
+                for block_size, last_block_size, n_blocks in block_set_data:
+                    self.add_blocks(host_name, file_hash, block_size, [(1, n_blocks)], last_block_size)
+    
+    def update_node_partial_files(self, host_name, data):
+        with self.lock:
+            for file_name, file_hash, block_set_data in data:
+                self.names.setdefault(file_hash, file_name)
+                for block_size, last_block_size, blocks in block_set_data:
+                    self.add_blocks(host_name, file_hash, block_size, numbers_to_intervals(blocks), last_block_size)
+                    
+    def add_block_ranges(self, host_name, data):
+        with self.lock:
+            for file_hash, file_name, block_set_data in data:
+                self.names.setdefault(file_hash, file_name)
+                for block_size, last_block_size, intervals in block_set_data:
+                    self.add_blocks(host_name, file_hash, block_size, intervals, last_block_size)
+                    
+    def remove_block_ranges(self, host_name, data):
+        with self.lock:
+            for file_hash, _, block_set_data in data:
+                host_names = self.files.get(file_hash)
+                division_sizes = host_names.get(host_name) if host_names is not None else None
+                if division_sizes is None:
+                    continue
+                
+                for block_size, _, intervals in block_set_data:
+                    entry = division_sizes.get(block_size)
+                    if entry is None:
+                        continue
+                    entry.remove(intervals)
+                    if len(entry.blocks) == 0:
+                        del division_sizes[block_size]
+                        
+                if len(division_sizes) == 0:
+                    del host_names[host_name]
+                    self.nodes[host_name].discard(file_hash)
+                    if len(host_names) == 0:
+                        self.remove_file(file_hash)
+                    
+    def load(self, rows):
+        """
+        Fills the index from the database's block ranges (warm restart)
+        """
+        with self.lock:
+            for host_name, file_hash, division_size, first, last, last_block_size in rows:
+                self.add_blocks(host_name, file_hash, division_size, [(first, last)], last_block_size)
+                
+    def load_names(self, files):
+        """
+        Sets the names of the loaded files (after load, which does not know them)
+        """
+        with self.lock:
+            self.names.update(files)
+            self.name_index.load((file_hash, self.names[file_hash]) for file_hash in self.files if file_hash in self.names)
+            
+    def restore(self, entries, files):
+        """
+        Fills the index from a snapshot: entries are (file_hash, host_name, division_size,
+        last_block_size, first blocks, last blocks) with the ranges already merged
+        """
+        with self.lock:
+            self.names.update(files)
+            for file_hash, host_name, division_size, last_block_size, starts, ends in entries:
+                entry = Block_entry(division_size)
+                entry.blocks.assign(starts, ends)
+                entry.last_block_size = last_block_size
+                self.files.setdefault(file_hash, {}).setdefault(host_name, {})[division_size] = entry
+                self.nodes.setdefault(host_name, set()).add(file_hash)
+            self.name_index.load((file_hash, self.names[file_hash]) for file_hash in self.files if file_hash in self.names)
+                    
+    def get_node_file_hashes(self, host_name):
+        with self.lock:
+            return list(self.nodes.get(host_name, ()))
+                    
+    def delete_node(self, host_name):
+        with self.lock:
+            for file_hash in self.nodes.pop(host_name, ()):
+                host_names = self.files[file_hash]
+                host_names.pop(host_name, None)
+                if len(host_names) == 0:
+                    self.remove_file(file_hash)
+                    
+    """
+    Queries
+    """
+    
+    def locate_file_hash(self, file_hash, host_name):
+        """
+        Returns [(host_name, [(division_size, last_block_size, n_blocks if full file else 0, block_numbers)])]
+        ordered by host name and by descending division size
+        """
+        with self.lock:
+            return self.locate(file_hash, host_name)
+        
+    def locate_file_hashes(self, file_hashes, host_name):
+        """
+        Results of locate_file_hash for many hashes, under a single acquisition of the lock
+        """
+        with self.lock:
+            return [self.locate(file_hash, host_name) for file_hash in file_hashes]
+        
+    def search_file_names(self, query, mode, host_name, limit):
+        """
+        Returns [(file_name, file_hash, [host_name])] of the files other nodes have whose name matches
+        the query (search_mode), ordered by name and hash; at most limit files, 0 for no limit
+        """
+        results = []
+        with self.lock:
+            for name in self.name_index.matches(query, mode):
+                for file_hash in sorted(self.name_index.hashes[name]):
+                    host_names = [other_host_name for other_host_name in sorted(self.files[file_hash]) if other_host_name != host_name]
+                    if host_names:
+                        results.append((name, file_hash, host_names))
+                        if len(results) == limit:
+                            return results
+        return results
+        
+    def locate(self, file_hash, host_name):  # lock must be held
+        results = []
+        
+        host_names = self.files.get(file_hash)
+        if host_names is None:
+            return results
+        
+        for other_host_name in sorted(host_names):
+            if other_host_name == host_name:
+                continue
+            
+            block_sets = []
+            for division_size in sorted(host_names[other_host_name], reverse=True):
+                entry = host_names[other_host_name][division_size]
+                n_blocks = len(entry.blocks)
+                
+                # a node with blocks 1..n of the division size has the full file
+                if n_blocks == entry.blocks.max():
+                    block_sets.append((division_size, entry.last_block_size, n_blocks, []))
+                else:
+                    block_sets.append((division_size, entry.last_block_size, 0, entry.blocks.numbers()))
+                    
+            results.append((other_host_name, block_sets))
+            
+        return results
@@ -0,0 +1,646 @@
+import struct
+from functools import lru_cache
+from utils import action, action_udp
+
+"""
+Wire format shared by the tracker and the nodes.
+
+Encoders size the message first and pack it into a preallocated bytearray with precompiled
+structs; variable-length parts (names, hashes, block numbers) use structs cached by length.
+TCP decoders read through a Socket_reader (or a Buffer_reader) after the action byte was read;
+UDP decoders receive the whole datagram and unpack straight from it.
+"""
+
+"""
+Precompiled structs
+"""
+
+U8 = struct.Struct("!B")
+U16 = struct.Struct("!H")
+
+ACTION_U8 = struct.Struct("!BB")
+ACTION_U16 = struct.Struct("!BH")
+RESPONSE = struct.Struct("!BBH")  # action, status, counter
+RESPONSE_FIELDS = struct.Struct("!BH")  # status, counter
+CHECK_STATUS_RESPONSE = struct.Struct("!BBBH")  # action, status, node status, counter
+CHECK_STATUS_RESPONSE_FIELDS = struct.Struct("!BBH")
+FULL_BLOCK_SET = struct.Struct("!HHH")  # division size, last block size, number of blocks
+PARTIAL_BLOCK_SET = struct.Struct("!HHB")  # division size, last block size, number of sequences
+LOCATE_HASH_BLOCK_SET = struct.Struct("!HHH")  # division size, last block size, full file
+DELTA_BLOCK_SET = struct.Struct("!HHH")  # division size, last block size, number of ranges
+SEARCH_NAME_FIELDS = struct.Struct("!BH")  # mode, maximum number of files (0: no limit)
+
+UDP_ACK = struct.Struct("!BH")  # flag, ack number (optionally followed by a SACK bitmap length and the bitmap)
+UDP_START_DATA_FIELDS = struct.Struct("!HHL")  # division size, block number, data length
+UDP_DATA_HEADER = struct.Struct("!BHHL")  # flag, sequence number, block number, data length
+
+@lru_cache(maxsize=1024)
+def u16_array(n):
+    return struct.Struct("!%dH" % n)
+
+@lru_cache(maxsize=1024)
+def file_header(hash_length, name_length):  # hash, name and number of block sets of an update
+    return struct.Struct("!H%dsB%dsB" % (hash_length, name_length))
+
+@lru_cache(maxsize=1024)
+def string_field(length_format, length):  # length followed by the bytes
+    return struct.Struct("!%s%ds" % (length_format, length))
+
+@lru_cache(maxsize=256)
+def udp_start_data_header(name_length):  # flag, sequence number, file name
+    return struct.Struct("!BHB%ds" % name_length)
+
+@lru_cache(maxsize=256)
+def udp_get_file_header(hash_length):  # flag, file hash, division size
+    return struct.Struct("!BB%dsH" % hash_length)
+
+"""
+Readers
+"""
+
+class Buffer_reader:
+    """
+    Same reading interface as utils.Socket_reader over a bytes-like object
+    """
+    def __init__(self, data, offset=0):
+        self.view = memoryview(data)
+        self.offset = offset
+        self.received = len(data)
+
+    def buffered(self):
+        return len(self.view) - self.offset
+
+    def read_action(self):
+        if self.offset >= len(self.view):
+            return None
+        byte = self.view[self.offset]
+        self.offset += 1
+        return byte
+
+    def read(self, n):
+        end = self.offset + n
+        if end > len(self.view):
+            raise ValueError("Message is shorter than its fields")
+        data = bytes(self.view[self.offset:end])
+        self.offset = end
+        return data
+
+    def unpack(self, packer):
+        values = packer.unpack_from(self.view, self.offset)
+        self.offset += packer.size
+        return values
+
+
+def read_u16_array(reader, n):
+    return list(reader.unpack(u16_array(n)))
+
+def read_hash(reader, length_packer):
+    return reader.read(reader.unpack(length_packer)[0]).hex()
+
+def read_string(reader):
+    return reader.read(reader.unpack(U8)[0]).decode("utf-8")
+
+def encode_field(length_format, data):
+    return string_field(length_format, len(data)).pack(len(data), data)
+
+"""
+Node -> tracker requests
+"""
+
+def encode_update_full_request(files):
+    # files: [(file_hash, file_name, [(division_size, last_block_size, n_blocks)])]
+    files = [(bytes.fromhex(file_hash), file_name.encode("utf-8"), block_sets) for file_hash, file_name, block_sets in files]
+
+    size = ACTION_U16.size + sum(
+        file_header(len(file_hash), len(file_name)).size + FULL_BLOCK_SET.size * len(block_sets)
+        for file_hash, file_name, block_sets in files
+    )
+    buffer = bytearray(size)
+    ACTION_U16.pack_into(buffer, 0, action.UPDATE_FULL_FILES.value, len(files))
+    offset = ACTION_U16.size
+
+    pack_block_set = FULL_BLOCK_SET.pack_into
+    for file_hash, file_name, block_sets in files:
+        header = file_header(len(file_hash), len(file_name))
+        header.pack_into(buffer, offset, len(file_hash), file_hash, len(file_name), file_name, len(block_sets))
+        offset += header.size
+
+        for division_size, last_block_size, n_blocks in block_sets:
+            pack_block_set(buffer, offset, division_size, last_block_size, n_blocks)
+            offset += FULL_BLOCK_SET.size
+
+    return buffer
+
+def decode_update_full_request(reader):
+    files = []
+
+    for _ in range(reader.unpack(U16)[0]):
+        file_hash = read_hash(reader, U16)
+        file_name = read_string(reader)
+        n_block_sets = reader.unpack(U8)[0]
+        block_sets = [reader.unpack(FULL_BLOCK_SET) for _ in range(n_block_sets)]
+        files.append((file_hash, file_name, block_sets))
+
+    return files
+
+def encode_update_partial_request(files):
+    # files: [(file_hash, file_name, [(division_size, last_block_size, [(first, last)], [block_number])])]
+    files = [(bytes.fromhex(file_hash), file_name.encode("utf-8"), block_sets) for file_hash, file_name, block_sets in files]
+
+    size = ACTION_U16.size
+    for file_hash, file_name, block_sets in files:
+        size += file_header(len(file_hash), len(file_name)).size
+        for _, _, sequences, blocks in block_sets:
+            size += PARTIAL_BLOCK_SET.size + 4 * len(sequences) + U16.size + 2 * len(blocks)
+
+    buffer = bytearray(size)
+    ACTION_U16.pack_into(buffer, 0, action.UPDATE_PARTIAL.value, len(files))
+    offset = ACTION_U16.size
+
+    for file_hash, file_name, block_sets in files:
+        header = file_header(len(file_hash), len(file_name))
+        header.pack_into(buffer, offset, len(file_hash), file_hash, len(file_name), file_name, len(block_sets))
+        offset += header.size
+
+        for division_size, last_block_size, sequences, blocks in block_sets:
+            PARTIAL_BLOCK_SET.pack_into(buffer, offset, division_size, last_block_size, len(sequences))
+            offset += PARTIAL_BLOCK_SET.size
+
+            flat_sequences = u16_array(2 * len(sequences))
+            flat_sequences.pack_into(buffer, offset, *[value for sequence in sequences for value in sequence])
+            offset += flat_sequences.size
+
+            U16.pack_into(buffer, offset, len(blocks))
+            offset += U16.size
+
+            block_numbers = u16_array(len(blocks))
+            block_numbers.pack_into(buffer, offset, *blocks)
+            offset += block_numbers.size
+
+    return buffer
+
+def decode_update_partial_request(reader):
+    files = []
+
+    for _ in range(reader.unpack(U16)[0]):
+        file_hash = read_hash(reader, U16)
+        file_name = read_string(reader)
+        block_sets = []
+
+        for _ in range(reader.unpack(U8)[0]):
+            division_size, last_block_size, n_sequences = reader.unpack(PARTIAL_BLOCK_SET)
+            flat_sequences = reader.unpack(u16_array(2 * n_sequences))
+            sequences = list(zip(flat_sequences[0::2], flat_sequences[1::2]))
+            blocks = read_u16_array(reader, reader.unpack(U16)[0])
+            block_sets.append((division_size, last_block_size, sequences, blocks))
+
+        files.append((file_hash, file_name, block_sets))
+
+    return files
+
+def encode_block_delta_request(action_value, files):
+    # files: [(file_hash, file_name, [(division_size, last_block_size, [(first, last)])])]
+    files = [(bytes.fromhex(file_hash), file_name.encode("utf-8"), block_sets) for file_hash, file_name, block_sets in files]
+
+    size = ACTION_U16.size
+    for file_hash, file_name, block_sets in files:
+        size += file_header(len(file_hash), len(file_name)).size
+        for _, _, ranges in block_sets:
+            size += DELTA_BLOCK_SET.size + 4 * len(ranges)
+
+    buffer = bytearray(size)
+    ACTION_U16.pack_into(buffer, 0, action_value, len(files))
+    offset = ACTION_U16.size
+
+    for file_hash, file_name, block_sets in files:
+        header = file_header(len(file_hash), len(file_name))
+        header.pack_into(buffer, offset, len(file_hash), file_hash, len(file_name), file_name, len(block_sets))
+        offset += header.size
+
+        for division_size, last_block_size, ranges in block_sets:
+            DELTA_BLOCK_SET.pack_into(buffer, offset, division_size, last_block_size, len(ranges))
+            offset += DELTA_BLOCK_SET.size
+
+            flat_ranges = u16_array(2 * len(ranges))
+            flat_ranges.pack_into(buffer, offset, *[value for block_range in ranges for value in block_range])
+            offset += flat_ranges.size
+
+    return buffer
+
+def encode_add_blocks_request(files):
+    return encode_block_delta_request(action.ADD_BLOCKS.value, files)
+
+def encode_remove_blocks_request(files):  # the names and last block sizes are not used
+    return encode_block_delta_request(action.REMOVE_BLOCKS.value, files)
+
+def decode_block_delta_request(reader):
+    files = []
+
+    for _ in range(reader.unpack(U16)[0]):
+        file_hash = read_hash(reader, U16)
+        file_name = read_string(reader)
+        block_sets = []
+
+        for _ in range(reader.unpack(U8)[0]):
+            division_size, last_block_size, n_ranges = reader.unpack(DELTA_BLOCK_SET)
+            flat_ranges = reader.unpack(u16_array(2 * n_ranges))
+            block_sets.append((division_size, last_block_size, list(zip(flat_ranges[0::2], flat_ranges[1::2]))))
+
+        files.append((file_hash, file_name, block_sets))
+
+    return files
+
+def encode_locate_hash_request(file_hash):
+    return U8.pack(action.LOCATE_HASH.value) + encode_field("H", bytes.fromhex(file_hash))
+
+def decode_locate_hash_request(reader):
+    return read_hash(reader, U16)
+
+MAX_LOCATE_HASH_BATCH = 0xFFFF  # hashes in one request, their count is a 16-bit field
+
+def encode_locate_hash_batch_request(file_hashes):
+    fields = [encode_field("H", bytes.fromhex(file_hash)) for file_hash in file_hashes]
+    return b"".join([ACTION_U16.pack(action.LOCATE_HASH_BATCH.value, len(fields))] + fields)
+
+def decode_locate_hash_batch_request(reader):
+    return [read_hash(reader, U16) for _ in range(reader.unpack(U16)[0])]
+
+def encode_locate_name_request(file_name):
+    return U8.pack(action.LOCATE_NAME.value) + encode_field("B", file_name.encode("utf-8"))
+
+def decode_locate_name_request(reader):
+    return read_string(reader)
+
+def encode_search_name_request(query, mode, limit):
+    return U8.pack(action.SEARCH_NAME.value) + SEARCH_NAME_FIELDS.pack(mode, limit) + encode_field("B", query.encode("utf-8"))
+
+def decode_search_name_request(reader):
+    mode, limit = reader.unpack(SEARCH_NAME_FIELDS)
+    return read_string(reader), mode, limit
+
+def encode_check_status_request(host_name):
+    return U8.pack(action.CHECK_STATUS.value) + encode_field("B", host_name.encode("utf-8"))
+
+def decode_check_status_request(reader):
+    return read_string(reader)
+
+def encode_update_status_request(node_status):
+    return ACTION_U8.pack(action.UPDATE_STATUS.value, node_status)
+
+def decode_update_status_request(reader):
+    return reader.unpack(U8)[0]
+
+def encode_leave_request():
+    return U8.pack(action.LEAVE.value)
+
+def encode_heartbeat_request():
+    return U8.pack(action.HEARTBEAT.value)
+
+"""
+Tracker -> node responses
+"""
+
+def encode_response(result_status, counter):
+    return RESPONSE.pack(action.RESPONSE.value, result_status, counter)
+
+def decode_response(reader):
+    return reader.unpack(RESPONSE_FIELDS)  # status, counter
+
+def encode_counter(counter):
+    return U16.pack(counter)
+
+def next_counter(counter):
+    # both ends number the requests of a connection the same way; the count wraps with its 16-bit field
+    return (counter + 1) & 0xFFFF
+
+def encode_locate_hash_body(results):  # response without the counter
+    # results: [(host_name, [(division_size, last_block_size, full_file, block_numbers)])]
+    results = [(host_name.encode("utf-8"), block_sets) for host_name, block_sets in results]
+
+    size = ACTION_U16.size
+    for host_name, block_sets in results:
+        size += U8.size + len(host_name) + U8.size + LOCATE_HASH_BLOCK_SET.size * len(block_sets)
+        for _, _, full_file, block_numbers in block_sets:
+            if full_file == 0:
+                size += U16.size + 2 * len(block_numbers)
+
+    buffer = bytearray(size)
+    ACTION_U16.pack_into(buffer, 0, action.RESPONSE_LOCATE_HASH.value, len(results))
+    offset = ACTION_U16.size
+
+    for host_name, block_sets in results:
+        header = string_field("B", len(host_name))
+        header.pack_into(buffer, offset, len(host_name), host_name)
+        offset += header.size
+        U8.pack_into(buffer, offset, len(block_sets))
+        offset += U8.size
+
+        for division_size, last_block_size, full_file, block_numbers in block_sets:
+            LOCATE_HASH_BLOCK_SET.pack_into(buffer, offset, division_size, last_block_size, full_file)
+            offset += LOCATE_HASH_BLOCK_SET.size
+
+            if full_file == 0:
+                U16.pack_into(buffer, offset, len(block_numbers))
+                offset += U16.size
+                numbers = u16_array(len(block_numbers))
+                numbers.pack_into(buffer, offset, *block_numbers)
+                offset += numbers.size
+
+    return buffer
+
+def decode_locate_hash_results(reader):
+    output_full_files = {}  # host_name -> [(block_size, last_block_size, full_file)]
+    output_partial_files = {}  # host_name -> [(block_size, last_block_size, [blocks])]
+
+    for _ in range(reader.unpack(U16)[0]):
+        host_name = read_string(reader)
+
+        for _ in range(reader.unpack(U8)[0]):
+            block_size, last_block_size, full_file = reader.unpack(LOCATE_HASH_BLOCK_SET)
+
+            if full_file == 0:
+                blocks = read_u16_array(reader, reader.unpack(U16)[0])
+                output_partial_files.setdefault(host_name, []).append((block_size, last_block_size, blocks))
+            else:
+                output_full_files.setdefault(host_name, []).append((block_size, last_block_size, full_file))
+
+    return output_full_files, output_partial_files
+
+def skip_locate_hash_results(reader):  # moves a Buffer_reader past the results without decoding them
+    # lengths are unpacked on their own line: in "offset += unpack()" the offset is read before unpack moves it
+    for _ in range(reader.unpack(U16)[0]):
+        host_name_length = reader.unpack(U8)[0]
+        reader.offset += host_name_length
+
+        for _ in range(reader.unpack(U8)[0]):
+            if reader.unpack(LOCATE_HASH_BLOCK_SET)[2] == 0:
+                n_blocks = reader.unpack(U16)[0]
+                reader.offset += 2 * n_blocks
+
+def decode_locate_hash_response(reader):
+    output_full_files, output_partial_files = decode_locate_hash_results(reader)
+    counter = reader.unpack(U16)[0]
+    return output_full_files, output_partial_files, counter
+
+def encode_locate_hash_batch_header(n_hashes):
+    return ACTION_U16.pack(action.RESPONSE_LOCATE_HASH_BATCH.value, n_hashes)
+
+def encode_locate_hash_batch_entry(file_hash, body):
+    # body: a LOCATE_HASH response body, whose action byte is replaced by the hash
+    return encode_field("H", bytes.fromhex(file_hash)) + body[1:]
+
+def decode_locate_hash_batch_response(reader):
+    results = []  # [(file_hash, output_full_files, output_partial_files)] in the order of the request
+
+    for _ in range(reader.unpack(U16)[0]):
+        file_hash = read_hash(reader, U16)
+        results.append((file_hash,) + decode_locate_hash_results(reader))
+
+    counter = reader.unpack(U16)[0]
+    return results, counter
+
+def split_locate_hash_batch_response(reader):
+    """
+    Entries of a batch response read by a Buffer_reader, as bytes, without decoding them
+    """
+    entries = []
+
+    for _ in range(reader.unpack(U16)[0]):
+        start = reader.offset
+        hash_length = reader.unpack(U16)[0]
+        reader.offset += hash_length
+        skip_locate_hash_results(reader)
+        entries.append(bytes(reader.view[start:reader.offset]))
+
+    return entries
+
+def encode_locate_name_body(results):  # response without the counter
+    # results: [(file_hash, host_name)]
+    host_name_references = {}  # host_name -> reference (1-based)
+    hash_dict = {}  # file_hash -> [reference]
+
+    for file_hash, host_name in results:
+        reference = host_name_references.setdefault(host_name, len(host_name_references) + 1)
+        hash_dict.setdefault(file_hash, []).append(reference)
+
+    host_names = [host_name.encode("utf-8") for host_name in host_name_references]
+    file_hashes = [(bytes.fromhex(file_hash), references) for file_hash, references in hash_dict.items()]
+
+    size = ACTION_U16.size + sum(U8.size + len(host_name) for host_name in host_names) + U16.size
+    size += sum(U8.size + len(file_hash) + U16.size + 2 * len(references) for file_hash, references in file_hashes)
+
+    buffer = bytearray(size)
+    ACTION_U16.pack_into(buffer, 0, action.RESPONSE_LOCATE_NAME.value, len(host_names))
+    offset = ACTION_U16.size
+
+    for host_name in host_names:
+        field = string_field("B", len(host_name))
+        field.pack_into(buffer, offset, len(host_name), host_name)
+        offset += field.size
+
+    U16.pack_into(buffer, offset, len(file_hashes))
+    offset += U16.size
+
+    for file_hash, references in file_hashes:
+        field = string_field("B", len(file_hash))
+        field.pack_into(buffer, offset, len(file_hash), file_hash)
+        offset += field.size
+        U16.pack_into(buffer, offset, len(references))
+        offset += U16.size
+        numbers = u16_array(len(references))
+        numbers.pack_into(buffer, offset, *references)
+        offset += numbers.size
+
+    return buffer
+
+def decode_locate_name_response(reader):
+    n_host_names = reader.unpack(U16)[0]
+    host_names = [read_string(reader) for _ in range(n_host_names)]
+
+    output = {}  # hash -> [host_name]
+
+    for _ in range(reader.unpack(U16)[0]):
+        file_hash = read_hash(reader, U8)
+        references = reader.unpack(u16_array(reader.unpack(U16)[0]))
+        output[file_hash] = [host_names[reference - 1] for reference in references]
+
+    counter = reader.unpack(U16)[0]
+    return output, counter
+
+def encode_search_name_body(results):  # response without the counter
+    # results: [(file_name, file_hash, [host_name])]; host names are sent once and referenced like in LOCATE_NAME
+    host_name_references = {}  # host_name -> reference (1-based)
+    files = []
+
+    for file_name, file_hash, host_names in results:
+        references = [host_name_references.setdefault(host_name, len(host_name_references) + 1) for host_name in host_names]
+        files.append((bytes.fromhex(file_hash), file_name.encode("utf-8"), references))
+
+    host_names = [host_name.encode("utf-8") for host_name in host_name_references]
+
+    size = ACTION_U16.size + sum(U8.size + len(host_name) for host_name in host_names) + U16.size
+    size += sum(2 * U8.size + len(file_hash) + len(file_name) + U16.size + 2 * len(references) for file_hash, file_name, references in files)
+
+    buffer = bytearray(size)
+    ACTION_U16.pack_into(buffer, 0, action.RESPONSE_SEARCH_NAME.value, len(host_names))
+    offset = ACTION_U16.size
+
+    for host_name in host_names:
+        field = string_field("B", len(host_name))
+        field.pack_into(buffer, offset, len(host_name), host_name)
+        offset += field.size
+
+    U16.pack_into(buffer, offset, len(files))
+    offset += U16.size
+
+    for file_hash, file_name, references in files:
+        for data in (file_hash, file_name):
+            field = string_field("B", len(data))
+            field.pack_into(buffer, offset, len(data), data)
+            offset += field.size
+        U16.pack_into(buffer, offset, len(references))
+        offset += U16.size
+        numbers = u16_array(len(references))
+        numbers.pack_into(buffer, offset, *references)
+        offset += numbers.size
+
+    return buffer
+
+def decode_search_name_results(reader):  # body after the action byte, without the counter
+    n_host_names = reader.unpack(U16)[0]
+    host_names = [read_string(reader) for _ in range(n_host_names)]
+
+    results = []  # [(file_name, file_hash, [host_name])]
+
+    for _ in range(reader.unpack(U16)[0]):
+        file_hash = read_hash(reader, U8)
+        file_name = read_string(reader)
+        references = reader.unpack(u16_array(reader.unpack(U16)[0]))
+        results.append((file_name, file_hash, [host_names[reference - 1] for reference in references]))
+
+    return results
+
+def decode_search_name_response(reader):
+    results = decode_search_name_results(reader)
+    counter = reader.unpack(U16)[0]
+    return results, counter
+
+def encode_check_status_response(status_db, result, counter):
+    return CHECK_STATUS_RESPONSE.pack(action.RESPONSE_CHECK_STATUS.value, status_db, result or 0, counter)
+
+def decode_check_status_response(reader):
+    return reader.unpack(CHECK_STATUS_RESPONSE_FIELDS)  # status, node status, counter
+
+"""
+Node <-> node datagrams
+"""
+
+# the GET requests may end with the receive window of the requester (datagrams it keeps ahead of a missing one);
+# a request without it leaves the window to the sender
+
+def encode_udp_get_full_file_request(file_hash, division_size, window=None):
+    file_hash = bytes.fromhex(file_hash)
+    data = udp_get_file_header(len(file_hash)).pack(action_udp.GET_FULL_FILE.value, len(file_hash), file_hash, division_size)
+    return data if window is None else data + U16.pack(window)
+
+def decode_udp_get_full_file_request(data):
+    header = udp_get_file_header(data[1])
+    _, _, file_hash, division_size = header.unpack_from(data)
+    window = U16.unpack_from(data, header.size)[0] if len(data) >= header.size + U16.size else None
+    return file_hash.hex(), division_size, window
+
+def encode_udp_get_partial_file_request(file_hash, division_size, sequences, blocks, window=None):
+    file_hash = bytes.fromhex(file_hash)
+    header = udp_get_file_header(len(file_hash))
+    flat_sequences = u16_array(2 * len(sequences))
+    block_numbers = u16_array(len(blocks))
+
+    buffer = bytearray(header.size + U8.size + flat_sequences.size + U16.size + block_numbers.size + (0 if window is None else U16.size))
+    header.pack_into(buffer, 0, action_udp.GET_PARTIAL_FILE.value, len(file_hash), file_hash, division_size)
+    offset = header.size
+
+    U8.pack_into(buffer, offset, len(sequences))
+    offset += U8.size
+    flat_sequences.pack_into(buffer, offset, *[value for sequence in sequences for value in sequence])
+    offset += flat_sequences.size
+
+    U16.pack_into(buffer, offset, len(blocks))
+    offset += U16.size
+    block_numbers.pack_into(buffer, offset, *blocks)
+    offset += block_numbers.size
+
+    if window is not None:
+        U16.pack_into(buffer, offset, window)
+
+    return buffer
+
+def decode_udp_get_partial_file_request(data):
+    reader = Buffer_reader(data)
+    _, _, file_hash, division_size = reader.unpack(udp_get_file_header(data[1]))
+
+    flat_sequences = reader.unpack(u16_array(2 * reader.unpack(U8)[0]))
+    sequences = list(zip(flat_sequences[0::2], flat_sequences[1::2]))
+    blocks = read_u16_array(reader, reader.unpack(U16)[0])
+    window = reader.unpack(U16)[0] if reader.buffered() >= U16.size else None
+
+    return file_hash.hex(), division_size, sequences, blocks, window
+
+def encode_udp_start_data_message(flag, seq_num, file_name, division_size, block_number, data):
+    file_name = file_name.encode("utf-8")
+    header = udp_start_data_header(len(file_name))
+
+    buffer = bytearray(header.size + UDP_START_DATA_FIELDS.size + len(data))
+    header.pack_into(buffer, 0, flag, seq_num, len(file_name), file_name)
+    UDP_START_DATA_FIELDS.pack_into(buffer, header.size, division_size, block_number, len(data))
+    buffer[header.size + UDP_START_DATA_FIELDS.size:] = data
+
+    return buffer
+
+def decode_udp_start_data_message(data):
+    header = udp_start_data_header(data[3])
+    _, seq_num, _, file_name = header.unpack_from(data)
+    division_size, block_number, data_len = UDP_START_DATA_FIELDS.unpack_from(data, header.size)
+
+    start = header.size + UDP_START_DATA_FIELDS.size
+    with memoryview(data) as view:
+        return seq_num, file_name.decode("utf-8"), division_size, block_number, bytes(view[start:start + data_len])
+
+def encode_udp_data_message(flag, seq_num, block_number, data):
+    return UDP_DATA_HEADER.pack(flag, seq_num, block_number, len(data)) + data
+
+def decode_udp_data_message(data):
+    _, seq_num, block_number, data_len = UDP_DATA_HEADER.unpack_from(data)
+    start = UDP_DATA_HEADER.size
+    with memoryview(data) as view:
+        return seq_num, block_number, bytes(view[start:start + data_len])
+
+MAX_SACK_BITMAP = 255  # bytes, the length is a single byte: only the first 2040 sequence numbers after the ack are listed
+
+def encode_udp_ack(ack_num, sacked=()):
+    # sacked: sequence numbers after ack_num the receiver holds; bit i of the (little endian) bitmap is ack_num + 1 + i
+    bitmap = 0
+    for seq_num in sacked:
+        if seq_num - ack_num - 1 < 8 * MAX_SACK_BITMAP:
+            bitmap |= 1 << (seq_num - ack_num - 1)
+
+    if not bitmap:
+        return UDP_ACK.pack(action_udp.ACK.value, ack_num)
+
+    length = (bitmap.bit_length() + 7) // 8
+    return UDP_ACK.pack(action_udp.ACK.value, ack_num) + U8.pack(length) + bitmap.to_bytes(length, "little")
+
+def decode_udp_ack(data):
+    ack_num = UDP_ACK.unpack_from(data)[1]
+    sacked = []
+
+    if len(data) > UDP_ACK.size:
+        length = data[UDP_ACK.size]
+        bitmap = int.from_bytes(data[UDP_ACK.size + 1:UDP_ACK.size + 1 + length], "little")
+        seq_num = ack_num + 1
+        while bitmap:
+            if bitmap & 1:
+                sacked.append(seq_num)
+            bitmap >>= 1
+            seq_num += 1
+
+    return ack_num, sacked
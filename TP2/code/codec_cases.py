@@ -0,0 +1,215 @@
+import codec
+from codec import Buffer_reader
+from utils import action, action_udp, status, search_mode
+
+"""
+Representative messages of each type, shared by the codec round trip tests and the codec benchmark
+"""
+
+def make_codec_cases():
+    """
+    (message type, encode, decode, expected decoded value) of a representative message of each type;
+    TCP messages are decoded past their action byte, like the tracker and the nodes do (the ones without fields are compared whole)
+    """
+    file_hash = "ab" * 20
+    data = bytes(range(256)) * 4
+    
+    full_files = [("%040x" % i, "file_%d" % i, [(512, 100, 1000)]) for i in range(100)]
+    partial_files = [("%040x" % i, "file_%d" % i, [(512, 512, [(1, 100)], list(range(200, 2200, 2)))]) for i in range(10)]
+    
+    locate_hash_results = [
+        ("node_%d" % i, [(512, 100, 1000, None)] if i % 2 else [(512, 100, 0, list(range(1, 1000, 2)))])
+        for i in range(50)
+    ]
+    locate_hash_expected = (
+        {host_name: [block_sets[0][:3]] for host_name, block_sets in locate_hash_results if block_sets[0][2]},
+        {host_name: [block_sets[0][:2] + (block_sets[0][3],)] for host_name, block_sets in locate_hash_results if not block_sets[0][2]},
+        1
+    )
+    
+    batch_hashes = ["%040x" % i for i in range(100)]
+    
+    locate_name_results = [("%040x" % i, "node_%d" % j) for i in range(50) for j in range(10)]
+    locate_name_expected = ({"%040x" % i: ["node_%d" % j for j in range(10)] for i in range(50)}, 1)
+    
+    search_name_results = [("file_%d" % i, "%040x" % i, ["node_%d" % j for j in range(10)]) for i in range(20)]
+    
+    delta_files = [("%040x" % i, "file_%d" % i, [(512, 100, [(1, 10), (20, 30)]), (256, 256, [(5, 5)])]) for i in range(20)]
+    
+    sequences = [(1, 100), (300, 400)]
+    blocks = list(range(500, 900, 2))
+    
+    return [
+        (
+            "UPDATE_FULL_FILES",
+            lambda: codec.encode_update_full_request(full_files),
+            lambda message: codec.decode_update_full_request(Buffer_reader(message, 1)),
+            full_files,
+        ),
+        (
+            "UPDATE_PARTIAL",
+            lambda: codec.encode_update_partial_request(partial_files),
+            lambda message: codec.decode_update_partial_request(Buffer_reader(message, 1)),
+            partial_files,
+        ),
+        (
+            "ADD_BLOCKS",
+            lambda: codec.encode_add_blocks_request(delta_files),
+            lambda message: codec.decode_block_delta_request(Buffer_reader(message, 1)),
+            delta_files,
+        ),
+        (
+            "REMOVE_BLOCKS",
+            lambda: codec.encode_remove_blocks_request(delta_files),
+            lambda message: codec.decode_block_delta_request(Buffer_reader(message, 1)),
+            delta_files,
+        ),
+        (
+            "UPDATE_STATUS",
+            lambda: codec.encode_update_status_request(1),
+            lambda message: codec.decode_update_status_request(Buffer_reader(message, 1)),
+            1,
+        ),
+        (
+            "CHECK_STATUS",
+            lambda: codec.encode_check_status_request("node_1"),
+            lambda message: codec.decode_check_status_request(Buffer_reader(message, 1)),
+            "node_1",
+        ),
+        (
+            "HEARTBEAT",
+            codec.encode_heartbeat_request,
+            lambda message: tuple(message),
+            (action.HEARTBEAT.value,),
+        ),
+        (
+            "LEAVE",
+            codec.encode_leave_request,
+            lambda message: tuple(message),
+            (action.LEAVE.value,),
+        ),
+        (
+            "LOCATE_NAME",
+            lambda: codec.encode_locate_name_request("file_1"),
+            lambda message: codec.decode_locate_name_request(Buffer_reader(message, 1)),
+            "file_1",
+        ),
+        (
+            "LOCATE_HASH",
+            lambda: codec.encode_locate_hash_request(file_hash),
+            lambda message: codec.decode_locate_hash_request(Buffer_reader(message, 1)),
+            file_hash,
+        ),
+        (
+            "LOCATE_HASH_BATCH",
+            lambda: codec.encode_locate_hash_batch_request(batch_hashes),
+            lambda message: codec.decode_locate_hash_batch_request(Buffer_reader(message, 1)),
+            batch_hashes,
+        ),
+        (
+            "RESPONSE_LOCATE_HASH",
+            lambda: codec.encode_locate_hash_body(locate_hash_results) + codec.encode_counter(1),
+            lambda message: codec.decode_locate_hash_response(Buffer_reader(message, 1)),
+            locate_hash_expected,
+        ),
+        (
+            "RESPONSE_LOCATE_HASH_BATCH",
+            lambda: b"".join(
+                [codec.encode_locate_hash_batch_header(len(batch_hashes[:10]))]
+                + [codec.encode_locate_hash_batch_entry(h, codec.encode_locate_hash_body(locate_hash_results)) for h in batch_hashes[:10]]
+                + [codec.encode_counter(1)]
+            ),
+            lambda message: codec.decode_locate_hash_batch_response(Buffer_reader(message, 1)),
+            ([(h,) + locate_hash_expected[:2] for h in batch_hashes[:10]], 1),
+        ),
+        (
+            "RESPONSE",
+            lambda: codec.encode_response(status.NOT_FOUND.value, 7),
+            lambda message: codec.decode_response(Buffer_reader(message, 1)),
+            (status.NOT_FOUND.value, 7),
+        ),
+        (
+            "RESPONSE_CHECK_STATUS",
+            lambda: codec.encode_check_status_response(status.SUCCESS.value, 1, 7),
+            lambda message: codec.decode_check_status_response(Buffer_reader(message, 1)),
+            (status.SUCCESS.value, 1, 7),
+        ),
+        (
+            "RESPONSE_LOCATE_NAME",
+            lambda: codec.encode_locate_name_body(locate_name_results) + codec.encode_counter(1),
+            lambda message: codec.decode_locate_name_response(Buffer_reader(message, 1)),
+            locate_name_expected,
+        ),
+        (
+            "SEARCH_NAME",
+            lambda: codec.encode_search_name_request("file_1", search_mode.PREFIX.value, 20),
+            lambda message: codec.decode_search_name_request(Buffer_reader(message, 1)),
+            ("file_1", search_mode.PREFIX.value, 20),
+        ),
+        (
+            "RESPONSE_SEARCH_NAME",
+            lambda: codec.encode_search_name_body(search_name_results) + codec.encode_counter(1),
+            lambda message: codec.decode_search_name_response(Buffer_reader(message, 1)),
+            (search_name_results, 1),
+        ),
+        (
+            "UDP GET_FULL no window",
+            lambda: codec.encode_udp_get_full_file_request(file_hash, 512),
+            codec.decode_udp_get_full_file_request,
+            (file_hash, 512, None),
+        ),
+        (
+            "UDP GET_PARTIAL no window",
+            lambda: codec.encode_udp_get_partial_file_request(file_hash, 512, sequences, blocks),
+            codec.decode_udp_get_partial_file_request,
+            (file_hash, 512, sequences, blocks, None),
+        ),
+        (
+            "UDP GET_FULL_FILE",
+            lambda: codec.encode_udp_get_full_file_request(file_hash, 512, 64),
+            codec.decode_udp_get_full_file_request,
+            (file_hash, 512, 64),
+        ),
+        (
+            "UDP GET_PARTIAL_FILE",
+            lambda: codec.encode_udp_get_partial_file_request(file_hash, 512, sequences, blocks, 64),
+            codec.decode_udp_get_partial_file_request,
+            (file_hash, 512, sequences, blocks, 64),
+        ),
+        (
+            "UDP START_DATA",
+            lambda: codec.encode_udp_start_data_message(action_udp.START_DATA.value, 1, "file_0", 1024, 7, data),
+            codec.decode_udp_start_data_message,
+            (1, "file_0", 1024, 7, data),
+        ),
+        (
+            "UDP START_END_DATA",
+            lambda: codec.encode_udp_start_data_message(action_udp.START_END_DATA.value, 1, "file_0", 1024, 7, data),
+            codec.decode_udp_start_data_message,
+            (1, "file_0", 1024, 7, data),
+        ),
+        (
+            "UDP DATA",
+            lambda: codec.encode_udp_data_message(action_udp.DATA.value, 2, 8, data),
+            codec.decode_udp_data_message,
+            (2, 8, data),
+        ),
+        (
+            "UDP ACK",
+            lambda: codec.encode_udp_ack(3),
+            codec.decode_udp_ack,
+            (3, []),
+        ),
+        (
+            "UDP ACK with SACK",
+            lambda: codec.encode_udp_ack(3, [5, 6, 20, 35]),
+            codec.decode_udp_ack,
+            (3, [5, 6, 20, 35]),
+        ),
+        (
+            "UDP END_DATA",
+            lambda: codec.encode_udp_data_message(action_udp.END_DATA.value, 65535, 8, b""),
+            codec.decode_udp_data_message,
+            (65535, 8, b""),
+        ),
+    ]
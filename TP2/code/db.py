@@ -1,24 +1,73 @@
 import sqlite3
 from sqlite3 import Error
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from concurrent.futures import Future
+from queue import Queue
+import queue
 import utils
+from utils import Interval_set
+
+
+SCHEMA_VERSION = 4  # stored in PRAGMA user_version; persistent databases with another version are recreated
+
+
+def serialized_write(method):
+    """
+    Runs a DB_manager method on its writer thread (the only user of the write connection) and waits for the result
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        if threading.current_thread() is self.writer or not self.writer.is_alive():
+            return method(self, *args)
+        
+        future = Future()
+        self.write_queue.put((method, args, future))
+        return future.result()
+    
+    return wrapper
 
 
 class DB_manager(metaclass=utils.SingletonMeta):
     """
     Class that manages the database (only one instance of this class is allowed)
-    SQLite3 is used as the database engine
+    SQLite3 is used as the database engine; writes are serialized on one writer thread
+    and reads use a pool of read-only connections
     """
-    def __init__(self, db_file, debug=False):
+    def __init__(self, db_file, debug=False, persistent=False, max_read_connections=8):
         self.db_file = db_file
-        self.conn = None
+        self.conn = None  # write connection, only used by the writer thread
         self.cursor = None
         self.debug = debug
+        self.persistent = persistent
+        self.snapshot_id = None  # id of the snapshot matching the stored data, if any
+        
+        self.write_queue = Queue()
+        self.writer = threading.Thread(target=self.run_writer, daemon=True)
+        
+        self.read_connections = Queue()
+        self.n_read_connections = 0
+        self.max_read_connections = max_read_connections
+        self.read_connections_lock = threading.Lock()
         
         try:
             self.conn = sqlite3.connect(db_file, check_same_thread=False)
             self.cursor = self.conn.cursor()
-            self.drop_tables()            
+            self.set_pragmas()
+            
+            schema_version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            if not persistent or schema_version != SCHEMA_VERSION:
+                self.drop_tables()
+                
             self.create_tables()
+            self.snapshot_id = self.get_snapshot_marker()
+            self.writer.start()
+            
+            if self.debug:
+                for name, detail in self.check_query_plans():
+                    print("[init] Warning: %s does a full scan (%s)" % (name, detail))
         except Error as e:
             if self.conn:
                 self.conn.close()
@@ -26,13 +75,120 @@ class DB_manager(metaclass=utils.SingletonMeta):
                 print("[init] Error: ", e)
                 
     def __del__(self):
+        self.close()
+        
+    def close(self):
+        if self.writer.is_alive():
+            self.write_queue.put((None, None, None))
+            self.writer.join()
+            
         if self.conn:
             self.conn.commit()
             self.conn.close()
+            self.conn = None
+            
+        while True:
+            try:
+                self.read_connections.get_nowait().close()
+            except queue.Empty:
+                break
             
     """
-    Create and drop tables; delete node
+    Query plans
+    """
+    
+    locate_file_hash_query = """
+        SELECT Node_host_name, division_size, first_number, last_number, last_block_size
+        FROM Block_range
+        WHERE File_hash = (?) AND Node_host_name != (?)
+        ORDER BY Node_host_name, division_size desc, first_number asc;
     """
+    
+    locate_file_name_query = """
+        SELECT distinct BR.File_hash, BR.Node_host_name
+            FROM Block_range AS BR
+            JOIN File AS F ON BR.File_hash = F.hash
+            WHERE F.name = (?) AND BR.Node_host_name != (?);
+    """
+    
+    expire_nodes_query = """
+        SELECT host_name
+        FROM Node
+        WHERE last_seen < (?)
+    """
+    
+    def check_query_plans(self):
+        """
+        Runs EXPLAIN QUERY PLAN on the tracker's lookups; returns the plan lines that scan a whole table
+        """
+        queries = {
+            "locate_file_hash": (self.locate_file_hash_query, ("", "")),
+            "locate_file_name": (self.locate_file_name_query, ("", "")),
+            "expire_nodes": (self.expire_nodes_query, (0,)),
+        }
+        
+        scans = []
+        with self.read_connection() as conn:
+            for name, (query, args) in queries.items():
+                for row in conn.execute("EXPLAIN QUERY PLAN " + query, args):
+                    detail = row[-1]
+                    # "SCAN <table> USING COVERING INDEX" still reads the whole index
+                    if detail.startswith("SCAN"):
+                        scans.append((name, detail))
+                        
+        return scans
+        
+    """
+    Writer thread and read connections
+    """
+    
+    def run_writer(self):
+        while True:
+            method, args, future = self.write_queue.get()
+            if method is None:
+                break
+            
+            try:
+                future.set_result(method(self, *args))
+            except Exception as e:
+                future.set_exception(e)
+                
+    @contextmanager
+    def read_connection(self):
+        """
+        Borrows a read-only connection from the pool (opening one if the pool isn't full yet)
+        """
+        conn = None
+        try:
+            conn = self.read_connections.get_nowait()
+        except queue.Empty:
+            with self.read_connections_lock:
+                if self.n_read_connections < self.max_read_connections:
+                    self.n_read_connections += 1
+                    conn = sqlite3.connect(self.db_file, check_same_thread=False)
+                    conn.execute("PRAGMA query_only = ON")
+                    conn.execute("PRAGMA cache_size = -16384")  # 16 MiB
+                    conn.execute("PRAGMA mmap_size = 268435456")  # 256 MiB
+            if conn is None:
+                conn = self.read_connections.get()
+                
+        try:
+            yield conn
+        finally:
+            self.read_connections.put(conn)
+            
+    """
+    Pragmas; create and drop tables; delete node
+    """
+    
+    def set_pragmas(self):
+        # WAL lets readers run while a transaction is being written and makes commits cheaper;
+        # with WAL, synchronous=NORMAL only loses the last transactions on power loss, never consistency
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("PRAGMA cache_size = -65536")  # 64 MiB
+        self.conn.execute("PRAGMA mmap_size = 268435456")  # 256 MiB
+        self.conn.execute("PRAGMA temp_store = MEMORY")
         
     def create_tables(self):
         try:
@@ -44,6 +200,7 @@ class DB_manager(metaclass=utils.SingletonMeta):
                 create table if not exists Node (
                     host_name TEXT(255) not null,
                     status INTEGER not null default 0,
+                    last_seen REAL not null default 0,
                     primary key (host_name)
                 );
                 """
@@ -59,39 +216,76 @@ class DB_manager(metaclass=utils.SingletonMeta):
                 """
             )
 
+            # contiguous blocks a node has of a file are stored as one range;
+            # last_block_size is the size of the block numbered last_number
             self.cursor.execute(
                 """
-                create table if not exists Block (
-                    size integer not null,
-                    number integer not null,
-                    division_size integer not null,
-                    is_last integer not null,
+                create table if not exists Block_range (
+                    Node_host_name text(255) not null,
                     File_hash text(32) not null,
-                    primary key (size, number, division_size, File_hash),
+                    division_size integer not null,
+                    first_number integer not null,
+                    last_number integer not null,
+                    last_block_size integer not null,
+                    primary key (Node_host_name, File_hash, division_size, first_number),
+                    foreign key (Node_host_name) 
+                        references Node (host_name),
                     foreign key (File_hash) 
-                        references File (hash)
-                    check (size <= division_size)
+                        references File (hash),
+                    check (first_number <= last_number),
+                    check (last_block_size <= division_size)
                 );
                 """
             )
-            
+
+            # id of the last snapshot written, deleted by the first write that makes it stale
             self.cursor.execute(
                 """
-                create table if not exists Node_has_Block (
-                    Node_host_name text(255) not null,
-                    Block_size INTEGER NOT NULL,
-                    Block_number INTEGER NOT NULL,
-                    Block_division_size INTEGER NOT NULL,
-                    Block_File_hash text(32) NOT NULL,
-                    primary key (Node_host_name, Block_size, Block_number, Block_division_size, Block_File_hash),
-                    foreign key (Node_host_name) 
-                        references Node (host_name),
-                    foreign key (Block_size, Block_number, Block_division_size, Block_File_hash) 
-                        references Block (size, number, division_size, File_hash)
+                create table if not exists Snapshot (
+                    id blob not null
+                );
+                """
+            )
+
+            # blocks of an update waiting to be merged with the stored ranges (one per connection)
+            self.cursor.execute(
+                """
+                create temp table if not exists Incoming_range (
+                    File_hash text(32) not null,
+                    division_size integer not null,
+                    first_number integer not null,
+                    last_number integer not null
                 );
                 """
             )
 
+            # LOCATE_HASH: equality on the hash, then ordered by host name, division size and first block;
+            # covering, so the ranges are read from the index alone
+            self.cursor.execute(
+                """
+                create index if not exists Block_range_File_hash
+                    on Block_range (File_hash, Node_host_name, division_size desc, first_number, last_number, last_block_size);
+                """
+            )
+            
+            # LOCATE_NAME: equality on the name
+            self.cursor.execute(
+                """
+                create index if not exists File_name
+                    on File (name, hash);
+                """
+            )
+            
+            # expiration of stale nodes
+            self.cursor.execute(
+                """
+                create index if not exists Node_last_seen
+                    on Node (last_seen);
+                """
+            )
+            
+            self.cursor.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
             if self.debug:
                 print("Tables created")
 
@@ -105,7 +299,7 @@ class DB_manager(metaclass=utils.SingletonMeta):
         try:
             self.conn.execute("BEGIN")
             
-            tables_to_clear = ["Node", "File", "Node_has_Block", "Block"]
+            tables_to_clear = ["Node", "File", "Node_has_Block", "Block", "Block_range", "Snapshot"]
             
             for table in tables_to_clear:
                 self.cursor.execute(
@@ -120,13 +314,15 @@ class DB_manager(metaclass=utils.SingletonMeta):
                 print("[clear_tables] Error: ", e)
             self.conn.rollback()
             
+    @serialized_write
     def delete_node(self, host_name):
         try:
             self.conn.execute("BEGIN")
+            self.delete_snapshot_marker()
             
             self.cursor.execute(
                 """
-                DELETE FROM Node_has_Block
+                DELETE FROM Block_range
                 WHERE Node_host_name = (?)
                 """,
                 (host_name,)
@@ -145,101 +341,464 @@ class DB_manager(metaclass=utils.SingletonMeta):
         except Error as e:
             if self.debug:
                 print("[delete_node] Error: ", e)
-            self.conn.rollback()
+            self.rollback()
             return utils.status.SERVER_ERROR.value
         
+    @serialized_write
+    def delete_nodes(self, host_names):
+        """
+        Deletes many nodes (and their blocks) in one transaction
+        """
+        try:
+            self.conn.execute("BEGIN")
+            self.delete_snapshot_marker()
+            
+            self.cursor.executemany(
+                """
+                DELETE FROM Block_range
+                WHERE Node_host_name = (?)
+                """,
+                ((host_name,) for host_name in host_names)
+            )
+            
+            self.cursor.executemany(
+                """
+                DELETE FROM Node
+                WHERE host_name = (?)
+                """,
+                ((host_name,) for host_name in host_names)
+            )
+            
+            self.conn.commit()
+            return utils.status.SUCCESS.value
+        except Error as e:
+            if self.debug:
+                print("[delete_nodes] Error: ", e)
+            self.rollback()
+            return utils.status.SERVER_ERROR.value
+        
+    @serialized_write
+    def expire_nodes(self, seen_before):
+        """
+        Deletes the nodes (and their blocks) that were not seen since a given time; returns their host names
+        """
+        try:
+            self.conn.execute("BEGIN")
+            self.delete_snapshot_marker()
+            
+            self.cursor.execute(self.expire_nodes_query, (seen_before,))
+            host_names = [row[0] for row in self.cursor.fetchall()]
+            
+            self.cursor.execute(
+                """
+                DELETE FROM Block_range
+                WHERE Node_host_name IN (SELECT host_name FROM Node WHERE last_seen < (?))
+                """,
+                (seen_before,)
+            )
+            
+            self.cursor.execute(
+                """
+                DELETE FROM Node
+                WHERE last_seen < (?)
+                """,
+                (seen_before,)
+            )
+            
+            self.conn.commit()
+            return host_names, utils.status.SUCCESS.value
+        except Error as e:
+            if self.debug:
+                print("[expire_nodes] Error: ", e)
+            self.rollback()
+            return [], utils.status.SERVER_ERROR.value
+        
+    """
+    Snapshot marker
+    """
+    
+    def get_snapshot_marker(self):
+        row = self.conn.execute("SELECT id FROM Snapshot").fetchone()
+        return row[0] if row else None
+    
+    @serialized_write
+    def mark_snapshot(self, snapshot_id):
+        """
+        Records the id of a snapshot of the current data (written while no update is running)
+        """
+        try:
+            self.conn.execute("BEGIN")
+            self.cursor.execute("DELETE FROM Snapshot")
+            self.cursor.execute("INSERT INTO Snapshot (id) VALUES (?)", (snapshot_id,))
+            self.conn.commit()
+            self.snapshot_id = snapshot_id
+            return utils.status.SUCCESS.value
+        except Error as e:
+            if self.debug:
+                print("[mark_snapshot] Error: ", e)
+            self.rollback()
+            return utils.status.SERVER_ERROR.value
+        
+    @serialized_write
+    def clear_snapshot_marker(self):
+        try:
+            self.conn.execute("BEGIN")
+            self.delete_snapshot_marker()
+            self.conn.commit()
+            return utils.status.SUCCESS.value
+        except Error as e:
+            if self.debug:
+                print("[clear_snapshot_marker] Error: ", e)
+            self.rollback()
+            return utils.status.SERVER_ERROR.value
+        
+    def delete_snapshot_marker(self):  # in a write transaction changing nodes, files or block ranges
+        if self.snapshot_id is not None:
+            self.cursor.execute("DELETE FROM Snapshot")
+            self.snapshot_id = None
+            
+    def rollback(self):
+        self.conn.rollback()
+        # a marker deleted by the transaction is back
+        self.snapshot_id = self.get_snapshot_marker()
+        
     """
     Inserting data
     """
+    
+    def insert_node(self, host_name):
+        self.cursor.execute(
+            """
+            INSERT INTO Node (host_name, last_seen) VALUES (?, ?)
+            ON CONFLICT (host_name) DO UPDATE SET last_seen = excluded.last_seen
+            """,
+            (host_name, time.time())
+        )
+        
+    @serialized_write
+    def touch_node(self, host_name):
+        """
+        Marks a known node as seen, so its blocks stored before a restart are kept
+        """
+        try:
+            self.conn.execute("BEGIN")
             
-    def insert_block_data(self, host_name, size, number, division_size, is_last, file_hash):
-                
-        insert_block_query = """
-            INSERT OR IGNORE INTO Block (size, number, division_size, is_last, File_hash) 
-            VALUES (?, ?, ?, ?, ?);
+            self.cursor.execute(
+                """
+                UPDATE Node
+                SET last_seen = (?)
+                WHERE host_name = (?)
+                """,
+                (time.time(), host_name)
+            )
+            
+            self.conn.commit()
+            return utils.status.SUCCESS.value
+        except Error as e:
+            if self.debug:
+                print("[touch_node] Error: ", e)
+            self.conn.rollback()
+            return utils.status.SERVER_ERROR.value
+            
+    def group_incoming_ranges(self, block_ranges):
+        """
+        Groups incoming intervals by (file hash, division size);
+        block_ranges: [(file_hash, division_size, sorted intervals, last_block_size)]
         """
+        incoming = {}  # (file_hash, division_size) -> (Interval_set, last block number -> size)
         
-        insert_node_has_block_query = """
-            INSERT OR IGNORE INTO Node_has_Block (Node_host_name, Block_size, Block_number, Block_division_size, Block_File_hash) 
-            VALUES (?, ?, ?, ?, ?);
+        for file_hash, division_size, intervals, last_block_size in block_ranges:
+            if len(intervals) == 0:
+                continue
+            
+            blocks, last_block_sizes = incoming.setdefault((file_hash, division_size), (Interval_set(), {}))
+            for first, last in intervals:
+                blocks.add(first, last)
+                last_block_sizes.setdefault(last, division_size)
+            last_block_sizes[intervals[-1][1]] = last_block_size
+            
+        return incoming
+    
+    def has_block_ranges(self, host_name, file_hash, division_size):
+        self.cursor.execute(
+            """
+            SELECT 1
+            FROM Block_range
+            WHERE Node_host_name = (?) AND File_hash = (?) AND division_size = (?)
+            LIMIT 1
+            """,
+            (host_name, file_hash, division_size)
+        )
+        return self.cursor.fetchone() is not None
+    
+    def load_incoming_ranges(self, incoming):
         """
-
-        self.cursor.execute(insert_block_query, (size, number, division_size, is_last, file_hash))
-        self.cursor.execute(insert_node_has_block_query, (host_name, size, number, division_size, file_hash))
+        Loads the grouped intervals into the Incoming_range temporary table
+        """
+        self.cursor.execute("DELETE FROM Incoming_range")
+        self.cursor.executemany(
+            """
+            INSERT INTO Incoming_range (File_hash, division_size, first_number, last_number)
+            VALUES (?, ?, ?, ?)
+            """,
+            (
+                (file_hash, division_size, first, last)
+                for (file_hash, division_size), (blocks, _) in incoming.items()
+                for first, last in blocks
+            )
+        )
     
+    def fetch_touching_ranges(self, host_name, margin):
+        """
+        Fetches the node's stored ranges that overlap an incoming interval (or are adjacent to it if margin is 1);
+        stored ranges don't overlap, so only the last one starting before an interval can reach into it
+        (CROSS JOIN keeps the incoming intervals as the outer loop, so each one is an index seek)
+        """
+        self.cursor.execute(
+            """
+            SELECT BR.File_hash, BR.division_size, BR.first_number, BR.last_number, BR.last_block_size
+            FROM Incoming_range AS I
+            CROSS JOIN Block_range AS BR ON BR.Node_host_name = :host_name
+                                   AND BR.File_hash = I.File_hash
+                                   AND BR.division_size = I.division_size
+                                   AND BR.first_number BETWEEN I.first_number - :margin AND I.last_number + :margin
+            UNION
+            SELECT BR.File_hash, BR.division_size, BR.first_number, BR.last_number, BR.last_block_size
+            FROM Incoming_range AS I
+            CROSS JOIN Block_range AS BR ON BR.Node_host_name = :host_name
+                                   AND BR.File_hash = I.File_hash
+                                   AND BR.division_size = I.division_size
+                                   AND BR.first_number = (
+                                        SELECT max(first_number)
+                                        FROM Block_range
+                                        WHERE Node_host_name = :host_name
+                                            AND File_hash = I.File_hash
+                                            AND division_size = I.division_size
+                                            AND first_number < I.first_number - :margin
+                                   )
+            WHERE BR.last_number >= I.first_number - :margin
+            """,
+            {"host_name": host_name, "margin": margin}
+        )
+        
+        stored = {}  # (file_hash, division_size) -> sorted [(first, last, last_block_size)]
+        for file_hash, division_size, first, last, last_block_size in sorted(self.cursor.fetchall()):
+            stored.setdefault((file_hash, division_size), []).append((first, last, last_block_size))
+            
+        self.cursor.executemany(
+            """
+            DELETE FROM Block_range
+            WHERE Node_host_name = (?) AND File_hash = (?) AND division_size = (?) AND first_number = (?)
+            """,
+            (
+                (host_name, file_hash, division_size, first)
+                for (file_hash, division_size), rows in stored.items()
+                for first, _, _ in rows
+            )
+        )
+        
+        return stored
+    
+    def insert_block_ranges(self, rows):
+        self.cursor.executemany(
+            """
+            INSERT INTO Block_range (Node_host_name, File_hash, division_size, first_number, last_number, last_block_size)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            rows
+        )
+    
+    def fetch_all_ranges(self, host_name, file_hash, division_size):
+        """
+        Fetches (and deletes) all the node's stored ranges of a file
+        """
+        self.cursor.execute(
+            """
+            SELECT first_number, last_number, last_block_size
+            FROM Block_range
+            WHERE Node_host_name = (?) AND File_hash = (?) AND division_size = (?)
+            ORDER BY first_number
+            """,
+            (host_name, file_hash, division_size)
+        )
+        rows = self.cursor.fetchall()
+        
+        self.cursor.execute(
+            """
+            DELETE FROM Block_range
+            WHERE Node_host_name = (?) AND File_hash = (?) AND division_size = (?)
+            """,
+            (host_name, file_hash, division_size)
+        )
+        
+        return rows
+    
+    def add_block_ranges(self, host_name, block_ranges, max_seeks=64):
+        """
+        Adds block intervals in bulk, merging them with the overlapping or adjacent ranges already stored;
+        block_ranges: [(file_hash, division_size, sorted intervals, last_block_size)]
+        """
+        incoming = self.group_incoming_ranges(block_ranges)
+        
+        # only files the node already has blocks of need to be merged with the stored ranges;
+        # files with many incoming intervals are rewritten whole instead of seeking every interval
+        to_merge = {}
+        stored = {}
+        for key, value in incoming.items():
+            if not self.has_block_ranges(host_name, *key):
+                continue
+            if len(value[0].starts) > max_seeks:
+                stored[key] = self.fetch_all_ranges(host_name, *key)
+            else:
+                to_merge[key] = value
+                
+        if len(to_merge) > 0:
+            self.load_incoming_ranges(to_merge)
+            stored.update(self.fetch_touching_ranges(host_name, 1))
+        
+        def merged_rows():
+            for (file_hash, division_size), (blocks, last_block_sizes) in incoming.items():
+                rows = stored.get((file_hash, division_size), ())
+                blocks.add_all((first, last) for first, last, _ in rows)
+                for _, last, last_block_size in rows:
+                    last_block_sizes.setdefault(last, last_block_size)
+                for first, last in blocks:
+                    yield host_name, file_hash, division_size, first, last, last_block_sizes.get(last, division_size)
+                    
+        self.insert_block_ranges(merged_rows())
+            
+    def remove_block_ranges(self, host_name, block_ranges):
+        """
+        Removes block intervals in bulk, splitting the stored ranges that only partially overlap them;
+        block_ranges: [(file_hash, division_size, sorted intervals, _)]
+        """
+        incoming = self.group_incoming_ranges(block_ranges)
+        self.load_incoming_ranges(incoming)
+        stored = self.fetch_touching_ranges(host_name, 0)
+        
+        def remaining_rows():
+            for (file_hash, division_size), rows in stored.items():
+                remaining = Interval_set(
+                    (first, last) for first, last, _ in rows
+                )
+                last_block_sizes = {last: last_block_size for _, last, last_block_size in rows}
+                for first, last in incoming[(file_hash, division_size)][0]:
+                    remaining.remove(first, last)
+                for first, last in remaining:
+                    yield host_name, file_hash, division_size, first, last, last_block_sizes.get(last, division_size)
+                    
+        self.insert_block_ranges(remaining_rows())
+    
+    @serialized_write
     def update_node_full_files(self, host_name, data):
         try:
             self.conn.execute("BEGIN")
+            self.delete_snapshot_marker()
             
-            self.cursor.execute(
+            self.insert_node(host_name)
+            
+            self.cursor.executemany(
                 """
-                INSERT OR IGNORE INTO Node (host_name) VALUES (?)
+                INSERT OR IGNORE INTO File (hash, name) VALUES (?, ?)
                 """, 
-                (host_name,)
+                ((file_hash, file_name) for file_hash, file_name, _ in data)
             )
             
-            for file in data:
-                file_hash, file_name, block_set_data = file
-                self.cursor.execute(
-                    """
-                    INSERT OR IGNORE INTO File (hash, name) VALUES (?, ?)
-                    """, 
-                    (file_hash, file_name)
-                )
-
-                
-                for block_set in block_set_data:
-                    block_size, last_block_size, n_blocks = block_set
-                    i = 1
-                    for i in range(1, n_blocks):
-                        self.insert_block_data(host_name, block_size, i, block_size, 0, file_hash)
-                        
-                    if n_blocks != 1:
-                        i += 1
-                        
-                    self.insert_block_data(host_name, last_block_size, i, block_size, 1, file_hash)
+            self.add_block_ranges(host_name, (
+                (file_hash, block_size, [(1, n_blocks)], last_block_size)
+                for file_hash, _, block_set_data in data
+                for block_size, last_block_size, n_blocks in block_set_data
+            ))
             
             self.conn.commit()
             return utils.status.SUCCESS.value
         except Error as e:
             if self.debug:
                 print("[update_node_full_files] Error: ", e)
-            self.conn.rollback()
+            self.rollback()
             return utils.status.SERVER_ERROR.value
         
+    @serialized_write
     def update_node_partial_files(self, host_name, data):
         try:
             self.conn.execute("BEGIN")
+            self.delete_snapshot_marker()
             
-            self.cursor.execute(
+            self.insert_node(host_name)
+            
+            self.cursor.executemany(
                 """
-                INSERT OR IGNORE INTO Node (host_name) VALUES (?)
-                """, (host_name,)
+                INSERT OR IGNORE INTO File (hash, name) VALUES (?, ?)
+                """, 
+                ((file_hash, file_name) for file_name, file_hash, _ in data)
             )
             
-            for file in data:
-                file_name, file_hash, block_set_data = file
-                self.cursor.execute(
-                    """
-                    INSERT OR IGNORE INTO File (hash, name) VALUES (?, ?)
-                    """, (file_hash, file_name)
-                )
-                
-                for block_set in block_set_data:
-                    block_size, last_block_size, blocks = block_set
-                    blocks = sorted(blocks)
-                    for block in blocks[:-1]:
-                        self.insert_block_data(host_name, block_size, block, block_size, 0, file_hash)
-                    self.insert_block_data(host_name, last_block_size, blocks[-1], block_size, 1, file_hash)
+            self.add_block_ranges(host_name, (
+                (file_hash, block_size, utils.numbers_to_intervals(blocks), last_block_size)
+                for _, file_hash, block_set_data in data
+                for block_size, last_block_size, blocks in block_set_data
+            ))
             
             self.conn.commit()
             return utils.status.SUCCESS.value
         except Error as e:
             if self.debug:
                 print("[update_node_partial_files] Error: ", e)
-            self.conn.rollback()
+            self.rollback()
+            return utils.status.SERVER_ERROR.value
+        
+    @serialized_write
+    def add_node_block_ranges(self, host_name, data):
+        # data: [(file_hash, file_name, [(division_size, last_block_size, sorted intervals)])]
+        try:
+            self.conn.execute("BEGIN")
+            self.delete_snapshot_marker()
+            
+            self.insert_node(host_name)
+            
+            self.cursor.executemany(
+                """
+                INSERT OR IGNORE INTO File (hash, name) VALUES (?, ?)
+                """, 
+                ((file_hash, file_name) for file_hash, file_name, _ in data)
+            )
+            
+            self.add_block_ranges(host_name, (
+                (file_hash, block_size, intervals, last_block_size)
+                for file_hash, _, block_set_data in data
+                for block_size, last_block_size, intervals in block_set_data
+            ))
+            
+            self.conn.commit()
+            return utils.status.SUCCESS.value
+        except Error as e:
+            if self.debug:
+                print("[add_node_block_ranges] Error: ", e)
+            self.rollback()
+            return utils.status.SERVER_ERROR.value
+        
+    @serialized_write
+    def remove_node_block_ranges(self, host_name, data):
+        # data: [(file_hash, file_name, [(division_size, last_block_size, sorted intervals)])]
+        try:
+            self.conn.execute("BEGIN")
+            self.delete_snapshot_marker()
+            
+            self.remove_block_ranges(host_name, (
+                (file_hash, block_size, intervals, last_block_size)
+                for file_hash, _, block_set_data in data
+                for block_size, last_block_size, intervals in block_set_data
+            ))
+            
+            self.conn.commit()
+            return utils.status.SUCCESS.value
+        except Error as e:
+            if self.debug:
+                print("[remove_node_block_ranges] Error: ", e)
+            self.rollback()
             return utils.status.SERVER_ERROR.value
         
+    @serialized_write
     def update_node_status(self, host_name, status):
         try:
             self.conn.execute("BEGIN")
@@ -266,19 +825,14 @@ class DB_manager(metaclass=utils.SingletonMeta):
         
     def get_node_status(self, host_name):
         try:
-            self.conn.execute("BEGIN")
-            
-            self.cursor.execute(
-                """
-                SELECT status
-                FROM Node
-                WHERE host_name = (?)
-                """, (host_name,)
-            )
-            
-            result = self.cursor.fetchall()
-            
-            self.conn.commit()
+            with self.read_connection() as conn:
+                result = conn.execute(
+                    """
+                    SELECT status
+                    FROM Node
+                    WHERE host_name = (?)
+                    """, (host_name,)
+                ).fetchall()
             
             if result is None or len(result) == 0:
                 return None, utils.status.NOT_FOUND.value
@@ -286,54 +840,66 @@ class DB_manager(metaclass=utils.SingletonMeta):
             return result[0][0], utils.status.SUCCESS.value
         except Error as e:
             if self.debug:
-                print("[update_node_partial_files] Error: ", e)
-            self.conn.rollback()
+                print("[get_node_status] Error: ", e)
             return None, utils.status.SERVER_ERROR.value
             
     def locate_file_hash(self, file_hash, host_name):
         try:
-            self.conn.execute("BEGIN")
-                        
-            query = """
-                SELECT NB.Node_host_name, B.size, B.number, B.division_size, B.is_last
-                FROM Node_has_Block AS NB
-                JOIN Block AS B ON NB.Block_size = B.size
-                                AND NB.Block_number = B.number
-                                AND NB.Block_division_size = B.division_size
-                                AND NB.Block_File_hash = B.File_hash
-                WHERE B.File_hash = (?) AND NB.Node_host_name != (?)
-                ORDER BY NB.Node_host_name, B.division_size desc, B.number asc;
-            """
-            
-            self.cursor.execute(query, (file_hash, host_name))
-            results = self.cursor.fetchall()
+            with self.read_connection() as conn:
+                results = conn.execute(self.locate_file_hash_query, (file_hash, host_name)).fetchall()
                 
-            self.conn.commit()
             return results, utils.status.SUCCESS.value
         except Error as e:
             if self.debug:
                 print("[locate_file] Error: ", e)
-            self.conn.rollback()
             return None, utils.status.SERVER_ERROR.value
         
     def locate_file_name(self, file_name, host_name):
         try:
-            self.conn.execute("BEGIN")
-                        
-            query = """
-                SELECT distinct NB.Block_File_hash, NB.Node_host_name
-                    FROM Node_has_Block AS NB
-                    JOIN File AS F ON NB.Block_File_hash = F.hash
-                    WHERE F.name = (?) AND NB.Node_host_name != (?);
-            """
-                        
-            self.cursor.execute(query, (file_name, host_name))
-            results = self.cursor.fetchall()
+            with self.read_connection() as conn:
+                results = conn.execute(self.locate_file_name_query, (file_name, host_name)).fetchall()
                             
-            self.conn.commit()
             return results, utils.status.SUCCESS.value
         except Error as e:
             if self.debug:
                 print("[locate_file] Error: ", e)
-            self.conn.rollback()
+            return None, utils.status.SERVER_ERROR.value
+        
+    def get_block_ranges(self, consume, batch_size=64*1024):
+        """
+        Passes the block ranges to consume in batches, so the whole table is never held in memory;
+        returns the number of ranges
+        """
+        try:
+            n_rows = 0
+            with self.read_connection() as conn:
+                cursor = conn.execute(
+                    """
+                    SELECT Node_host_name, File_hash, division_size, first_number, last_number, last_block_size
+                    FROM Block_range
+                    ORDER BY Node_host_name, File_hash, division_size, first_number
+                    """
+                )
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    consume(rows)
+                    n_rows += len(rows)
+            
+            return n_rows, utils.status.SUCCESS.value
+        except Error as e:
+            if self.debug:
+                print("[get_block_ranges] Error: ", e)
+            return 0, utils.status.SERVER_ERROR.value
+        
+    def get_files(self):
+        try:
+            with self.read_connection() as conn:
+                results = conn.execute("SELECT hash, name FROM File").fetchall()
+            
+            return results, utils.status.SUCCESS.value
+        except Error as e:
+            if self.debug:
+                print("[get_files] Error: ", e)
             return None, utils.status.SERVER_ERROR.value
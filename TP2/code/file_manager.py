@@ -158,6 +158,11 @@ class File_manager(metaclass=SingletonMeta):
         
         return file.hash_id
     
+    def set_file_hash(self, file_name, file_hash):  # hash of a file whose blocks were downloaded
+        file = self.files.get(file_name)
+        if file is not None and file.hash_id is None:
+            file.hash_id = file_hash
+    
     def get_file_name_by_hash(self, file_hash):
         for file in self.files.values():
             if file.hash_id == file_hash:
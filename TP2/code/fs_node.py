@@ -1,47 +1,62 @@
 import socket
 import threading
-import struct
 from file_manager import File_manager
 import argparse
-from utils import action, status, action_udp, Queue_dictionary, join_blocks
+from utils import action, status, action_udp, search_mode, Queue_dictionary, join_blocks, Socket_reader, Interval_set, numbers_to_intervals, Rtt_estimator, Congestion_controller
+import codec
 import traceback
 from queue import Queue
+from concurrent.futures import Future
 import time
         
         
+MAX_UDP_RECEIVER_WINDOW = 8 * codec.MAX_SACK_BITMAP  # datagrams past the ack a selective ack can list
+
+
 class UDP_receiver_connection:
-    def __init__(self, host, port, start_seq_num, file_name, division_size, file_manager, debug=False, buffer_size=4):
+    def __init__(self, host, port, start_seq_num, file_name, division_size, file_manager, debug=False, buffer_size=4, ends_file=False):
         self.host = host
         self.port = port
         self.current_seq_num = start_seq_num - 1
         self.debug = debug
         self.buffer_size = buffer_size
-        self.seq_nums = set()
         self.updated = time.time()
         self.file_name = file_name
         self.division_size = division_size
         self.file_manager = file_manager
-        
-    def ack(self, seq_num, block_number, is_last, data):
+        self.end_seq_num = None  # sequence number of the last datagram, once it arrived
+        self.ends_file = ends_file  # the last datagram carries the last block of the file (GET_FULL_FILE transfers)
+        self.reported = False  # the end of the transfer was put in the response queue
+        self.buffer = {}  # sequence number -> (block number, is last, data) of the datagrams that came before a missing one
+        
+    def ack(self, seq_num, block_number, data, end=False):
+        """
+        Saves the blocks of the datagrams arriving in order and keeps the ones arriving after a missing datagram
+        (up to buffer_size sequence numbers past the last one saved) until it arrives; end marks the last datagram.
+        Returns the next sequence number expected (a cumulative ack) and the sequence numbers kept after it
+        """
         self.updated = time.time()
         
-        if seq_num > self.current_seq_num and seq_num <= self.current_seq_num + self.buffer_size:
-            self.seq_nums.add(seq_num)
-            keys = sorted(self.seq_nums)
-            for n in keys:
-                if n == self.current_seq_num + 1:
-                    self.current_seq_num += 1  
-                    self.file_manager.save_block(self.file_name, self.division_size, block_number, is_last, data)
-                    self.seq_nums.remove(n)
-                else:
-                    break  # out of order seq_num
+        is_last = end and self.ends_file
+        if end:
+            self.end_seq_num = seq_num
+            
+        if seq_num == self.current_seq_num + 1:
+            self.current_seq_num += 1
+            self.file_manager.save_block(self.file_name, self.division_size, block_number, is_last, data)
+            
+            while self.current_seq_num + 1 in self.buffer:
+                self.current_seq_num += 1
+                block_number, is_last, data = self.buffer.pop(self.current_seq_num)
+                self.file_manager.save_block(self.file_name, self.division_size, block_number, is_last, data)
                 
-        return self.current_seq_num + 1
+        elif self.current_seq_num + 1 < seq_num <= self.current_seq_num + self.buffer_size:
+            self.buffer[seq_num] = (block_number, is_last, data)
+                
+        return self.current_seq_num + 1, sorted(self.buffer)
     
-    def reset(self, start_seq_num):
-        self.current_seq_num = start_seq_num - 1
-        self.seq_nums.clear()
-        self.updated = time.time()
+    def finished(self):
+        return self.end_seq_num is not None and self.current_seq_num >= self.end_seq_num
     
 
 class FS_Node:
@@ -58,12 +73,17 @@ class FS_Node:
         udp_host="",
         udp_port=9090,
         udp_max_buffer_size=1400,
-        udp_receiver_window_size=4,
+        udp_receiver_window_size=64,
         udp_receiver_connection_timeout=5,
-        udp_ack_timeout=0.4
+        udp_ack_timeout=0.4,
+        udp_window_size=32,
+        udp_congestion_control=True,
+        udp_pacing=False,
+        heartbeat_interval=2
     ):
         # TCP   
         self.socket = None
+        self.reader = None
         self.dir = dir
         self.server_address = server_address
         self.port = port
@@ -73,9 +93,27 @@ class FS_Node:
         self.callback = callback
         self.done = False
         self.timeout = timeout
-        self.response_queue = Queue()
         self.udp_response_queue = Queue()
         
+        # requests sent to the tracker and not answered yet: counter -> future of the response;
+        # the tracker numbers the requests of the connection in the order they arrive
+        self.pending_requests = {}
+        self.counter = 0
+        self.send_lock = threading.Lock()
+        
+        # blocks announced to the tracker: (file_hash, division_size) -> Interval_set of block numbers;
+        # the changes count as announced once sent (a later announcement doesn't send them again) and are undone
+        # if the tracker rejects them; the heartbeat, controller and receiving threads all use it under announce_lock
+        self.announced = {}
+        self.announced_generation = 0  # incremented when announced is replaced, older announcements are not undone
+        self.announce_lock = threading.Lock()
+        
+        # heartbeats keep the node in the tracker's locate results (0 disables them)
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_thread = threading.Thread(target=self.run_heartbeats, daemon=True)
+        self.heartbeat_stopped = threading.Event()
+        self.evicted = False
+        
         # UDP
         self.udp_max_buffer_size = udp_max_buffer_size
         self.udp_timeout = udp_timeout
@@ -83,12 +121,18 @@ class FS_Node:
         self.udp_host = udp_host
         self.udp_port = udp_port
         self.udp_thread = threading.Thread(target=self.run_udp_receiver)
-        self.udp_ack_timeout = udp_ack_timeout
+        self.udp_ack_timeout = udp_ack_timeout  # retransmission timeout until a peer's round trip time is measured
+        self.udp_window_size = udp_window_size  # datagrams a sender keeps unacknowledged
+        self.udp_congestion_control = udp_congestion_control  # the window shrinks on losses when set
+        self.udp_pacing = udp_pacing  # spaces the datagrams of a window over a round trip (with congestion control)
+        self.udp_rtt_estimators = {}  # peer address -> Rtt_estimator, kept between transfers
         
-        self.udp_receiver_window_size = udp_receiver_window_size
+        # datagrams kept ahead of a missing one, sent in the GET requests; the acks can only list MAX_UDP_RECEIVER_WINDOW of them
+        self.udp_receiver_window_size = min(max(udp_receiver_window_size, 1), MAX_UDP_RECEIVER_WINDOW)
         
         self.udp_ack_queue = Queue_dictionary() # receives acks from other nodes' get requests
         self.udp_receiver_connections = {}  # sends acks upon received data
+        self.udp_full_file_requests = set()  # peers last asked for a whole file, whose last datagram has the last block
         self.udp_threads = {}  # sends data according to other nodes' get requests
         
         self.udp_last_receiver_connections_cleanup = time.time()
@@ -115,7 +159,7 @@ class FS_Node:
                 if self.done or not bytes_read:
                     break        
                 
-                decoded_flag = struct.unpack("!B", bytes_read[0:1])[0]  
+                decoded_flag = bytes_read[0]
                 
                 if self.debug and decoded_flag != action_udp.ACK.value:
                     print(" >>> Received UDP packet from %s:%d with flag %s" % (address[0], address[1], action_udp(decoded_flag).name))                      
@@ -126,15 +170,19 @@ class FS_Node:
                     action_udp.GET_FULL_FILE.value: self.udp_get_full_file_flag_handler,
                     action_udp.GET_PARTIAL_FILE.value: self.udp_get_partial_file_flag_handler,
                     action_udp.START_DATA.value: self.udp_start_data_flag_handler,
-                    action_udp.START_END_DATA.value: self.udp_start_data_flag_handler,
+                    action_udp.START_END_DATA.value: self.udp_start_end_data_flag_handler,
                     action_udp.DATA.value: self.udp_data_flag_handler,
                     action_udp.END_DATA.value: self.udp_end_data_flag_handler,
                 }
 
-                decoded_flag = bytes_read[0]
-
                 if decoded_flag in udp_action_handlers:
-                    udp_action_handlers[decoded_flag](bytes_read, address)
+                    try:
+                        udp_action_handlers[decoded_flag](bytes_read, address)
+                    except Exception as e:
+                        # a malformed datagram (or one the handler fails on) is dropped, the next ones are still received
+                        if self.debug:
+                            print("[run_udp_receiver] Datagram from %s:%d dropped: %s" % (address[0], address[1], e))
+                            traceback.print_exc()
                 else:
                     if self.debug:
                         print(" >>> Invalid action received")
@@ -154,23 +202,24 @@ class FS_Node:
     """
     
     def udp_ack_flag_handler(self, bytes_read, address):
-        ack_num = struct.unpack("!H", bytes_read[1:3])[0]
+        ack_num, sacked = codec.decode_udp_ack(bytes_read)
         if self.debug:
-            print(" >>> Received ack with ack_num %d" % (ack_num))
-        self.udp_ack_queue.put(address, ack_num)
+            print(" >>> Received ack with ack_num %d, sacked %s" % (ack_num, sacked))
+        self.udp_ack_queue.put(address, (ack_num, sacked))
         
     def udp_get_full_file_flag_handler(self, bytes_read, address):
-        packet = self.decode_udp_get_full_file(bytes_read[1:])
+        packet = self.decode_udp_get_full_file(bytes_read)
         if self.debug:
             print(" >>> Packet: ", packet)
         
-        file_hash, division_size = packet
+        file_hash, division_size, window = packet
         
-        block_numbers = self.file_manager.get_all_block_numbers(file_hash, division_size)
+        # in order, so that the last datagram (END_DATA) carries the last block of the file
+        block_numbers = sorted(self.file_manager.get_all_block_numbers(file_hash, division_size))
         
         thread = threading.Thread(
             target=self.send_udp_blocks, 
-            args=(address, file_hash, division_size, block_numbers)
+            args=(address, file_hash, division_size, block_numbers, window)
         )
         
         with self.lock:
@@ -183,17 +232,17 @@ class FS_Node:
                 thread.start()
                 
     def udp_get_partial_file_flag_handler(self, bytes_read, address):
-        packet = self.decode_udp_get_partial_file(bytes_read[1:])
+        packet = self.decode_udp_get_partial_file(bytes_read)
         if self.debug:
             print(" >>> Packet: ", packet)
         
-        file_hash, division_size, sequences, blocks = packet
+        file_hash, division_size, sequences, blocks, window = packet
         
         block_numbers = join_blocks(sequences, blocks)
         
         thread = threading.Thread(
             target=self.send_udp_blocks,
-            args=(address, file_hash, division_size, block_numbers)
+            args=(address, file_hash, division_size, block_numbers, window)
         )
         
         with self.lock:
@@ -206,302 +255,340 @@ class FS_Node:
                 thread.start()
                 
     def udp_start_data_flag_handler(self, bytes_read, address):
-        packet = self.decode_udp_start_data_message(bytes_read[1:])
+        packet = self.decode_udp_start_data_message(bytes_read)
         if self.debug:
             print(" >>> Received packet: ", packet[:-1])
         self.handle_udp_start_data(address, packet)
         
     def udp_start_end_data_flag_handler(self, bytes_read, address):
-        _, file_name, div_size, block_number, data = self.decode_udp_start_data_message(bytes_read[1:])
+        packet = self.decode_udp_start_data_message(bytes_read)
         if self.debug:
-            print(" >>> Received packet: ", (file_name, div_size, block_number))
-        self.file_manager.save_block(file_name, div_size, block_number, True, data)
+            print(" >>> Received packet: ", packet[:-1])
+        self.handle_udp_start_data(address, packet, end=True)
         
     def udp_data_flag_handler(self, bytes_read, address):
-        packet = self.decode_udp_data_message(bytes_read[1:])
+        packet = self.decode_udp_data_message(bytes_read)
         if self.debug:
             print(" >>> Received packet: ", packet[:-1])
         self.handle_udp_data(address, packet)
         
     def udp_end_data_flag_handler(self, bytes_read, address):
-        self.udp_data_flag_handler(bytes_read, address)
-        
-        with self.lock:
-            file_name = None
-            if address in self.udp_receiver_connections:
-                file_name = self.udp_receiver_connections[address].file_name
-            self.udp_response_queue.put((address, file_name, status.SUCCESS.value))
+        packet = self.decode_udp_data_message(bytes_read)
+        if self.debug:
+            print(" >>> Received packet: ", packet[:-1])
+        self.handle_udp_data(address, packet, end=True)
             
     """
     Send blocks
     """
             
-    def send_udp_blocks(self, address, file_hash, division_size, block_numbers):
+    def send_udp_blocks(self, address, file_hash, division_size, block_numbers, receiver_window=None):
+        """
+        Sends the blocks keeping up to udp_window_size datagrams in flight, fewer while the congestion window is smaller
+        and no more than the receiver keeps ahead of a missing datagram (receiver_window, sent in its request).
+        The receiver acks the next sequence number it expects (so an ack above the window base acknowledges every
+        datagram before it) and lists the datagrams it holds after it (selective acks).
+        A datagram with duplicate_acks_threshold datagrams selectively acked after it was lost and is the only one sent
+        again. The oldest datagram not acknowledged within the peer's retransmission timeout (or, if the receiver didn't
+        send its window, three duplicate acks) make the sender go back to the oldest unacknowledged datagram, skipping
+        those the receiver holds
+        """
+        max_timeout_retries = 8
+        duplicate_acks_threshold = 3
+        max_window = self.udp_window_size if receiver_window is None else max(min(self.udp_window_size, receiver_window), 1)
+        rtt = self.udp_rtt_estimator(address)
+        congestion = Congestion_controller(max_window) if self.udp_congestion_control else None
+        n_packets = len(block_numbers)
+        packets = {}  # sequence number -> datagram, until acknowledged
+        sent_at = {}  # sequence number -> time sent, for the datagrams sent only once (Karn's rule)
+        base = 1  # oldest unacknowledged sequence number
+        seq_num = 1  # next sequence number to send in order
+        highest_sent = 0
+        sacked = set()  # sequence numbers past the base the receiver holds
+        lost = []  # sequence numbers to send again before any other, in order
+        resent = set()  # lost sequence numbers sent again since the last timeout
+        recover = 0  # the losses among the datagrams sent before the last one detected belong to the same episode
+        duplicate_acks = 0
+        timeouts = 0
+        next_send = 0  # with pacing, no datagram leaves before then
         
-        seq_num = 1
-        is_last = False
         with self.lock:
             self.udp_ack_queue.init(address)
+            
+        while self.udp_ack_queue.get(address, 0) is not None:  # acks left by an earlier transfer to this address
+            pass
+        
+        deadline = time.monotonic() + rtt.rto
+        
+        while base <= n_packets and not self.done:
+            window = congestion.window() if congestion else max_window
+            
+            while True:
+                in_flight = seq_num - base - len(lost) - sum(1 for n in sacked if n < seq_num)
+                now = time.monotonic()
+                if in_flight >= window or now < next_send:
+                    break
+                
+                if lost:
+                    n = lost.pop(0)
+                    resent.add(n)
+                else:
+                    while seq_num in sacked:  # after going back, the receiver already holds these
+                        seq_num += 1
+                    if seq_num > n_packets or seq_num >= base + max_window:  # past what the receiver can keep
+                        break
+                    n = seq_num
+                    seq_num += 1
+                
+                packet = packets.get(n)
+                if packet is None:
+                    block_number = block_numbers[n - 1]
+                    file_name, data = self.file_manager.get_block_with_file_hash(file_hash, division_size, block_number)
+                    packet = packets[n] = self.encode_udp_block(n, n == n_packets, file_name, division_size, block_number, data)
+                
+                if self.debug:
+                    print(" >>> Sending packet: ", (n, block_numbers[n - 1], n == n_packets))
                     
-        while not is_last:
-
-            max_timeout_retries = 5
-            block_number = block_numbers.pop(0)
-            file_name, data = self.file_manager.get_block_with_file_hash(file_hash, division_size, block_number)
+                self.udp_socket.sendto(packet, address)
+                if n > highest_sent:
+                    highest_sent = n
+                    sent_at[n] = now
+                
+                if self.udp_pacing and congestion and rtt.srtt is not None:
+                    # spreads the window over a round trip instead of sending it in one burst
+                    next_send = max(next_send, now) + rtt.srtt / window
+                
+            wake_up = deadline
+            if next_send > time.monotonic():
+                wake_up = min(deadline, next_send)
+            ack = self.udp_ack_queue.get(address, max(wake_up - time.monotonic(), 0))
             
-            if len(block_numbers) == 0:
-                is_last = True
+            if ack is None:
+                if time.monotonic() < deadline:  # the next paced datagram may leave
+                    continue
                 
-            packet = None
-            if seq_num == 1 and is_last:
-                packet = self.encode_udp_start_data_message(
-                    action_udp.START_END_DATA.value, seq_num, file_name, division_size, block_number,data
-                )
-            elif seq_num == 1:
-                packet = self.encode_udp_start_data_message(
-                    action_udp.START_DATA.value, seq_num, file_name, division_size, block_number, data
-                )
-            elif is_last:
-                packet = self.encode_udp_data_message(
-                    action_udp.END_DATA.value, seq_num, block_number, data
-                )
-            else:
-                packet = self.encode_udp_data_message(
-                    action_udp.DATA.value, seq_num, block_number, data
-                )
+                timeouts += 1
+                if timeouts > max_timeout_retries:
+                    if self.debug:
+                        print(" >>> Gave up sending to %s:%d (%d of %d packets acknowledged)" % (address[0], address[1], base - 1, n_packets))
+                    break
                 
-            if self.debug:
-                print(" >>> Sending packet: ", (seq_num, block_number, is_last))
+                rtt.backoff()
+                if congestion:
+                    congestion.on_timeout(highest_sent - base + 1 - len(sacked))
+                if self.debug:
+                    print(" >>> (timeout) Resending from packet %d, rto %.3f s" % (base, rtt.rto))
                 
-            self.udp_socket.sendto(packet, address)
+                recover = highest_sent
+                seq_num = base
+                lost = []
+                resent.clear()
+                duplicate_acks = 0
+                next_send = 0
+                sent_at.clear()  # an ack of a datagram sent twice can't tell which copy arrived
+                deadline = time.monotonic() + rtt.rto
+                continue
             
-            expected_ack = seq_num + 1
+            received_ack, received_sacked = ack
             
-            while max_timeout_retries:
-                received_ack = self.udp_ack_queue.get(address, self.udp_ack_timeout)
+            if received_ack > base:
+                received_ack = min(received_ack, highest_sent + 1)
+                now = time.monotonic()
                 
-                if received_ack is not None:
+                # the receiver acks as soon as a datagram arrives, so the ack measures the last datagram it covers
+                if received_ack - 1 in sent_at:
+                    rtt.sample(now - sent_at[received_ack - 1])
+                if congestion:
+                    congestion.on_ack(received_ack - base - sum(1 for n in sacked if n < received_ack))
                     
-                    if received_ack == expected_ack:  # last seq num sent
-                        if self.debug:
-                            print(" >>> [ received %d == expected %d ]" % (received_ack, expected_ack))
-                        break
-                    elif received_ack > expected_ack:  # node already received the packet
-                        if self.debug:
-                            print(" >>> [ (out of order) received %d > expected %d ]" % (received_ack, expected_ack))
-                    elif received_ack < expected_ack:  # duplicated packet probably => ignore
-                        if self.debug:
-                            print(" >>> [ (probably duplicated) received %d < expected %d ]" % (received_ack, expected_ack))
-                        continue
-
-                else:
+                if self.debug:
+                    print(" >>> [ received ack %d, window base was %d, rto %.3f s ]" % (received_ack, base, rtt.rto))
                     
+                for n in range(base, received_ack):
+                    del packets[n]
+                    sent_at.pop(n, None)
+                    sacked.discard(n)
+                    resent.discard(n)
+                lost = [n for n in lost if n >= received_ack]
+                base = received_ack
+                seq_num = max(seq_num, base)  # after going back, the ack may cover datagrams not sent again yet
+                duplicate_acks = 0
+                timeouts = 0
+                deadline = now + rtt.rto
+                
+            elif received_ack == base:  # a datagram after the base arrived before it
+                duplicate_acks += 1
+                
+            newly_sacked = [n for n in received_sacked if base < n <= highest_sent and n not in sacked]
+            if newly_sacked:
+                if congestion:
+                    congestion.on_ack(len(newly_sacked))
+                sacked.update(newly_sacked)
+                
+            if sacked:
+                # a datagram is lost once enough datagrams sent after it arrived
+                holes = sorted(sacked)
+                newly_lost = [
+                    n for n in range(base, holes[-duplicate_acks_threshold] if len(holes) >= duplicate_acks_threshold else base)
+                    if n not in sacked and n not in resent and n not in lost and n < seq_num
+                ]
+                if newly_lost:
+                    if base > recover:
+                        if congestion:
+                            congestion.on_loss(highest_sent - base + 1 - len(sacked))
+                        recover = highest_sent
                     if self.debug:
-                        print(" >>> (timeout) Resending packet: ", (seq_num, block_number, is_last))
+                        print(" >>> (selective acks) Resending packets %s" % (newly_lost))
+                        
+                    for n in newly_lost:
+                        sent_at.pop(n, None)
+                    lost = sorted(lost + newly_lost)
                     
-                    max_timeout_retries -= 1
+            elif duplicate_acks == duplicate_acks_threshold and base > recover and receiver_window is None:
+                # a receiver that didn't send its window may drop what comes after a missing datagram; one that did
+                # keeps everything the sender may send, so its duplicate acks without selective acks only mean duplicates
+                if congestion:
+                    congestion.on_loss(highest_sent - base + 1)
+                if self.debug:
+                    print(" >>> (duplicate acks) Resending from packet %d" % (base))
                     
-                    self.udp_socket.sendto(packet, address)
-            
-            seq_num += 1
+                recover = highest_sent
+                seq_num = base
+                lost = []
+                sent_at.clear()
+                deadline = time.monotonic() + rtt.rto
             
         with self.lock:
             self.udp_threads.pop(address)
+            
+    def udp_rtt_estimator(self, address):
+        with self.lock:
+            rtt = self.udp_rtt_estimators.get(address)
+            if rtt is None:
+                # the largest timeout (4 s) stays below the receivers' connection timeout (5 s by default):
+                # a receiver forgets a transfer idle for longer and stops acking it
+                rtt = self.udp_rtt_estimators[address] = Rtt_estimator(self.udp_ack_timeout)
+            return rtt
+        
+    def udp_rtt_stats(self):
+        """
+        Round trip time estimates and retransmission timeouts of the peers blocks were sent to
+        """
+        with self.lock:
+            return {"%s:%d" % address: rtt.stats() for address, rtt in self.udp_rtt_estimators.items()}
+            
+    def encode_udp_block(self, seq_num, is_last, file_name, division_size, block_number, data):
+        # the first datagram of a transfer carries the file name, the last one ends it
+        if seq_num == 1:
+            flag = action_udp.START_END_DATA if is_last else action_udp.START_DATA
+            return self.encode_udp_start_data_message(flag.value, seq_num, file_name, division_size, block_number, data)
+        
+        flag = action_udp.END_DATA if is_last else action_udp.DATA
+        return self.encode_udp_data_message(flag.value, seq_num, block_number, data)
     
     """
     UDP handle functions
     """
     
-    def handle_udp_start_data(self, address, packet):
+    def handle_udp_start_data(self, address, packet, end=False):
         seq_num, file_name, division_size, block_number, data = packet
-        if address not in self.udp_receiver_connections:
-            self.udp_receiver_connections[address] = UDP_receiver_connection(
-                address[0],
-                address[1],
-                seq_num,
-                file_name,
-                division_size,
-                self.file_manager,
-                buffer_size=self.udp_receiver_window_size,
-                debug=self.debug
-            )      
-            if self.debug:
-                print(" >>> Created new UDP receiver connection with address %s:%d" % (address[0], address[1]))
-        else:
-            conn = self.udp_receiver_connections[address]
-            conn.reset(seq_num)
+        with self.lock:  # the controller forgets the connections when it sends a GET
+            if address not in self.udp_receiver_connections:
+                self.udp_receiver_connections[address] = UDP_receiver_connection(
+                    address[0],
+                    address[1],
+                    seq_num,
+                    file_name,
+                    division_size,
+                    self.file_manager,
+                    buffer_size=self.udp_receiver_window_size,
+                    debug=self.debug,
+                    ends_file=address in self.udp_full_file_requests
+                )      
+                if self.debug:
+                    print(" >>> Created new UDP receiver connection with address %s:%d" % (address[0], address[1]))
+            # otherwise the START_DATA was sent again: the GET that starts a new transfer forgot the last one,
+            # and resetting would drop the datagrams kept after a missing one, which the sender won't send again
         
-        self.handle_udp_data(address, (seq_num, block_number, data))
+        self.handle_udp_data(address, (seq_num, block_number, data), end=end)
 
-    def handle_udp_data(self, address, packet, is_last=False):
+    def handle_udp_data(self, address, packet, end=False):
         seq_num, block_number, data = packet
         
-        if address in self.udp_receiver_connections:
-            conn = self.udp_receiver_connections[address]
-            ack_num = conn.ack(seq_num, block_number, is_last, data)            
-            self.send_udp_ack(address, ack_num)
+        conn = self.udp_receiver_connections.get(address)
+        if conn is None:
+            return
+        
+        ack_num, sacked = conn.ack(seq_num, block_number, data, end=end)
+        self.send_udp_ack(address, ack_num, sacked)
+        
+        # the transfer ends once every datagram up to the last one arrived, whatever order they came in
+        if conn.finished() and not conn.reported:
+            conn.reported = True
+            self.udp_response_queue.put((address, conn.file_name, status.SUCCESS.value))
+            
     """
     UDP decode functions
     """
     
-    def decode_udp_get_full_file(self, bytes_read):
-        
-        start = 0; end = 1
-        hash_len = struct.unpack("!B", bytes_read[start:end])[0]
-        
-        start = end; end += hash_len
-        file_hash = bytes_read[start:end].hex()
-        
-        start = end; end += 2
-        division_size = struct.unpack("!H", bytes_read[start:end])[0]
-        
-        return file_hash, division_size
+    def decode_udp_get_full_file(self, bytes_read):  # bytes_read is the whole datagram
+        return codec.decode_udp_get_full_file_request(bytes_read)
     
     def decode_udp_get_partial_file(self, bytes_read):
-                
-        start = 0; end = 1
-        hash_len = struct.unpack("!B", bytes_read[start:end])[0]
-                
-        start = end; end += hash_len
-        file_hash = bytes_read[start:end].hex()
-                
-        start = end; end += 2
-        division_size = struct.unpack("!H", bytes_read[start:end])[0]
-        
-        start = end; end += 1
-        n_seq = struct.unpack("!B", bytes_read[start:end])[0]
-        sequences = []
-        for _ in range(n_seq):
-            start = end; end += 4
-            first, last = struct.unpack("!HH", bytes_read[start:end])
-            sequences.append((first, last))
-            
-        start = end; end += 2
-        n_blocks = struct.unpack("!H", bytes_read[start:end])[0]
-        blocks = []
-        for _ in range(n_blocks):
-            start = end; end += 2
-            block_number = struct.unpack("!H", bytes_read[start:end])[0]
-            blocks.append(block_number)
-        
-        return file_hash, division_size, sequences, blocks
+        return codec.decode_udp_get_partial_file_request(bytes_read)
     
     def decode_udp_start_data_message(self, bytes_read):
-            
-        start = 0; end = 2
-        seq_num = struct.unpack("!H", bytes_read[start:end])[0]
-        
-        start = end; end += 1
-        file_name_len = struct.unpack("!B", bytes_read[start:end])[0]
-                    
-        start = end; end += file_name_len
-        file_name = bytes_read[start:end].decode("utf-8")
-        
-        start = end; end += 2
-        division_size = struct.unpack("!H", bytes_read[start:end])[0]
-        
-        start = end; end += 2
-        block_number = struct.unpack("!H", bytes_read[start:end])[0]
-        
-        start = end; end += 4
-        data_len = struct.unpack("!L", bytes_read[start:end])[0]
-        
-        start = end; end += data_len
-        data = bytes_read[start:end]
-        
-        return seq_num, file_name, division_size, block_number, data
+        return codec.decode_udp_start_data_message(bytes_read)
     
     def decode_udp_data_message(self, bytes_read):
-            
-        start = 0; end = 2
-        seq_num = struct.unpack("!H", bytes_read[start:end])[0]
-        
-        start = end; end += 2
-        block_number = struct.unpack("!H", bytes_read[start:end])[0]
-        
-        start = end; end += 4
-        data_len = struct.unpack("!L", bytes_read[start:end])[0]
-        
-        start = end; end += data_len
-        data = bytes_read[start:end]
-        
-        return seq_num, block_number, data
+        return codec.decode_udp_data_message(bytes_read)
     
     """
     UDP encode functions
     """
     
     def encode_udp_get_full_file_request(self, file_hash, division_size):
-        
-        file_hash = bytes.fromhex(file_hash)
-        file_hash_length = len(file_hash)
-        
-        format_string = "!BB%dsH" % file_hash_length
-        flat_data = [action_udp.GET_FULL_FILE.value, file_hash_length, file_hash, division_size]
-        
-        return struct.pack(format_string, *flat_data)
+        return codec.encode_udp_get_full_file_request(file_hash, division_size, self.udp_receiver_window_size)
     
     def encode_udp_get_partial_file_request(self, file_hash, division_size, sequences, blocks):
-            
-        file_hash = bytes.fromhex(file_hash)
-        file_hash_length = len(file_hash)
-        
-        format_string = "!BB%dsH" % file_hash_length
-        flat_data = [action_udp.GET_PARTIAL_FILE.value, file_hash_length, file_hash, division_size]
-        
-        format_string += "B"
-        flat_data.append(len(sequences))
-        
-        format_string += "HH" * len(sequences)
-        flat_data.extend([value for sequence in sequences for value in sequence])
-        
-        format_string += "H"
-        flat_data.append(len(blocks))
-        
-        format_string += "H" * len(blocks)
-        flat_data.extend(blocks)
-        
-        return struct.pack(format_string, *flat_data)
+        return codec.encode_udp_get_partial_file_request(file_hash, division_size, sequences, blocks, self.udp_receiver_window_size)
     
     def encode_udp_start_data_message(self, flag, seq_num, file_name, division_size, block_number, data):  # data is in bytes
-            
-        file_name = file_name.encode("utf-8")
-        file_name_length = len(file_name)
-        
-        data_len = len(data)
-        format_string = "!BHB%dsHHL%ds" % (file_name_length, data_len)
-        flat_data = [flag, seq_num, file_name_length, file_name, division_size, block_number, data_len, data]
-                    
-        return struct.pack(format_string, *flat_data)
+        return codec.encode_udp_start_data_message(flag, seq_num, file_name, division_size, block_number, data)
     
     def encode_udp_data_message(self, flag, seq_num, block_number, data): # data is bytes
-        
-        format_string = "!BHHL"
-        flat_data = [flag, seq_num, block_number, len(data)]
-        
-        format_string += "%ds" % len(data)
-        flat_data.append(data)
-                
-        return struct.pack(format_string, *flat_data)
+        return codec.encode_udp_data_message(flag, seq_num, block_number, data)
        
     """
     UDP send functions
     """   
     
-    def send_udp_ack(self, address, ack_num):
-        encoded_data = struct.pack("!BH", action_udp.ACK.value, ack_num)
+    def send_udp_ack(self, address, ack_num, sacked=()):
+        encoded_data = codec.encode_udp_ack(ack_num, sacked)
         self.udp_socket.sendto(encoded_data, address) 
         if self.debug:
-            print(" >>> Sending ack with ack_num %d" % (ack_num))
+            print(" >>> Sending ack with ack_num %d, sacked %s" % (ack_num, list(sacked)))
         
     def send_udp_get_full_file_request(self, address, file_hash, division_size):
+        self.forget_udp_receiver_connection(address, full_file=True)
         encoded_data = self.encode_udp_get_full_file_request(file_hash, division_size)
         self.udp_socket.sendto(encoded_data, address)
         
     def send_udp_get_partial_file_request(self, address, file_hash, division_size, sequences, blocks):
+        self.forget_udp_receiver_connection(address)
         encoded_data = self.encode_udp_get_partial_file_request(file_hash, division_size, sequences, blocks)
         self.udp_socket.sendto(encoded_data, address)
         
+    def forget_udp_receiver_connection(self, address, full_file=False):
+        # a new transfer from this address starts with its START_DATA: until it arrives, the data of the new
+        # transfer must not be acked as if it continued the last one (their sequence numbers both start at 1)
+        with self.lock:
+            self.udp_receiver_connections.pop(address, None)
+            if full_file:
+                self.udp_full_file_requests.add(address)
+            else:
+                self.udp_full_file_requests.discard(address)
+        
     def send_udp_start_data_message(self, address, flag, seq_num, file_name, division_size, block_number, data):
         encoded_data = self.encode_udp_start_data_message(flag, seq_num, file_name, division_size, block_number, data)
         self.udp_socket.sendto(encoded_data, address)
@@ -520,13 +607,12 @@ class FS_Node:
             
         now = time.time()
 
-        keys = [k for k, v in self.udp_receiver_connections.items()]
-        for address in keys:
-            conn = self.udp_receiver_connections[address]
-            if now - conn.updated > self.udp_receiver_connection_timeout:
-                if self.debug:
-                    print(" >>> Receiver connection with address %s:%d terminated (%.2f old)." % (address[0], address[1], now - conn.updated))
-                del self.udp_receiver_connections[address]
+        with self.lock:  # the controller forgets the connections when it sends a GET
+            for address, conn in list(self.udp_receiver_connections.items()):
+                if now - conn.updated > self.udp_receiver_connection_timeout:
+                    if self.debug:
+                        print(" >>> Receiver connection with address %s:%d terminated (%.2f old)." % (address[0], address[1], now - conn.updated))
+                    self.udp_receiver_connections.pop(address, None)
         self.udp_last_receiver_connections_cleanup = now
      
     """
@@ -538,13 +624,16 @@ class FS_Node:
             print("Shutting down ...")
             
         self.done = True
+        self.heartbeat_stopped.set()
         if self.socket:
             self.socket.close()
             
         self.udp_socket.sendto(b"", ("", self.port))  # to "unlock" recvfrom
         self.udp_thread.join()   
         
-        for thread in self.udp_threads.values():
+        with self.lock:
+            threads = list(self.udp_threads.values())  # the threads remove themselves when they finish
+        for thread in threads:
             thread.join()
         
         if self.udp_socket:
@@ -563,26 +652,29 @@ class FS_Node:
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.connect((self.server_address, self.port))
         self.socket.settimeout(self.timeout)
+        self.reader = Socket_reader(self.socket)
                         
     def run(self):
         try:
             self.connect_to_fs_tracker()
             self.create_udp_socket()
             self.udp_thread.start()
+            if self.heartbeat_interval > 0:
+                self.heartbeat_thread.start()
 
             while not self.done:
-                bytes_read = self.socket.recv(1)
+                decoded_byte = self.reader.read_action()
 
-                if not bytes_read:
+                if decoded_byte is None:
                     break
-
-                decoded_byte = struct.unpack("!B", bytes_read)[0]
                 
                 response_handlers = {
                     action.RESPONSE.value: self.handle_response,
                     action.RESPONSE_LOCATE_HASH.value: self.handle_locate_hash_response,
                     action.RESPONSE_LOCATE_NAME.value: self.handle_locate_name_response,
                     action.RESPONSE_CHECK_STATUS.value: self.handle_check_status_response,
+                    action.RESPONSE_LOCATE_HASH_BATCH.value: self.handle_locate_hash_batch_response,
+                    action.RESPONSE_SEARCH_NAME.value: self.handle_search_name_response,
                 }
 
                 if decoded_byte in response_handlers:
@@ -601,6 +693,7 @@ class FS_Node:
                     print("Traceback:")
                     traceback.print_exc()
         finally:
+            self.fail_pending_requests()
             self.shutdown()
            
     """
@@ -608,228 +701,312 @@ class FS_Node:
     """       
      
     def handle_response(self):
-        result_status, counter = struct.unpack("!BH", self.socket.recv(3))
-        self.response_queue.put((result_status, counter))
+        result_status, counter = codec.decode_response(self.reader)
+        self.resolve_request(counter, (result_status, counter))
             
     def handle_locate_hash_response(self):
-        n_host_names = struct.unpack("!H", self.socket.recv(2))[0]
-        
-        output_full_files = {}  # host_name -> (block_size, last_block_size, full_file, [blocks])
-        output_partial_files = {}
-        
-        for _ in range(n_host_names):
-            
-            host_name_length = struct.unpack("!B", self.socket.recv(1))[0]
-            host_name = self.socket.recv(host_name_length).decode("utf-8")
-            
-            n_sets = struct.unpack("!B", self.socket.recv(1))[0]
-            
-            for _ in range(n_sets):
-                block_size = struct.unpack("!H", self.socket.recv(2))[0]
-                last_block_size = struct.unpack("!H", self.socket.recv(2))[0]
-                full_file = struct.unpack("!H", self.socket.recv(2))[0]
-                
-                if full_file == 0:
-                    blocks = []
-                    n_blocks = struct.unpack("!H", self.socket.recv(2))[0]
-                    for _ in range(n_blocks):
-                        block_number = struct.unpack("!H", self.socket.recv(2))[0]
-                        blocks.append(block_number)
-                        
-                    if output_partial_files.get(host_name) is None:
-                        output_partial_files[host_name] = []
-                        
-                    output_partial_files[host_name].append((block_size, last_block_size, blocks))
-                else:     
-                    if output_full_files.get(host_name) is None:
-                        output_full_files[host_name] = []
-                    output_full_files[host_name].append((block_size, last_block_size, full_file))
-                                        
-        counter = struct.unpack("!H", self.socket.recv(2))[0] 
-        self.response_queue.put((output_full_files, output_partial_files, counter))            
+        # host_name -> [(block_size, last_block_size, full_file)] / [(block_size, last_block_size, [blocks])]
+        output_full_files, output_partial_files, counter = codec.decode_locate_hash_response(self.reader)
+        self.resolve_request(counter, (output_full_files, output_partial_files, counter))
         
     def handle_locate_name_response(self):
-        n_host_names = struct.unpack("!H", self.socket.recv(2))[0]
-        host_names_dict = {}
-        
-        output = {}  # hash -> [host_name]
-        
-        for i in range(n_host_names):
-            
-            host_name_length = struct.unpack("!B", self.socket.recv(1))[0]
-            host_name = self.socket.recv(host_name_length).decode("utf-8")
-            host_names_dict[i+1] = host_name
-            
-        n_hashes = struct.unpack("!H", self.socket.recv(2))[0]
-        
-        for _ in range(n_hashes):
-            file_hash_length = struct.unpack("!B", self.socket.recv(1))[0]
-            file_hash = self.socket.recv(file_hash_length).hex()
-            
-            output[file_hash] = []
-            
-            n_ips_with_hash = struct.unpack("!H", self.socket.recv(2))[0]
-            
-            for _ in range(n_ips_with_hash):
-                host_name_reference = struct.unpack("!H", self.socket.recv(2))[0]
-                output[file_hash].append(host_names_dict[host_name_reference])
-        
-        counter = struct.unpack("!H", self.socket.recv(2))[0]    
-        self.response_queue.put((output, counter))
+        output, counter = codec.decode_locate_name_response(self.reader)  # hash -> [host_name]
+        self.resolve_request(counter, (output, counter))
+    
+    def handle_locate_hash_batch_response(self):
+        results, counter = codec.decode_locate_hash_batch_response(self.reader)  # [(file_hash, full files, partial files)]
+        self.resolve_request(counter, (results, counter))
+    
+    def handle_search_name_response(self):
+        results, counter = codec.decode_search_name_response(self.reader)  # [(file_name, file_hash, [host_name])]
+        self.resolve_request(counter, (results, counter))
     
     def handle_check_status_response(self):
-        status_db, result, counter = struct.unpack("!BBH", self.socket.recv(1+1+2))
-        self.response_queue.put((status_db, result, counter))
+        status_db, result, counter = codec.decode_check_status_response(self.reader)
+        self.resolve_request(counter, (status_db, result, counter))
+        
+    def resolve_request(self, counter, output):
+        future = self.pending_requests.pop(counter, None)
+        if future is None:
+            if self.debug:
+                print("Response to an unknown request", counter)
+            return
+        future.set_result(output)
+        
+    def fail_pending_requests(self):
+        while self.pending_requests:
+            _, future = self.pending_requests.popitem()
+            future.set_exception(ConnectionError("Connection to the tracker closed"))
     
     """
     Functions that send messages to the tracker
     """
     
+    def send_requests(self, messages):
+        """
+        Sends encoded requests back to back in a single write, without waiting for the responses;
+        returns the futures of the responses, in the same order
+        """
+        futures = []
+        
+        # the lock keeps the counters in the order the requests reach the socket; the receiving
+        # thread never takes it, it only pops futures registered before their request was sent
+        with self.send_lock:
+            for _ in messages:
+                self.counter = codec.next_counter(self.counter)
+                future = Future()
+                self.pending_requests[self.counter] = future
+                futures.append(future)
+            
+            self.socket.sendall(messages[0] if len(messages) == 1 else b"".join(messages))
+            
+        return futures
+    
+    def send_request(self, message):
+        return self.send_requests([message])[0]
+    
     def send_leave_request(self):  # receives a normal response
-        self.socket.sendall(struct.pack("!B", action.LEAVE.value))
+        return self.send_request(codec.encode_leave_request())
         
     def send_update_full_request(self, files):  # receives a normal response
-        encoded_request = self.encode_update_full_request(files)
-        self.socket.sendall(encoded_request)
+        return self.send_request(self.encode_update_full_request(files))
     
     def send_update_partial_request(self, files):  # receives a normal response
-        encoded_request = self.encode_update_partial_request(files)
-        self.socket.sendall(encoded_request)
+        return self.send_request(self.encode_update_partial_request(files))
     
     def send_update_status_request(self, s):  # receives a normal response
-        self.socket.sendall(struct.pack("!BB", action.UPDATE_STATUS.value, s))
+        return self.send_request(codec.encode_update_status_request(s))
     
     def send_locate_hash_request(self, file_hash):  # receives a locate hash response
-        encoded_request = self.encode_locate_hash_request(file_hash)
-        self.socket.sendall(encoded_request)
+        return self.send_request(self.encode_locate_hash_request(file_hash))
+    
+    def send_locate_hash_batch_request(self, file_hashes):  # receives a locate hash batch response
+        """
+        Larger batches than a request can hold are sent as several pipelined requests;
+        their responses are joined into one, with the counter of the last request
+        """
+        batches = [
+            file_hashes[i:i + codec.MAX_LOCATE_HASH_BATCH]
+            for i in range(0, len(file_hashes), codec.MAX_LOCATE_HASH_BATCH)
+        ] or [file_hashes]
+        futures = self.send_requests([codec.encode_locate_hash_batch_request(batch) for batch in batches])
+        
+        if len(futures) == 1:
+            return futures[0]
+        
+        joined = Future()
+        remaining = [len(futures)]
+        lock = threading.Lock()  # the callbacks run on the receiving thread, or on this one if a response already arrived
+        
+        def join(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            try:
+                outputs = [future.result() for future in futures]
+            except Exception as e:
+                joined.set_exception(e)
+                return
+            
+            # a plain response (status, counter) instead of results is the tracker's error
+            error = next((output for output in outputs if not isinstance(output[0], list)), None)
+            if error is not None:
+                joined.set_result(error)
+            else:
+                joined.set_result(([result for results, _ in outputs for result in results], outputs[-1][1]))
+            
+        for future in futures:
+            future.add_done_callback(join)
+        return joined
     
     def send_locate_name_request(self, file_name):  # receives a locate name response
-        encoded_request = self.enconde_locate_name_request(file_name)
-        self.socket.sendall(encoded_request)
+        return self.send_request(self.enconde_locate_name_request(file_name))
+    
+    def send_search_name_request(self, query, mode, limit):  # receives a search name response
+        return self.send_request(codec.encode_search_name_request(query, mode, limit))
+    
+    def send_check_status_request(self, host_name):  # receives a check status response
+        return self.send_request(self.encode_check_status_request(host_name))
     
-    def send_check_status_request(self, ip):  # receives a check status response
-        encoded_request = self.encode_check_status_request(ip)
-        self.socket.sendall(encoded_request)
+    def send_add_blocks_request(self, files):  # receives a normal response
+        return self.send_request(codec.encode_add_blocks_request(files))
+    
+    def send_remove_blocks_request(self, files):  # receives a normal response
+        return self.send_request(codec.encode_remove_blocks_request(files))
     
     """
-    Functions that encode messages to send to the tracker
+    Heartbeats
     """
     
-    def encode_update_full_request(self, files):
-        
-        n_files = len(files)
-        format_string = "!BH"
-        flat_data = [action.UPDATE_FULL_FILES.value, n_files]
-        
-        for file in files:
-            file_hash, file_name, block_sets = file    
-        
-            file_hash = bytes.fromhex(file_hash)
-            file_hash_length = len(file_hash)
-            file_name = file_name.encode("utf-8")
-            file_name_length = len(file_name)
-            n_block_sets = len(block_sets)
-
-            format_string += "H%dsB%dsB" % (file_hash_length, file_name_length)
-            flat_data.extend([file_hash_length, file_hash, file_name_length, file_name, n_block_sets])
+    def run_heartbeats(self):
+        while not self.heartbeat_stopped.wait(self.heartbeat_interval):
+            # the tracker dropped this node's blocks while it was silent: announce them again
+            if self.evicted:
+                self.evicted = False
+                self.announce_all()
+                    
+            try:
+                future = self.send_request(codec.encode_heartbeat_request())
+            except OSError:
+                break
+            future.add_done_callback(self.heartbeat_acknowledged)
             
-            for block in block_sets:
-                division_size, last_block_size, n_blocks = block
-                format_string += "HHH"
-                flat_data.extend([division_size, last_block_size, n_blocks])
-                        
-        return struct.pack(format_string, *flat_data)
-
-    def encode_update_partial_request(self, files):
-        
-        n_files = len(files)
-        format_string = "!BH"
-        flat_data = [action.UPDATE_PARTIAL.value, n_files]
-        
-        for file in files:
-            file_hash, file_name, block_sets = file
-        
-            file_hash = bytes.fromhex(file_hash)
-            file_hash_length = len(file_hash)
-            file_name = file_name.encode("utf-8")
-            file_name_length = len(file_name)
-            n_block_sets = len(block_sets)
-
-            format_string += "H%dsB%dsB" % (file_hash_length, file_name_length)
-            flat_data.extend([file_hash_length, file_hash, file_name_length, file_name, n_block_sets])
+    def heartbeat_acknowledged(self, future):
+        if future.exception() is None and future.result()[0] == status.NOT_FOUND.value:
+            self.evicted = True
+    
+    """
+    Delta announcements
+    """
+    
+    def local_block_ranges(self):
+        """
+        (file_hash, division_size) -> (file_name, Interval_set, last_block_size) of the blocks this node has
+        """
+        ranges = {}
+        
+        for file in list(self.file_manager.files.values()):
+            if not file.hash_id:
+                continue
             
-            for block in block_sets:
-                division_size, last_block_size, sequences, blocks = block
-                format_string += "HHB"
-                flat_data.extend([division_size, last_block_size, len(sequences)])
-                for sequence in sequences:
-                    format_string += "HH"
-                    flat_data.extend([sequence[0], sequence[1]])
-                n_blocks = len(blocks)
-                format_string += "H"
-                flat_data.append(n_blocks)
-                for block_number in blocks:
-                    format_string += "H"
-                    flat_data.append(block_number)
+            for division_size, block_set in list(file.blocks.items()):
+                if len(block_set) == 0:
+                    continue
+                
+                last_block_size = division_size
+                for block in block_set:
+                    if block.is_last:
+                        last_block_size = block.size
                         
-        return struct.pack(format_string, *flat_data)
-        
+                blocks = Interval_set(numbers_to_intervals(block.number for block in block_set))
+                ranges[(file.hash_id, division_size)] = (file.name, blocks, last_block_size)
+                
+        return ranges
     
-    def encode_check_status_request(self, ip):
-        
-        ip_bytes = socket.inet_aton(ip)
-        format_string = "!BBBBB"
-        flat_data = [action.CHECK_STATUS.value]
-        flat_data.extend(ip_bytes)
+    def set_announced(self, ranges):
+        with self.announce_lock:
+            self.announced = {key: blocks for key, (_, blocks, _) in ranges.items()}
+            self.announced_generation += 1
+            
+    def announce_all(self):
+        """
+        Announces all the blocks again (the tracker dropped them), if some were announced;
+        returns the futures of the responses
+        """
+        with self.announce_lock:
+            if not self.announced:
+                return []
+            self.announced = {}
+            self.announced_generation += 1
+            
+        if self.debug:
+            print("Evicted by the tracker, announcing all blocks again")
+        return self.announce_changes()
+    
+    def announce_changes(self):
+        """
+        Sends ADD_BLOCKS / REMOVE_BLOCKS with only the blocks gained and lost since the last
+        announcement (both pipelined); returns the futures of the responses
+        """
+        with self.announce_lock:
+            requests, generation = self.send_announcement()
+            
+        # outside the lock: the callback of a response that already arrived runs right away
+        futures = []
+        for future, (_, files, _, undo) in requests:
+            future.add_done_callback(
+                lambda future, files=files, undo=undo: self.acknowledge_announcement(future, files, undo, generation)
+            )
+            futures.append(future)
+        return futures
+    
+    def send_announcement(self):
+        # called with announce_lock held
+        current = self.local_block_ranges()
+        added = {}  # file_hash -> (file_name, [(division_size, last_block_size, intervals)])
+        removed = {}
+        
+        for key in current.keys() | self.announced.keys():
+            file_hash, division_size = key
+            file_name, blocks, last_block_size = current.get(key, ("", Interval_set(), division_size))
+            announced = self.announced.get(key, Interval_set())
+            
+            new_blocks = Interval_set(blocks)
+            for first, last in announced:
+                new_blocks.remove(first, last)
+            if len(new_blocks) > 0:
+                added.setdefault(file_hash, (file_name, []))[1].append((division_size, last_block_size, new_blocks.intervals()))
+                
+            lost_blocks = Interval_set(announced)
+            for first, last in blocks:
+                lost_blocks.remove(first, last)
+            if len(lost_blocks) > 0:
+                removed.setdefault(file_hash, (file_name, []))[1].append((division_size, division_size, lost_blocks.intervals()))
+                
+        requests = []
+        for changes, encode, apply, undo in (
+            (added, codec.encode_add_blocks_request, Interval_set.add, Interval_set.remove),
+            (removed, codec.encode_remove_blocks_request, Interval_set.remove, Interval_set.add),
+        ):
+            if changes:
+                files = [(file_hash, file_name, block_sets) for file_hash, (file_name, block_sets) in changes.items()]
+                requests.append((encode(files), files, apply, undo))
+                
+        if not requests:
+            return [], self.announced_generation
         
-        return struct.pack(format_string, *flat_data)
+        futures = self.send_requests([message for message, _, _, _ in requests])
+        for _, files, apply, _ in requests:
+            self.update_announced(files, apply)
+            
+        return list(zip(futures, requests)), self.announced_generation
+    
+    def acknowledge_announcement(self, future, files, undo, generation):
+        if future.exception() is None and future.result()[0] == status.SUCCESS.value:
+            return
+        
+        # not applied by the tracker: undone, so that the next announcement sends the same changes
+        with self.announce_lock:
+            if generation == self.announced_generation:  # otherwise announced was replaced since, without them
+                self.update_announced(files, undo)
+                
+    def update_announced(self, files, apply):
+        for file_hash, _, block_sets in files:
+            for division_size, _, intervals in block_sets:
+                blocks = self.announced.setdefault((file_hash, division_size), Interval_set())
+                for first, last in intervals:
+                    apply(blocks, first, last)
+    
+    """
+    Functions that encode messages to send to the tracker
+    """
+    
+    def encode_update_full_request(self, files):
+        return codec.encode_update_full_request(files)
+
+    def encode_update_partial_request(self, files):
+        return codec.encode_update_partial_request(files)
+    
+    def encode_check_status_request(self, host_name):
+        return codec.encode_check_status_request(host_name)
     
     def encode_locate_hash_request(self, file_hash):
-        
-        file_hash = bytes.fromhex(file_hash)
-        file_hash_length = len(file_hash)
-        format_string = "!BH%ds" % file_hash_length
-        flat_data = [action.LOCATE_HASH.value, file_hash_length, file_hash]
-        
-        return struct.pack(format_string, *flat_data)
+        return codec.encode_locate_hash_request(file_hash)
     
     def enconde_locate_name_request(self, file_name):
-
-        file_name = file_name.encode("utf-8")
-        file_name_length = len(file_name)
-        format_string = "!BB%ds" % file_name_length
-        flat_data = [action.LOCATE_NAME.value, file_name_length, file_name]
-        
-        return struct.pack(format_string, *flat_data)
+        return codec.encode_locate_name_request(file_name)
     
     def encode_all_files(self):
         
         files = self.file_manager.files
-        
-        format_string_uf = "!BH"
-        flat_data_uf = [action.UPDATE_FULL_FILES.value, 0]
-        n_files_uf = 0
-        
-        format_string_up = "!BH"
-        flat_data_up = [action.UPDATE_PARTIAL.value, 0]
-        n_files_up = 0
+        files_uf = []  # (file_hash, file_name, [(division_size, last_block_size, n_blocks)])
+        files_up = []  # (file_hash, file_name, [(division_size, last_block_size, sequences, blocks)])
                 
         for file in files.values():
             
-            file_hash = bytes.fromhex(file.hash_id) if file.hash_id else b""
-            file_hash_length = len(file_hash)
-            
-            file_name = file.name.encode("utf-8")
-            file_name_length = len(file_name)
-            
-            file_included_uf = False
-            n_block_sets_uf = 0
-            block_sets_uf_format_string = ""
+            file_hash = file.hash_id or ""
             block_sets_uf = []
-            
-            file_included_up = False
-            n_block_sets_up = 0
-            block_sets_up_format_string = ""
             block_sets_up = []
             
             for division_size, block_set in file.blocks.items():
@@ -841,24 +1018,12 @@ class FS_Node:
                 if division_size in file.is_complete:
                     for block in block_set:
                         if block.is_last:
-                            
-                            if not file_included_uf:
-                                file_included_uf = True
-                                n_files_uf += 1
-                            
-                            n_block_sets_uf += 1
-                                
-                            block_sets_uf_format_string += "HHH"
-                            block_sets_uf.extend([division_size, block.size, len(block_set)])
+                            block_sets_uf.append((division_size, block.size, len(block_set)))
                             break_flag = True
                             
                 if break_flag:
                     break
                 
-                if not file_included_up:
-                    file_included_up = True
-                    n_files_up += 1
-                
                 aux = []
                 last_block_size = division_size
                 for block in block_set:
@@ -866,44 +1031,22 @@ class FS_Node:
                     if block.is_last:
                         last_block_size = block.size
                         
-                block_sets_up_format_string += "B"
-                block_sets_up.append(0)
-                        
-                n_block_sets_up += 1
-                block_sets_up_format_string += "HHH"
-                block_sets_up.extend([division_size, last_block_size, len(block_set)])
-                
+                block_sets_up.append((division_size, last_block_size, [], sorted(aux)))
 
-            if n_block_sets_uf > 0:
-                format_string_uf += "H%dsB%ds" % (file_hash_length, file_name_length)
-                flat_data_uf.extend([file_hash_length, file_hash, file_name_length, file_name])
+            if block_sets_uf:
+                files_uf.append((file_hash, file.name, block_sets_uf))
 
-                format_string_uf += "B"
-                flat_data_uf.append(n_block_sets_uf)
-
-                format_string_uf += block_sets_uf_format_string
-                flat_data_uf.extend(block_sets_uf)
-
-            if n_block_sets_up > 0:
-                format_string_up += "H%dsB%ds" % (file_hash_length, file_name_length)
-                flat_data_up.extend([file_hash_length, file_hash, file_name_length, file_name])
-                
-                format_string_up += "B"
-                flat_data_up.append(n_block_sets_up)
-
-                format_string_up += block_sets_up_format_string
-                flat_data_up.extend(block_sets_up)
+            if block_sets_up:
+                files_up.append((file_hash, file.name, block_sets_up))
         
         uf_packed_data = None
         up_packed_data = None
         
-        if len(format_string_uf) > 3:
-            flat_data_uf[1] = n_files_uf
-            uf_packed_data = struct.pack(format_string_uf, *flat_data_uf)        
+        if files_uf:
+            uf_packed_data = codec.encode_update_full_request(files_uf)
             
-        if len(format_string_up) > 3:
-            flat_data_up[1] = n_files_up
-            up_packed_data = struct.pack(format_string_up, *flat_data_up)
+        if files_up:
+            up_packed_data = codec.encode_update_partial_request(files_up)
             
         return uf_packed_data, up_packed_data
     
@@ -1012,6 +1155,21 @@ def print_locate_hash_output(output):
             
     print("Counter: ", counter)
     
+def print_locate_hash_batch_output(output):
+    results, counter = output
+    for file_hash, output_full_files, output_partial_files in results:
+        print(f"Hash: {file_hash}")
+        if not output_full_files and not output_partial_files:
+            print("\tNot found")
+        for host_name, data in output_full_files.items():
+            for block_size, last_block_size, n_blocks in data:
+                print(f"\tHost name: {host_name}, division size: {block_size}, full file ({n_blocks} blocks)")
+        for host_name, data in output_partial_files.items():
+            for block_size, last_block_size, blocks in data:
+                print(f"\tHost name: {host_name}, division size: {block_size}, blocks: {blocks}")
+    
+    print("Counter: ", counter)
+
 def print_locate_name_output(output):
     output, counter = output
     
@@ -1020,6 +1178,17 @@ def print_locate_name_output(output):
         print("\tHost names: ", host_names)
     print("Counter: ", counter)
     
+def print_search_name_output(output):
+    results, counter = output
+    
+    if not results:
+        print("No file found")
+    for file_name, file_hash, host_names in results:
+        print("File name: ", file_name)
+        print("\tFile hash: ", file_hash)
+        print("\tHost names: ", host_names)
+    print("Counter: ", counter)
+    
 def print_check_status_output(output):
     status_db, result, counter = output
     print("Status: ", status(status_db).name, result)
@@ -1049,78 +1218,100 @@ class FS_Node_controller:
                 
                 if command == "leave" or command == "l":
                     self.done = True
-                    self.node.send_leave_request()
+                    future = self.node.send_leave_request()
                     print("Leaving ...")
-                    output = self.node.response_queue.get()
+                    output = future.result()
                     print_response_output(output)
                     
                 elif not self.full_update and (command == "full update" or command == "fu"):
+                    ranges = self.node.local_block_ranges()
                     uf_packed_data, up_packed_data = self.node.encode_all_files()
+                    requests = [
+                        (name, packed_data)
+                        for name, packed_data in (("UPDATE_FULL", uf_packed_data), ("UPDATE_PARTIAL", up_packed_data))
+                        if packed_data is not None
+                    ]
                     
-                    if uf_packed_data is not None:
-                        self.node.socket.sendall(uf_packed_data)
-                        print("Sending UPDATE_FULL request ...")
-                        output = self.node.response_queue.get()
-                        print_response_output(output)
-                        
-                    if up_packed_data is not None:
-                        self.node.socket.sendall(up_packed_data)
-                        print("Sending UPDATE_PARTIAL request ...")
-                        output = self.node.response_queue.get()
-                        print_response_output(output)
+                    if requests:
+                        print("Sending %s request(s) ..." % " and ".join(name for name, _ in requests))
+                        outputs = [future.result() for future in self.node.send_requests([packed_data for _, packed_data in requests])]
+                        for output in outputs:
+                            print_response_output(output)
+                            
+                        # later changes are announced as deltas of this state
+                        if all(output[0] == status.SUCCESS.value for output in outputs):
+                            self.node.set_announced(ranges)
                         
                     self.full_update = True
                         
                 elif command == "locate name" or command == "ln":
                     file_name = input("Enter file name: ")
-                    self.node.send_locate_name_request(file_name)
+                    future = self.node.send_locate_name_request(file_name)
                     print("Locating file name...")
-                    output = self.node.response_queue.get()
+                    output = future.result()
                     print_locate_name_output(output)
                     
                     
+                elif command == "search name" or command == "sn":
+                    query = input("Enter a name or part of a name: ")
+                    mode = input("Match (exact / prefix / substring, default substring): ").strip().upper() or "SUBSTRING"
+                    if mode not in search_mode.__members__:
+                        print("Invalid match")
+                        continue
+                    limit = input("Maximum number of files (default 20, 0 for all): ").strip()
+                    future = self.node.send_search_name_request(query, search_mode[mode].value, int(limit or 20))
+                    print("Searching file names ...")
+                    output = future.result()
+                    print_search_name_output(output)
+                    
                 elif command == "locate hash" or command == "lh":
                     file_hash = input("Enter file hash: ")
-                    self.node.send_locate_hash_request(file_hash)
+                    future = self.node.send_locate_hash_request(file_hash)
                     print("Locating file hash ...")
-                    output = self.node.response_queue.get()
+                    output = future.result()
                     print_locate_hash_output(output)
                     
+                elif command == "locate hashes" or command == "lhs":
+                    file_hashes = input("Enter file hashes (separated by spaces, none for all local files): ").split()
+                    if not file_hashes:
+                        file_hashes = [file.hash_id for file in self.node.file_manager.files.values() if file.hash_id]
+                    future = self.node.send_locate_hash_batch_request(file_hashes)
+                    print("Locating %d file hash(es) ..." % len(file_hashes))
+                    output = future.result()
+                    print_locate_hash_batch_output(output)
+                    
                 elif command == "locate hash with name" or command == "lhn":
                     file_name = input("Enter file name: ")
                     result = self.node.file_manager.get_file_hash_by_name(file_name)
                     
                     if result is None:
                         print("File not found in local directory. Sendind LOCATE_NAME request ...")
-                        self.node.send_locate_name_request(file_name)  
-                        output = self.node.response_queue.get()
+                        output = self.node.send_locate_name_request(file_name).result()
                         print_locate_name_output(output)
                         
                     else:
                         print("File found in local directory. Sendind LOCATE_HASH request ...")
-                        self.node.send_locate_hash_request(result)
-                        output = self.node.response_queue.get()
+                        output = self.node.send_locate_hash_request(result).result()
                         print_locate_hash_output(output)
                     
                 elif command == "check status" or command == "cs":
                     host_name = input("Enter host name: ")
-                    self.node.send_check_status_request(host_name)
+                    future = self.node.send_check_status_request(host_name)
                     print("Checking status ...")
-                    output = self.node.response_queue.get()
+                    output = future.result()
                     print_check_status_output(output)
                     
                 elif command == "update status" or command == "us":
                     print("This command is avaible for testing purposes only")
                     s = input("Enter status: ")
-                    self.node.send_update_status_request(int(s))
+                    future = self.node.send_update_status_request(int(s))
                     print("Updating status ...")
-                    output = self.node.response_queue.get()
+                    output = future.result()
                     print_response_output(output)
                     
                 elif command == "get" or command == "g":
                     file_hash = input("Enter file hash: ")
-                    self.node.send_locate_hash_request(file_hash)
-                    response = self.node.response_queue.get()
+                    response = self.node.send_locate_hash_request(file_hash).result()
                     
                     if (
                         (response[0] is None or len(response[0]) == 0) and 
@@ -1159,23 +1350,19 @@ class FS_Node_controller:
                         
                     file_name = None
                     output_length = len(output)
+                    update_futures = []
                     
                     for _ in range(output_length):
                         address, file_name, res_status = self.node.udp_response_queue.get(timeout=60*10)
-                        host_name = socket.gethostbyaddr(address[0])[0]
-                        last_block_size = output[host_name][3] 
-                        
-                        if output_length == 1 and res_status == status.SUCCESS.value:
-                            block_sets = [(division_size, last_block_size, output[host_name][1])]
-                            self.node.send_update_full_request([(file_hash, file_name, block_sets)])
                         
-                        elif res_status == status.SUCCESS.value:
-                            sequences = [(output[host_name][0], output[host_name][1])]
-                            block_sets = [(division_size, last_block_size, sequences, [])]
-                            self.node.send_update_partial_request([(file_hash, file_name, block_sets)])
+                        # each finished transfer announces only the blocks received since the last announcement
+                        if res_status == status.SUCCESS.value:
+                            self.node.file_manager.set_file_hash(file_name, file_hash)
+                            update_futures.extend(self.node.announce_changes())
                     
-                    for i in range(output_length):
-                        output = self.node.response_queue.get(timeout=60*10)
+                    # the announcements went out as the transfers finished; their responses are collected at the end
+                    for future in update_futures:
+                        future.result(timeout=60*10)
                     
                     r = self.node.file_manager.join_blocks(file_name, division_size)
                     if r:
@@ -1183,6 +1370,20 @@ class FS_Node_controller:
                     else:
                         print("Error joining file")           
                             
+                elif command == "announce" or command == "a":
+                    futures = self.node.announce_changes()
+                    if not futures:
+                        print("Nothing changed since the last announcement")
+                    for future in futures:
+                        print_response_output(future.result())
+                    
+                elif command == "rtt stats" or command == "rs":
+                    stats = self.node.udp_rtt_stats()
+                    if not stats:
+                        print("No blocks sent yet")
+                    for peer, peer_stats in stats.items():
+                        print(f"{peer}: srtt {peer_stats['srtt_ms']} ms, rttvar {peer_stats['rttvar_ms']} ms, rto {peer_stats['rto_ms']} ms ({peer_stats['samples']} samples, {peer_stats['backoffs']} backoffs)")
+                    
                 elif command == "join blocks" or command == "jbb":
                     file_name = input("Enter file name: ")
                     division_size = input("Enter division size: ")
@@ -1197,11 +1398,15 @@ class FS_Node_controller:
                     print("\tleave (l)")
                     print("\tfull update (fu)")
                     print("\tlocate hash (lh)")
+                    print("\tlocate hashes (lhs)")
                     print("\tlocate name (ln)")
+                    print("\tsearch name (sn)")
                     print("\tlocate hash with name (lhn)")
                     print("\tcheck status (cs)")
                     print("\tupdate status (us)")
                     print("\tget (g)")
+                    print("\tannounce (a)")
+                    print("\trtt stats (rs)")
                     print("\tjoin blocks (jbb)")
                     print("\thelp (h)")
                 else:
@@ -1225,9 +1430,14 @@ def parse_args():
         parser.add_argument('--block_size', '-b', type=int, default=512, help='Block size')
         parser.add_argument('--dir', '-D', type=str, default=None, help='Directory to store files')
         parser.add_argument('--udp_port', '-up', type=int, default=9090, help='UDP port')
-        parser.add_argument('--ack_timeout', '-at', type=float, default=0.5, help='UDP ack timeout')
+        parser.add_argument('--ack_timeout', '-at', type=float, default=0.5, help='UDP retransmission timeout until the round trip time to a peer is measured')
+        parser.add_argument('--window', '-w', type=int, default=32, help='UDP datagrams sent ahead of the acks')
+        parser.add_argument('--receiver_window', '-rw', type=int, default=64, help='UDP datagrams kept ahead of a missing one when receiving')
+        parser.add_argument('--no_congestion_control', '-ncc', default=False, action='store_true', help='Always send a full window')
+        parser.add_argument('--pacing', '-pc', default=False, action='store_true', help='Space the UDP datagrams over a round trip')
         parser.add_argument('--timeout', '-t', type=float, default=60*10, help='TCP timeout')
         parser.add_argument('--udp_timeout', '-ut', type=float, default=60*10, help='UDP timeout')
+        parser.add_argument('--heartbeat', '-hb', type=float, default=2, help='Seconds between heartbeats to the tracker (0 disables them)')
         args = parser.parse_args()
         
         if args.block_size > 1024:
@@ -1235,6 +1445,9 @@ def parse_args():
     
         if args.dir is None:
             raise argparse.ArgumentError("Directory must be specified")
+        
+        if not 1 <= args.receiver_window <= MAX_UDP_RECEIVER_WINDOW:
+            parser.error("the receiver window must be between 1 and %d datagrams" % MAX_UDP_RECEIVER_WINDOW)
     
         return args
     except argparse.ArgumentError as e:
@@ -1254,8 +1467,13 @@ if __name__ == "__main__":
         debug=args.debug,
         udp_port=args.udp_port,
         udp_ack_timeout=args.ack_timeout,
+        udp_window_size=args.window,
+        udp_receiver_window_size=args.receiver_window,
+        udp_congestion_control=not args.no_congestion_control,
+        udp_pacing=args.pacing,
         timeout=args.timeout,
-        udp_timeout=args.udp_timeout
+        udp_timeout=args.udp_timeout,
+        heartbeat_interval=args.heartbeat
     )
         
     fs_node_1.file_manager.run()
@@ -1,12 +1,21 @@
 import sys
 import socket
+import selectors
 from threading import Thread
+from queue import Queue
+import queue
 import os
+import time
 from datetime import datetime
-import struct
 import argparse
-from utils import action, status, join_blocks
+from utils import action, status, search_mode, join_blocks, Socket_reader, Socket_writer, Host_name_resolver, Nonblocking_socket_reader, Nonblocking_socket_writer, Incomplete_message
+import codec
 from db import DB_manager
+from block_index import Block_index
+from response_cache import Response_cache
+from metrics import Tracker_metrics, Null_metrics, Stats_server, Stats_dumper, DB, ENCODE, SOCKET
+from liveness import Liveness_table
+from snapshot import Snapshot_writer, Update_gate, Snapshot_error, read_snapshot
 import traceback
 
 
@@ -19,9 +28,19 @@ class FS_Tracker(Thread):
         max_connections=5,
         timeout=60*5,
         debug=False,
+        mode="thread",
+        n_loops=1,
+        n_resolvers=4,
+        persistent=False,
+        stale_timeout=60,
+        cache_size=64*1024*1024,
+        stats_port=None,
+        stats_file=None,
+        stats_interval=10,
+        liveness_timeout=6,
+        snapshot_interval=60,
     ):
         self.socket = None
-        self.db = DB_manager(db, debug)
         self.port = port
         self.address = address
         self.max_connections = max_connections
@@ -30,6 +49,39 @@ class FS_Tracker(Thread):
         self.clients = []
         self.threads = []
         self.done = False
+        self.mode = mode
+        self.n_loops = n_loops
+        self.loops = []
+        self.resolver = Host_name_resolver(n_workers=n_resolvers)
+        self.metrics = Tracker_metrics() if stats_port is not None or stats_file is not None else Null_metrics()
+        self.stats_port = stats_port
+        self.stats_file = stats_file
+        self.stats_interval = stats_interval
+        self.stats_threads = []
+        self.liveness = Liveness_table(self.evict_nodes, liveness_timeout, debug=debug)
+        
+        self.start_time = time.time()
+        self.stale_timeout = stale_timeout
+        self.stale_nodes_expired = not persistent
+        self.snapshot_interval = snapshot_interval
+        self.snapshots = None
+        self.updates = Update_gate()  # database writes and their index changes, paused by the snapshots
+        self.open_state(db, persistent, cache_size)
+        
+        self.request_handlers = {
+            action.UPDATE_FULL_FILES.value: self.handle_update_full_request,
+            action.UPDATE_PARTIAL.value: self.handle_update_partial_request,
+            action.LOCATE_NAME.value: self.handle_locate_name_request,
+            action.LOCATE_HASH.value: self.handle_locate_hash_request,
+            action.CHECK_STATUS.value: self.handle_check_status_request,
+            action.UPDATE_STATUS.value: self.handle_update_status_request,
+            action.ADD_BLOCKS.value: self.handle_add_blocks_request,
+            action.REMOVE_BLOCKS.value: self.handle_remove_blocks_request,
+            action.HEARTBEAT.value: self.handle_heartbeat_request,
+            action.LOCATE_HASH_BATCH.value: self.handle_locate_hash_batch_request,
+            action.SEARCH_NAME.value: self.handle_search_name_request,
+        }
+        
         Thread.__init__(self)    
 
     """
@@ -51,32 +103,90 @@ class FS_Tracker(Thread):
         self.socket.listen(self.max_connections)
         if self.debug:
             print(datetime.now(), "Server socket listening for connections")
+            
+        self.start_stats()
+        self.liveness.start()
 
-        while not self.done:
-            client, address = self.socket.accept()
-            self.clients.append(client)
-            client.settimeout(self.timeout)
+        if self.mode == "selectors":
+            self.run_event_loops()
+        else:
+            self.run_threads()
             
-            print(datetime.now(), "Client connected", address)
-            host_name, _, _ = socket.gethostbyaddr(address[0])
+    def accept_client(self):
+        """
+        Accepts a connection; the host name is resolved in the background so the
+        accept loop never waits for a DNS lookup
+        """
+        client, address = self.socket.accept()
+        self.clients.append(client)
+        client.settimeout(self.timeout)
+        
+        print(datetime.now(), "Client connected", address)
             
-            if self.debug:
-                print(datetime.now(), "Client connected", host_name)
+        return client, self.resolver.resolve(address[0])
+            
+    def run_threads(self):
+        while not self.done:
+            client, host_name_future = self.accept_client()
 
             node_thread = Thread(
                 target=self.listen_to_client,
-                args=(client, host_name)
+                args=(client, host_name_future)
             )
             
             node_thread.start()
             self.threads.append(node_thread)
+            
+    def run_event_loops(self):
+        for _ in range(self.n_loops):
+            loop = Tracker_event_loop(self)
+            loop.start()
+            self.loops.append(loop)
+            
+        if self.debug:
+            print(datetime.now(), "Started %d event loop(s)" % self.n_loops)
+            
+        i = 0
+        while not self.done:
+            client, host_name_future = self.accept_client()
+            
+            # connections are spread round-robin over the event loops and only
+            # registered once the host name is known
+            loop = self.loops[i]
+            host_name_future.add_done_callback(
+                lambda future, loop=loop, client=client: loop.add_client(client, future.result())
+            )
+            i = (i + 1) % len(self.loops)
 
+    def start_stats(self):
+        if self.stats_port is not None:
+            self.stats_threads.append(Stats_server(self.stats, self.stats_port))
+        if self.stats_file is not None:
+            self.stats_threads.append(Stats_dumper(self.stats, self.stats_file, self.stats_interval))
+            
+        for thread in self.stats_threads:
+            thread.start()
+            
     def stop(self):
         self.done = True
+        self.resolver.shutdown()
+        self.liveness.stop()
+        if self.snapshots is not None:
+            self.snapshots.stop()
+        for thread in self.stats_threads:
+            thread.stop()
         for thread in self.threads:
             thread.join()
+        for loop in self.loops:
+            loop.stop()
+            loop.join()
 
-    def listen_to_client(self, client, host_name):
+    def listen_to_client(self, client, host_name_future):
+        host_name = host_name_future.result()
+        reader = Socket_reader(client)
+        writer = Socket_writer(client)
+        self.node_connected(host_name)
+            
         counter = 0
         leave = False
 
@@ -85,35 +195,13 @@ class FS_Tracker(Thread):
                 if self.debug:
                     print(datetime.now(), "Waiting for data from client", host_name)
                     
-                bytes_read = client.recv(1)
+                decoded_byte = reader.read_action()
 
-                if not bytes_read:
+                if decoded_byte is None:
                     break
 
-                counter += 1
-                decoded_byte = struct.unpack("!B", bytes_read)[0]
-                
-                if self.debug:
-                    print(datetime.now(), "Request received",  action(decoded_byte).name)
-                
-                request_handlers = {
-                    action.UPDATE_FULL_FILES.value: self.handle_update_full_request,
-                    action.UPDATE_PARTIAL.value: self.handle_update_partial_request,
-                    action.LOCATE_NAME.value: self.handle_locate_name_request,
-                    action.LOCATE_HASH.value: self.handle_locate_hash_request,
-                    action.CHECK_STATUS.value: self.handle_check_status_request,
-                    action.UPDATE_STATUS.value: self.handle_update_status_request,
-                }
-                
-                if decoded_byte == action.LEAVE.value:
-                    result = self.db.delete_node(host_name)
-                    self.send_response(client, result, counter)
-                    leave = True
-                elif decoded_byte in request_handlers:
-                    request_handlers[decoded_byte](client, host_name, counter)
-                else:
-                    self.send_response(client, status.INVALID_ACTION.value, counter)
-                    break
+                counter = codec.next_counter(counter)
+                leave = self.handle_request(writer, reader, host_name, decoded_byte, counter)
                 
             except Exception as e:
                 if self.debug:
@@ -124,24 +212,203 @@ class FS_Tracker(Thread):
                     print("Host name:", host_name, '\n')
                 break
             
-        self.db.delete_node(host_name)
+        self.disconnect_client(client, host_name)
+
+        return False
+    
+    def handle_request(self, client, reader, host_name, decoded_byte, counter):
+        """
+        Dispatches one request to its handler; returns True if the connection should be closed
+        """
+        if self.debug:
+            print(datetime.now(), "Request received",  action(decoded_byte).name)
+            
+        if not self.stale_nodes_expired and time.time() - self.start_time > self.stale_timeout:
+            self.expire_stale_nodes()
+            
+        timer = self.metrics.begin()
+        
+        if decoded_byte == action.LEAVE.value:
+            result = self.delete_node(host_name)
+            self.send_response(client, result, counter)
+            close = True
+        elif decoded_byte in self.request_handlers:
+            self.request_handlers[decoded_byte](client, reader, host_name, counter)
+            close = False
+        else:
+            self.send_response(client, status.INVALID_ACTION.value, counter)
+            close = True
+            
+        # the responses are held while more requests of a pipeline are waiting in the reader
+        if close or reader.buffered() == 0:
+            self.flush(client)
+            
+        self.metrics.end(decoded_byte, timer)
+        self.metrics.bytes_in += reader.received
+        reader.received = 0
+        return close
+        
+    def disconnect_client(self, client, host_name):
+        self.metrics.node_disconnected()
+        self.liveness.forget(host_name)
+        self.delete_node(host_name)
         client.close()
 
         if self.debug:
             print(datetime.now(), "Client disconnected", host_name)
-
-        return False
     
     """
     Generic functions
     """
     
+    def open_state(self, db, persistent, cache_size):
+        """
+        Opens the database, block index and response cache the requests are answered from
+        """
+        self.db = DB_manager(db, self.debug, persistent)
+        self.index = Block_index()
+        self.cache = Response_cache(cache_size)
+        self.snapshot_file = os.path.splitext(db)[0] + ".snapshot"
+        
+        # warm restart: nodes stored by a previous run are kept until stale_timeout;
+        # the ones that reconnect in the meantime keep their blocks without sending a full update
+        if persistent:
+            self.load_index()
+            
+            if self.snapshot_interval:
+                self.snapshots = Snapshot_writer(
+                    self.snapshot_file, self.db, self.index, self.updates, self.snapshot_interval, self.debug
+                )
+                self.snapshots.start()
+    
+    def load_index(self):
+        """
+        Restores the index from the snapshot if it matches the database, otherwise reads every block range
+        """
+        if self.snapshot_interval and self.restore_snapshot():
+            return
+        
+        # the marker is stale if the snapshot it names could not be read
+        if self.db.snapshot_id is not None:
+            self.db.clear_snapshot_marker()
+        
+        n_rows, status_db = self.db.get_block_ranges(self.index.load)
+        if status_db == status.SUCCESS.value:
+            files, _ = self.db.get_files()
+            self.index.load_names(files or ())
+            
+        if self.debug:
+            print(datetime.now(), "Loaded %d block ranges from the database" % n_rows)
+            
+    def restore_snapshot(self):
+        if self.db.snapshot_id is None:
+            return False
+        
+        start = time.perf_counter()
+        try:
+            snapshot_id, files, entries = read_snapshot(self.snapshot_file)
+        except (OSError, Snapshot_error) as e:
+            if self.debug:
+                print(datetime.now(), "Snapshot not used:", e)
+            return False
+        
+        if snapshot_id != self.db.snapshot_id:
+            if self.debug:
+                print(datetime.now(), "Snapshot not used: the database changed since it was written")
+            return False
+        
+        self.index.restore(entries, files)
+        
+        if self.debug:
+            print(datetime.now(), "Restored the index from %s in %.3f s" % (self.snapshot_file, time.perf_counter() - start))
+        return True
+            
+    def node_connected(self, host_name):
+        if self.debug:
+            print(datetime.now(), "Client connected", host_name)
+        self.metrics.node_connected()
+        self.db.touch_node(host_name)
+        
+    def expire_stale_nodes(self):
+        """
+        Removes the nodes stored by a previous run that did not reconnect in time
+        """
+        self.stale_nodes_expired = True
+        with self.updates:
+            host_names, _ = self.db.expire_nodes(self.start_time)
+            for host_name in host_names:
+                file_hashes = self.index.get_node_file_hashes(host_name)
+                self.index.delete_node(host_name)
+                self.invalidate_cache(file_hashes)
+            
+        if self.debug:
+            print(datetime.now(), "Expired %d stale node(s)" % len(host_names))
+    
+    def delete_node(self, host_name):
+        with self.updates:
+            file_hashes = self.index.get_node_file_hashes(host_name)
+            self.index.delete_node(host_name)
+            start = time.perf_counter()
+            result = self.db.delete_node(host_name)
+            self.metrics.add(DB, start)
+        self.invalidate_cache(file_hashes)
+        return result
+    
+    def delete_nodes(self, host_names):
+        file_hashes = set()
+        with self.updates:
+            for host_name in host_names:
+                file_hashes.update(self.index.get_node_file_hashes(host_name))
+                self.index.delete_node(host_name)
+            start = time.perf_counter()
+            result = self.db.delete_nodes(host_names)
+            self.metrics.add(DB, start)
+        self.invalidate_cache(file_hashes)
+        return result
+    
+    def evict_nodes(self, host_names):
+        """
+        Removes the nodes that stopped sending heartbeats (called by the liveness table, one batch per tick);
+        their connections are kept, a node that comes back is told to announce its blocks again
+        """
+        self.delete_nodes(host_names)
+        
+        if self.debug:
+            print(datetime.now(), "Evicted", ", ".join(host_names))
+    
+    def invalidate_cache(self, file_hashes, file_names=()):
+        """
+        Drops the cached responses that depend on the given files
+        """
+        tags = [("hash", file_hash) for file_hash in file_hashes]
+        tags.extend(("name", file_name) for file_name in file_names)
+        self.cache.invalidate(tags)
+    
+    def stats(self):
+        """
+        Metrics snapshot served by the stats socket / dump file
+        """
+        snapshot = self.metrics.snapshot()
+        snapshot["cache"] = self.cache.stats()
+        snapshot["liveness"] = self.liveness.stats()
+        if self.snapshots is not None:
+            snapshot["snapshots"] = self.snapshots.stats()
+        return snapshot
+    
+    def send(self, client, data):
+        start = time.perf_counter()
+        client.sendall(data)
+        self.metrics.add(SOCKET, start)
+        self.metrics.bytes_out += len(data)
+    
+    def flush(self, client):
+        start = time.perf_counter()
+        client.flush()
+        self.metrics.add(SOCKET, start)
+    
     def send_response(self, client, status, counter):
         try:
-            flat_data = []
-            format_string = "!BBH"
-            flat_data.extend([action.RESPONSE.value, status, counter])
-            client.sendall(struct.pack(format_string, *flat_data))
+            self.send(client, codec.encode_response(status, counter))
             if self.debug:
                 print(datetime.now(), "-> Response sent to client")
         except Exception as e:
@@ -153,122 +420,226 @@ class FS_Tracker(Thread):
     Functions to handle requests
     """
     
-    def receive_file_hash(self, client):
-        file_hash_lenght = struct.unpack("!H", client.recv(2))[0]
-        file_hash_data = client.recv(file_hash_lenght)
-        file_hash = struct.unpack("!%ds" % file_hash_lenght, 
-                                    file_hash_data)[0].hex()
-        return file_hash
-    
-    def receive_file_name(self, client):
-        file_name_length = struct.unpack("!B", client.recv(1))[0]
-        file_name = struct.unpack("!%ds" % file_name_length,
-                                    client.recv(file_name_length))[0].decode("utf-8")
-        return file_name
-    
-    def handle_update_aux(self, client):
-        file_hash = self.receive_file_hash(client)
-        file_name = self.receive_file_name(client)
-        n_block_sets = struct.unpack("!B", client.recv(1))[0]
-        return file_hash, file_name, n_block_sets
-        
-    def handle_update_full_request(self, client, host_name, counter):
-        n_files = struct.unpack("!H", client.recv(2))[0]
+    def handle_update_full_request(self, client, reader, host_name, counter):
+        files = codec.decode_update_full_request(reader)
+        
+        with self.updates:
+            start = time.perf_counter()
+            status_db = self.db.update_node_full_files(host_name, files)
+            self.metrics.add(DB, start)
+            if status_db == status.SUCCESS.value:
+                self.index.update_node_full_files(host_name, files)
+                self.invalidate_cache(
+                    [file_hash for file_hash, _, _ in files],
+                    [file_name for _, file_name, _ in files]
+                )
+        
+        self.send_response(client, status_db, counter)
+
+    def handle_update_partial_request(self, client, reader, host_name, counter):
         files = []
         
-        for _ in range(n_files):
-            file_hash, file_name, n_block_sets = self.handle_update_aux(client)
-            block_sets_data = []
+        for file_hash, file_name, block_sets in codec.decode_update_partial_request(reader):
+            block_sets_data = [
+                (block_size, last_block_size, join_blocks(sequences, blocks))
+                for block_size, last_block_size, sequences, blocks in block_sets
+            ]
+            files.append((file_name, file_hash, block_sets_data))
+                    
+        with self.updates:
+            start = time.perf_counter()
+            status_db = self.db.update_node_partial_files(host_name, files)
+            self.metrics.add(DB, start)
+            if status_db == status.SUCCESS.value:
+                self.index.update_node_partial_files(host_name, files)
+                self.invalidate_cache(
+                    [file_hash for _, file_hash, _ in files],
+                    [file_name for file_name, _, _ in files]
+                )
+
+        self.send_response(client, status_db, counter)
+        
+    def decode_block_delta_request(self, reader):
+        # intervals sorted, like the other updates hand them to the database and the index
+        return [
+            (file_hash, file_name, [
+                (block_size, last_block_size, sorted(intervals))
+                for block_size, last_block_size, intervals in block_sets
+            ])
+            for file_hash, file_name, block_sets in codec.decode_block_delta_request(reader)
+        ]
+        
+    def handle_add_blocks_request(self, client, reader, host_name, counter):
+        files = self.decode_block_delta_request(reader)
+        
+        with self.updates:
+            start = time.perf_counter()
+            status_db = self.db.add_node_block_ranges(host_name, files)
+            self.metrics.add(DB, start)
+            if status_db == status.SUCCESS.value:
+                self.index.add_block_ranges(host_name, files)
+                self.invalidate_cache(
+                    [file_hash for file_hash, _, _ in files],
+                    [file_name for _, file_name, _ in files]
+                )
             
-            for _ in range(n_block_sets):
-                block_size, last_block_size, n_blocks = struct.unpack("!HHH", client.recv(2+2+2))
-                block_sets_data.append((block_size, last_block_size, n_blocks))
+        self.send_response(client, status_db, counter)
+        
+    def handle_remove_blocks_request(self, client, reader, host_name, counter):
+        files = self.decode_block_delta_request(reader)
+        
+        with self.updates:
+            start = time.perf_counter()
+            status_db = self.db.remove_node_block_ranges(host_name, files)
+            self.metrics.add(DB, start)
+            if status_db == status.SUCCESS.value:
+                self.index.remove_block_ranges(host_name, files)
+                # cached LOCATE_NAME responses are also tagged with the hashes they list
+                self.invalidate_cache([file_hash for file_hash, _, _ in files])
             
-            files.append((file_hash, file_name, block_sets_data))
+        self.send_response(client, status_db, counter)
         
-        status = self.db.update_node_full_files(host_name, files)
+    def handle_heartbeat_request(self, client, reader, host_name, counter):
+        # NOT_FOUND: the node was evicted since its last heartbeat and its blocks are gone
+        alive = self.liveness.heartbeat(host_name)
+        self.send_response(client, status.SUCCESS.value if alive else status.NOT_FOUND.value, counter)
         
-        self.send_response(client, status, counter)
-
-    def handle_update_partial_request(self, client, host_name, counter):
-        n_files = struct.unpack("!H", client.recv(2))[0]
-        files = []
+    def handle_locate_name_request(self, client, reader, host_name, counter):
+        file_name = codec.decode_locate_name_request(reader)
         
-        for _ in range(n_files):
-            file_hash, file_name, n_block_sets = self.handle_update_aux(client)
-            block_sets_data = []
-            
-            for _ in range(n_block_sets):
-                block_size, last_block_size, n_sequences = struct.unpack("!HHB", client.recv(2+2+1))
-                
-                sequences = []
-                for _ in range(n_sequences):
-                    first, last = struct.unpack("!HH", client.recv(2+2))
-                    sequences.append((first, last))
-                
-                n_blocks = struct.unpack("!H", client.recv(2))[0]
+        key = ("name", file_name, host_name)
+        body = self.cache.get(key)
+        
+        if body is None:
+            epoch = self.cache.begin()
+            try:
+                start = time.perf_counter()
+                results, status_db = self.db.locate_file_name(file_name, host_name)
+                self.metrics.add(DB, start)
+                        
+                if status_db != status.SUCCESS.value:
+                    self.send_response(client, status_db, counter)
+                    return
                 
-                blocks = []
-                for _ in range(n_blocks):
-                    blocks.append(struct.unpack("!H", client.recv(2))[0])
-                    
-                blocks = join_blocks(sequences, blocks)
+                start = time.perf_counter()
+                body = self.encode_locate_name_body(results)
+                self.metrics.add(ENCODE, start)
                 
-                block_sets_data.append((block_size, last_block_size, blocks))
-            
-            files.append((file_name, file_hash, block_sets_data))
-                    
-        status = self.db.update_node_partial_files(host_name, files)
-
-        self.send_response(client, status, counter)
+                # the response changes if a file gets this name or if a node with one of the hashes changes
+                tags = [("name", file_name)] + [("hash", file_hash) for file_hash, _ in results]
+                self.cache.put(key, body, tags, epoch)
+            finally:
+                self.cache.end(epoch)
         
-    def handle_locate_name_request(self, client, host_name, counter):
-        file_name = self.receive_file_name(client)
-                
-        results, status_db = self.db.locate_file_name(file_name, host_name)
+        self.send(client, body + codec.encode_counter(counter))
+        
+        if self.debug:
+            print(datetime.now(), "-> Response sent to client")
+        
+    def handle_locate_hash_request(self, client, reader, host_name, counter):
+        file_hash = codec.decode_locate_hash_request(reader)
+        
+        key = ("hash", file_hash, host_name)
+        body = self.cache.get(key)
+        
+        if body is None:
+            epoch = self.cache.begin()
+            try:
+                # answered from the in-memory index, the database is only the durable store
+                # (the lookup is still accounted as db time)
+                start = time.perf_counter()
+                results = self.index.locate_file_hash(file_hash, host_name)
+                self.metrics.add(DB, start)
                 
-        if status_db != status.SUCCESS.value:
-            self.send_response(client, status, counter)
-            return
+                start = time.perf_counter()
+                body = self.encode_locate_hash_body(results)
+                self.metrics.add(ENCODE, start)
+                self.cache.put(key, body, [("hash", file_hash)], epoch)
+            finally:
+                self.cache.end(epoch)
         
-        response = self.encode_locate_name_response(results, counter)
-        client.sendall(response)
+        self.send(client, body + codec.encode_counter(counter))
         
         if self.debug:
             print(datetime.now(), "-> Response sent to client")
         
-    def handle_locate_hash_request(self, client, host_name, counter):
-        file_hash = self.receive_file_hash(client)
+    def handle_locate_hash_batch_request(self, client, reader, host_name, counter):
+        file_hashes = codec.decode_locate_hash_batch_request(reader)
+        
+        # the bodies are the ones LOCATE_HASH caches; the misses are looked up together
+        bodies = {}
+        misses = []
+        for file_hash in dict.fromkeys(file_hashes):
+            body = self.cache.get(("hash", file_hash, host_name))
+            if body is None:
+                misses.append(file_hash)
+            else:
+                bodies[file_hash] = body
+                
+        if misses:
+            epoch = self.cache.begin()
+            try:
+                start = time.perf_counter()
+                all_results = self.index.locate_file_hashes(misses, host_name)
+                self.metrics.add(DB, start)
+                
+                start = time.perf_counter()
+                for file_hash, results in zip(misses, all_results):
+                    body = bodies[file_hash] = self.encode_locate_hash_body(results)
+                    self.cache.put(("hash", file_hash, host_name), body, [("hash", file_hash)], epoch)
+                self.metrics.add(ENCODE, start)
+            finally:
+                self.cache.end(epoch)
+        
+        # one entry per requested hash, in order; the writer sends them in chunks as they are added
+        self.send(client, codec.encode_locate_hash_batch_header(len(file_hashes)))
+        for file_hash in file_hashes:
+            self.send(client, codec.encode_locate_hash_batch_entry(file_hash, bodies[file_hash]))
+        self.send(client, codec.encode_counter(counter))
+        
+        if self.debug:
+            print(datetime.now(), "-> Response sent to client")
         
-        results, status_db = self.db.locate_file_hash(file_hash, host_name)
+    def handle_search_name_request(self, client, reader, host_name, counter):
+        query, mode, limit = codec.decode_search_name_request(reader)
         
-        if status_db != status.SUCCESS.value:
-            self.send_response(client, status, counter)
+        if mode not in [m.value for m in search_mode]:
+            self.send_response(client, status.INVALID_REQUEST.value, counter)
             return
         
-        response = self.encode_locate_hash_response(results, counter)
-        client.sendall(response)
+        # not cached: any announced name can change the results of a prefix or substring query
+        start = time.perf_counter()
+        results = self.index.search_file_names(query, mode, host_name, limit)
+        self.metrics.add(DB, start)
+        
+        start = time.perf_counter()
+        body = codec.encode_search_name_body(results)
+        self.metrics.add(ENCODE, start)
+        
+        self.send(client, body + codec.encode_counter(counter))
         
         if self.debug:
             print(datetime.now(), "-> Response sent to client")
         
-    def handle_check_status_request(self, client, host_name, counter):
+    def handle_check_status_request(self, client, reader, host_name, counter):
         
-        host_name_length = struct.unpack("!B", client.recv(1))[0]
-        host_name = struct.unpack("!%ds" % host_name_length, 
-                                  client.recv(host_name_length))[0].decode("utf-8")
+        host_name = codec.decode_check_status_request(reader)
         
+        start = time.perf_counter()
         result, status_db = self.db.get_node_status(host_name)
+        self.metrics.add(DB, start)
                 
         encoded_response = self.encode_check_status_response(status_db, result, counter)
-        client.sendall(encoded_response)
+        self.send(client, encoded_response)
         
         if self.debug:
             print(datetime.now(), "-> Response sent to client")
         
-    def handle_update_status_request(self, client, host_name, counter):
-        status = struct.unpack("!B", client.recv(1))[0]
+    def handle_update_status_request(self, client, reader, host_name, counter):
+        status = codec.decode_update_status_request(reader)
+        start = time.perf_counter()
         result = self.db.update_node_status(host_name, status)
+        self.metrics.add(DB, start)
         self.send_response(client, result, counter)
         
         if self.debug:
@@ -278,117 +649,181 @@ class FS_Tracker(Thread):
     Functions to encode responses
     """
     
-    def encode_locate_name_response(self, results, counter):
-                
-        host_name_dict = {host_name: i for i, (_, host_name) in enumerate(results, start=1)}
-        host_name_dict_len = len(host_name_dict)
-        hash_dict = {file_hash: [] for file_hash, _ in results}
+    def encode_locate_name_body(self, results):  # response without the counter
+        return codec.encode_locate_name_body(results)
 
-        for file_hash, host_name in results:
-            hash_dict[file_hash].append(host_name)    
+    def encode_locate_hash_body(self, results):  # response without the counter
+        return codec.encode_locate_hash_body(results)
+    
+    def encode_check_status_response(self, status_db, result, counter):
+        return codec.encode_check_status_response(status_db, result, counter)
         
-        format_string = "!BH"
-        flat_data = [action.RESPONSE_LOCATE_NAME.value, host_name_dict_len]
-            
-        for host_name in host_name_dict.keys():
-            host_name_length = len(host_name)
-            format_string += "B%ds" % host_name_length
-            flat_data.extend([host_name_length, host_name.encode("utf-8")])
-            
-        n_hashes = len(hash_dict)
-        format_string += "H"
-        flat_data.append(n_hashes)
+class Client_connection:
+    """
+    State of a node connection served by an event loop: a non-blocking socket, the request being
+    received (reader) and the responses the socket did not take yet (writer)
+    """
+    def __init__(self, client, host_name):
+        client.setblocking(False)
+        self.client = client
+        self.reader = Nonblocking_socket_reader(client)
+        self.writer = Nonblocking_socket_writer(client)
+        self.host_name = host_name
+        self.counter = 0
+        self.updated = time.time()
+        self.events = selectors.EVENT_READ
+
+
+class Tracker_event_loop(Thread):
+    """
+    Serves many node connections on a single thread with a selector; a request is only handed to
+    the tracker's handlers once all of it was received, and the responses are sent as the sockets
+    become writable, so a slow node never holds up the others
+    """
+    def __init__(self, tracker, select_timeout=1, max_pending_output=1024*1024):
+        self.tracker = tracker
+        self.debug = tracker.debug
+        self.select_timeout = select_timeout
+        self.max_pending_output = max_pending_output  # a node that does not read its responses is not read from either
+        self.selector = selectors.DefaultSelector()
+        self.pending_clients = Queue()
+        self.connections = {}
+        self.done = False
         
-        for file_hash, host_names in hash_dict.items():
-            file_hash_bytes = bytes.fromhex(file_hash)
-            file_hash_len = len(file_hash_bytes)
-            format_string += "B%dsH" % file_hash_len
-            flat_data.extend([file_hash_len, file_hash_bytes, len(host_names)])
-            
-            for host_name in host_names:
-                format_string += "H"
-                flat_data.append(host_name_dict[host_name])
-                
-        format_string += "H"
-        flat_data.append(counter)
+        # the accept thread wakes the loop up through this pair of sockets
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.wakeup_sender.setblocking(False)
+        self.selector.register(self.wakeup_receiver, selectors.EVENT_READ, data=None)
         
-        return struct.pack(format_string, *flat_data)
-    
-    def encode_locate_hash_response(self, results, counter):
+        Thread.__init__(self, daemon=True)
         
-        format_string = "!B"
-        flat_data = [action.RESPONSE_LOCATE_HASH.value]
+    def add_client(self, client, host_name):  # called from other threads
+        self.tracker.node_connected(host_name)
+        self.pending_clients.put(Client_connection(client, host_name))
+        self.wakeup()
         
-        host_names = {}
+    def wakeup(self):
+        try:
+            self.wakeup_sender.send(b"\0")
+        except OSError:
+            pass  # buffer full, the loop is already awake
         
-        # organize results by host name and division size
-        for result in results:
-            host_name, block_size, block_number, division_size, is_last = result
-            
-            if host_names.get(host_name) is None:
-                host_names[host_name] = {}
-                
-            if host_names[host_name].get(division_size) is None:
-                host_names[host_name][division_size] = []
-                
-            host_names[host_name][division_size].append((block_size, block_number, is_last))
+    def stop(self):
+        self.done = True
+        self.wakeup()
         
-        # host_name => (division_size => (division_size, last_block_size, is_full_file, block_numbers))
-        new_host_names = {}
+    def run(self):
+        while not self.done:
+            events = self.selector.select(timeout=self.select_timeout)
             
-        for host_name, division_size_dict in host_names.items():
-            for division_size, block_list in division_size_dict.items():
-                
-                sorted(block_list, key=lambda x: x[1])
-                
-                block_list_length = len(block_list)
-                last_block = block_list[-1]
-                
-                if block_list_length == last_block[1]:
-                    if new_host_names.get(host_name) is None:
-                        new_host_names[host_name] = []
-                    new_host_names[host_name].append((division_size, last_block[0], last_block[1], []))
-                    
+            for key, mask in events:
+                if key.data is None:
+                    self.register_pending_clients()
                 else:
-                    block_numbers = [block[1] for block in block_list]
+                    self.serve(key.data, mask)
                     
-                    if new_host_names.get(host_name) is None:
-                        new_host_names[host_name] = []
-                    new_host_names[host_name].append((division_size, last_block[0], 0, block_numbers))
-                            
-        n_host_names = len(new_host_names)
+            self.close_idle_connections()
+            
+        for conn in list(self.connections.values()):
+            self.close(conn)
+        self.selector.close()
+        self.wakeup_receiver.close()
+        self.wakeup_sender.close()
+            
+    def register_pending_clients(self):
+        try:
+            while self.wakeup_receiver.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
         
-        format_string += "H"
-        flat_data.append(n_host_names)
+        while True:
+            try:
+                conn = self.pending_clients.get_nowait()
+            except queue.Empty:
+                break
+            self.connections[conn.client.fileno()] = conn
+            self.selector.register(conn.client, conn.events, data=conn)
+            
+    def serve(self, conn, mask):
+        conn.updated = time.time()
+        leave = False
         
-        for host_name, division_size_dict in new_host_names.items():
+        try:
+            if mask & selectors.EVENT_WRITE:
+                conn.writer.send_pending()
+            if mask & selectors.EVENT_READ:
+                conn.reader.receive()
+                
+            leave = self.handle_requests(conn)
+            
+            if not leave:
+                self.tracker.flush(conn.writer)
+                leave = conn.reader.closed
+                
+        except Exception as e:
+            if self.debug:
+                print("[Tracker_event_loop]", datetime.now(), f"Exception: {type(e).__name__}")
+                print("Error message:", e)
+                print("Traceback:")
+                traceback.print_exc()
+                print("Host name:", conn.host_name, '\n')
+            leave = True
             
-            host_name_length = len(host_name)
-            sets_len = len(division_size_dict)
-            format_string += "B%dsB" % host_name_length
-            flat_data.extend([host_name_length, host_name.encode("utf-8"), sets_len])
+        if leave:
+            self.close(conn)
+        else:
+            self.update_events(conn)
             
-            for division_size, last_block_size, full_file, block_numbers in division_size_dict:
-
-                format_string += "HHH"
-                flat_data.extend([division_size, last_block_size, full_file])
-
-                if full_file == 0:
-                    format_string += "H"
-                    format_string += "H" * len(block_numbers)
-                    flat_data.append(len(block_numbers))
-                    flat_data.extend(block_numbers)
-                    
-        format_string += "H"
-        flat_data.append(counter)
+    def handle_requests(self, conn):
+        """
+        Handles the requests received in full; returns True if the connection should be closed
+        """
+        reader = conn.reader
         
-        return struct.pack(format_string, *flat_data)
-    
-    def encode_check_status_response(self, status_db, result, counter):
-        if result is None:
-            return struct.pack("!BBBH", action.RESPONSE_CHECK_STATUS.value, status_db, 0, counter)
-        return struct.pack("!BBBH", action.RESPONSE_CHECK_STATUS.value, status_db, result, counter)
+        while reader.has_message() and conn.writer.pending_size < self.max_pending_output:
+            try:
+                decoded_byte = reader.read_action()
+                counter = codec.next_counter(conn.counter)
+                leave = self.tracker.handle_request(conn.writer, reader, conn.host_name, decoded_byte, counter)
+            except Incomplete_message:
+                # decoded again from its action byte when more of it arrives
+                reader.rewind()
+                break
+            
+            conn.counter = counter
+            if leave:
+                return True
+            
+        return False
+            
+    def update_events(self, conn):
+        # reading stops while too many responses are waiting, writing is only watched while some are
+        events = 0
+        if conn.writer.pending_size < self.max_pending_output:
+            events |= selectors.EVENT_READ
+        if conn.writer.pending:
+            events |= selectors.EVENT_WRITE
+            
+        if events != conn.events:
+            conn.events = events
+            self.selector.modify(conn.client, events, data=conn)
+            
+    def close(self, conn):
+        self.selector.unregister(conn.client)
+        self.connections.pop(conn.client.fileno(), None)
+        self.tracker.disconnect_client(conn.client, conn.host_name)
+            
+    def close_idle_connections(self):
+        now = time.time()
+        for conn in list(self.connections.values()):
+            if now - conn.updated > self.tracker.timeout:
+                if self.debug:
+                    print(datetime.now(), "Connection timed out", conn.host_name)
+                self.close(conn)
         
+
 """
 Function to parse command line arguments
 """
@@ -401,6 +836,18 @@ def parse_args():
         parser.add_argument('-db','--db',  default="db.sqlite3", help='Database file name')
         parser.add_argument('-m', '--max', type=int, default=5, help='Maximum number of connections')
         parser.add_argument('-t', '--timeout', type=int, default=60*10, help='Timeout for connections')
+        parser.add_argument('-M', '--mode', choices=["thread", "selectors"], default="thread", help='Serving mode: one thread per node or event loops')
+        parser.add_argument('-l', '--loops', type=int, default=1, help='Number of event loops (selectors mode)')
+        parser.add_argument('-r', '--resolvers', type=int, default=4, help='Number of threads resolving host names')
+        parser.add_argument('-P', '--persistent', default=False, action='store_true', help='Keep the database between runs')
+        parser.add_argument('-s', '--stale_timeout', type=int, default=60, help='Seconds stored nodes have to reconnect after a restart')
+        parser.add_argument('-c', '--cache_size', type=int, default=64, help='Size of the locate response cache in MiB')
+        parser.add_argument('-S', '--shards', type=int, default=1, help='Number of tracker processes sharing the file hashes')
+        parser.add_argument('--stats_port', type=int, default=None, help='Local port serving a JSON metrics snapshot')
+        parser.add_argument('--stats_file', default=None, help='File the JSON metrics snapshot is periodically written to')
+        parser.add_argument('--stats_interval', type=int, default=10, help='Seconds between metrics dumps')
+        parser.add_argument('--liveness_timeout', type=float, default=6, help='Seconds without heartbeats before a node is evicted')
+        parser.add_argument('--snapshot_interval', type=float, default=60, help='Seconds between snapshots of the index (persistent mode, 0 disables them)')
     
         return parser.parse_args()
     except argparse.ArgumentError as e:
@@ -413,8 +860,33 @@ if __name__ == "__main__":
     print(f"Running {file_name}")
     
     args = parse_args()
-        
-    tracker = FS_Tracker(db=args.db, port=args.port, debug=args.debug, max_connections=args.max, timeout=args.timeout)
+    
+    tracker_class = FS_Tracker
+    tracker_args = {}
+    if args.shards > 1:
+        from sharded_tracker import FS_Sharded_tracker
+        tracker_class = FS_Sharded_tracker
+        tracker_args["n_shards"] = args.shards
+        
+    tracker = tracker_class(
+        db=args.db,
+        port=args.port,
+        debug=args.debug,
+        max_connections=args.max,
+        timeout=args.timeout,
+        mode=args.mode,
+        n_loops=args.loops,
+        n_resolvers=args.resolvers,
+        persistent=args.persistent,
+        stale_timeout=args.stale_timeout,
+        cache_size=args.cache_size*1024*1024,
+        stats_port=args.stats_port,
+        stats_file=args.stats_file,
+        stats_interval=args.stats_interval,
+        liveness_timeout=args.liveness_timeout,
+        snapshot_interval=args.snapshot_interval,
+        **tracker_args
+    )
     
     try:
         tracker.run()
@@ -0,0 +1,128 @@
+import math
+import time
+import threading
+from datetime import datetime
+
+"""
+Node liveness.
+
+Nodes that send HEARTBEAT requests are kept in a timer wheel; the ones that stay silent for longer
+than the timeout are evicted together, once per tick, so a burst of dead nodes costs one
+database transaction instead of one per node. Nodes that never sent a heartbeat are not tracked
+(they are only removed when their connection ends, as before).
+"""
+
+class Timer_wheel:
+    """
+    Deadlines rounded to ticks in a ring of slots: scheduling, rescheduling and expiring a key are O(1)
+    """
+    def __init__(self, timeout, tick=1.0, now=0.0):
+        self.tick = tick
+        self.timeout_ticks = max(1, int(math.ceil(timeout / tick)))
+        # one slot more than the furthest deadline, so a slot only holds keys of one deadline
+        self.slots = [set() for _ in range(self.timeout_ticks + 1)]
+        self.deadlines = {}  # key -> tick of its deadline
+        self.current = int(now / tick)
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def schedule(self, key, now):
+        deadline = int(now / self.tick) + self.timeout_ticks
+        old_deadline = self.deadlines.get(key)
+        if old_deadline == deadline:
+            return
+
+        if old_deadline is not None:
+            self.slots[old_deadline % len(self.slots)].discard(key)
+        self.slots[deadline % len(self.slots)].add(key)
+        self.deadlines[key] = deadline
+
+    def remove(self, key):
+        deadline = self.deadlines.pop(key, None)
+        if deadline is not None:
+            self.slots[deadline % len(self.slots)].discard(key)
+
+    def advance(self, now):
+        """
+        Moves the wheel to the current time; returns the keys whose deadline passed
+        """
+        expired = []
+        target = int(now / self.tick)
+
+        # after a long pause every slot has expired once, there is no need to go around again
+        if target - self.current > len(self.slots):
+            self.current = target - len(self.slots)
+
+        while self.current < target:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            # a key scheduled while the wheel was behind can sit in a slot one turn early
+            for key in [key for key in slot if self.deadlines[key] <= self.current]:
+                expired.append(key)
+                slot.discard(key)
+                del self.deadlines[key]
+
+        return expired
+
+
+class Liveness_table(threading.Thread):
+    """
+    Host names of the nodes sending heartbeats; every tick, the ones silent for longer than timeout
+    are passed to evict in a single call
+    """
+    def __init__(self, evict, timeout=6, tick=1.0, debug=False):
+        threading.Thread.__init__(self, daemon=True, name="liveness")
+        self.evict = evict
+        self.tick = tick
+        self.debug = debug
+        self.wheel = Timer_wheel(timeout, tick, time.monotonic())
+        self.evicted = set()  # evicted nodes that did not send a heartbeat since
+        self.evicting = set()  # nodes of the eviction in progress, not forgotten meanwhile
+        self.n_evicted = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def heartbeat(self, host_name):
+        """
+        Returns False if the node was evicted since its previous heartbeat (it has to announce its blocks again)
+        """
+        with self.lock:
+            self.wheel.schedule(host_name, time.monotonic())
+            if host_name in self.evicted:
+                self.evicted.discard(host_name)
+                return False
+            return True
+
+    def forget(self, host_name):  # the node left or its connection ended
+        with self.lock:
+            self.wheel.remove(host_name)
+            self.evicted.discard(host_name)
+            self.evicting.discard(host_name)
+
+    def run(self):
+        while not self.stopped.wait(self.tick):
+            with self.lock:
+                expired = self.wheel.advance(time.monotonic())
+                self.evicting.update(expired)
+
+            if expired:
+                if self.debug:
+                    print(datetime.now(), "Evicting %d node(s) without heartbeats" % len(expired))
+                self.evict(expired)
+                
+                # only now: a node told earlier would announce its blocks again before they are deleted,
+                # and the ones that sent a heartbeat meanwhile are told by their next one
+                with self.lock:
+                    self.evicted.update(self.evicting)
+                    self.evicting.clear()
+                    self.n_evicted += len(expired)
+
+    def stop(self):
+        self.stopped.set()
+
+    def stats(self):
+        return {"tracked_nodes": len(self.wheel), "evicted_nodes": self.n_evicted}
@@ -0,0 +1,386 @@
+import sys
+import os
+import time
+import random
+import socket
+import hashlib
+import argparse
+import selectors
+import tempfile
+import multiprocessing
+from collections import deque
+from utils import action, status, search_mode, Socket_reader
+import codec
+
+"""
+Synthetic load for FS_Tracker: many simulated nodes, each from its own loopback address
+(127.x.y.z, so the tracker sees distinct hosts), speak the real protocol through the same
+codec functions FS_Node uses. Every node keeps -P requests in flight (closed loop, pipelined
+when more than one); the requests follow a weighted mix and a seeded random sequence, so runs are repeatable.
+"""
+
+ACTIONS = {
+    "update_full": action.UPDATE_FULL_FILES,
+    "update_partial": action.UPDATE_PARTIAL,
+    "locate_hash": action.LOCATE_HASH,
+    "locate_hash_batch": action.LOCATE_HASH_BATCH,
+    "locate_name": action.LOCATE_NAME,
+    "search_name": action.SEARCH_NAME,
+    "add_blocks": action.ADD_BLOCKS,
+    "remove_blocks": action.REMOVE_BLOCKS,
+    "heartbeat": action.HEARTBEAT,
+    "leave": action.LEAVE,
+}
+
+class Catalog:
+    """
+    Files shared by the simulated nodes; the same seed gives the same files
+    """
+    def __init__(self, n_files, n_blocks, division_size, seed):
+        self.n_blocks = n_blocks
+        self.division_size = division_size
+        self.files = [
+            (hashlib.sha1(b"%d:%d" % (seed, i)).hexdigest(), "file_%d" % i)
+            for i in range(n_files)
+        ]
+
+
+class Simulated_node:
+    """
+    Connection and state of one simulated node
+    """
+    def __init__(self, number, catalog, config, rng):
+        self.number = number
+        self.address = node_address(number)
+        self.catalog = catalog
+        self.config = config
+        self.rng = rng
+        self.files = rng.sample(catalog.files, min(config.files_per_node, len(catalog.files)))
+        self.socket = None
+        self.reader = None
+        self.pending = deque()  # (action name, start time) of the requests in flight, in order
+        self.leaving = False
+
+    def connect(self, tracker_address, port):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind((self.address, 0))
+        self.socket.connect((tracker_address, port))
+        self.socket.settimeout(30)
+        self.reader = Socket_reader(self.socket, buffer_size=4096)
+
+    def close(self):
+        self.socket.close()
+        self.socket = None
+        self.pending.clear()
+        self.leaving = False
+
+    def encode_request(self, name):
+        catalog = self.catalog
+        files = self.rng.sample(self.files, min(self.config.files_per_update, len(self.files)))
+        last_block_size = catalog.division_size // 2
+
+        if name == "update_full":
+            return codec.encode_update_full_request([
+                (file_hash, file_name, [(catalog.division_size, last_block_size, catalog.n_blocks)])
+                for file_hash, file_name in files
+            ])
+        elif name == "update_partial":
+            block_sets = []
+            for file_hash, file_name in files:
+                first = self.rng.randint(1, catalog.n_blocks)
+                last = min(catalog.n_blocks, first + self.rng.randint(0, 63))
+                blocks = sorted(self.rng.sample(range(1, catalog.n_blocks + 1), min(16, catalog.n_blocks)))
+                block_sets.append((file_hash, file_name, [(catalog.division_size, last_block_size, [(first, last)], blocks)]))
+            return codec.encode_update_partial_request(block_sets)
+        elif name in ("add_blocks", "remove_blocks"):
+            # a delta announcement: one range of blocks gained or lost in one file
+            file_hash, file_name = self.rng.choice(self.files)
+            first = self.rng.randint(1, catalog.n_blocks)
+            last = min(catalog.n_blocks, first + self.rng.randint(0, 63))
+            encode = codec.encode_add_blocks_request if name == "add_blocks" else codec.encode_remove_blocks_request
+            return encode([(file_hash, file_name, [(catalog.division_size, last_block_size, [(first, last)])])])
+        elif name == "locate_hash":
+            return codec.encode_locate_hash_request(self.rng.choice(catalog.files)[0])
+        elif name == "locate_hash_batch":
+            return codec.encode_locate_hash_batch_request([file_hash for file_hash, _ in self.rng.sample(catalog.files, self.config.batch)])
+        elif name == "locate_name":
+            return codec.encode_locate_name_request(self.rng.choice(catalog.files)[1])
+        elif name == "search_name":
+            # a prefix or a part of the number of a catalog name ("file_12" / "12")
+            file_name = self.rng.choice(catalog.files)[1]
+            if self.rng.random() < 0.5:
+                return codec.encode_search_name_request(file_name[:-1], search_mode.PREFIX.value, 20)
+            return codec.encode_search_name_request(file_name[5:], search_mode.SUBSTRING.value, 20)
+        elif name == "heartbeat":
+            return codec.encode_heartbeat_request()
+        else:
+            return codec.encode_leave_request()
+
+    def read_response(self):
+        """
+        Decodes the response to the request in flight; returns its status
+        """
+        decoded_byte = self.reader.read_action()
+
+        if decoded_byte is None:
+            raise ConnectionError("Tracker closed the connection")
+        elif decoded_byte == action.RESPONSE.value:
+            result_status, _ = codec.decode_response(self.reader)
+            return result_status
+        elif decoded_byte == action.RESPONSE_LOCATE_HASH.value:
+            codec.decode_locate_hash_response(self.reader)
+        elif decoded_byte == action.RESPONSE_LOCATE_NAME.value:
+            codec.decode_locate_name_response(self.reader)
+        elif decoded_byte == action.RESPONSE_LOCATE_HASH_BATCH.value:
+            codec.decode_locate_hash_batch_response(self.reader)
+        elif decoded_byte == action.RESPONSE_SEARCH_NAME.value:
+            codec.decode_search_name_response(self.reader)
+        elif decoded_byte == action.RESPONSE_CHECK_STATUS.value:
+            codec.decode_check_status_response(self.reader)
+        else:
+            raise ValueError("Unexpected response action %d" % decoded_byte)
+
+        return status.SUCCESS.value
+
+
+def node_address(number):
+    number += 1
+    return "127.%d.%d.%d" % (1 + (number >> 16), (number >> 8) & 255, number & 255)
+
+def parse_mix(mix):
+    """
+    "locate_hash=5,update_full=1" -> ([action names], [weights])
+    """
+    names, weights = [], []
+    for item in mix.split(","):
+        name, weight = item.split("=")
+        if name not in ACTIONS:
+            raise ValueError("Unknown action in mix: %s" % name)
+        names.append(name)
+        weights.append(float(weight))
+    return names, weights
+
+def raise_file_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+"""
+Load worker (one per process)
+"""
+
+def run_worker(worker, node_numbers, config, results):
+    raise_file_limit()
+
+    rng = random.Random(config.seed * 1000003 + worker)
+    catalog = Catalog(config.files, config.blocks, config.division_size, config.seed)
+    names, weights = parse_mix(config.mix)
+
+    latencies = {name: [] for name in ACTIONS}
+    errors = {name: 0 for name in ACTIONS}
+    selector = selectors.DefaultSelector()
+    nodes = [Simulated_node(number, catalog, config, random.Random(rng.random())) for number in node_numbers]
+
+    def send(node, name):
+        message = node.encode_request(name)
+        node.pending.append((name, time.perf_counter()))
+        node.socket.sendall(message)
+        # the tracker closes the connection after LEAVE, nothing goes after it
+        node.leaving = name == "leave"
+
+    def fill(node):
+        while len(node.pending) < config.pipeline and not node.leaving:
+            send(node, node.rng.choices(names, weights)[0])
+
+    def start(node):
+        node.connect(config.address, config.port)
+        selector.register(node.socket, selectors.EVENT_READ, node)
+        # a node announces its files before anything else, like FS_Node does when it starts
+        send(node, "update_full")
+        fill(node)
+
+    for node in nodes:
+        start(node)
+
+    # the clock starts once every node is connected
+    measuring_from = time.perf_counter() + config.warmup
+    deadline = time.perf_counter() + config.duration
+
+    while time.perf_counter() < deadline:
+        for key, _ in selector.select(timeout=1):
+            node = key.data
+
+            # responses come in the order of the requests; all of them that were received together are read
+            while True:
+                name, sent = node.pending.popleft()
+
+                try:
+                    result_status = node.read_response()
+                except (ConnectionError, OSError, ValueError):
+                    errors[name] += 1
+                    result_status = None
+
+                # requests sent during the warmup are not measured (the first ones wait for the
+                # tracker's reverse DNS lookup of each new address)
+                if sent >= measuring_from and result_status is not None:
+                    latencies[name].append(time.perf_counter() - sent)
+                    if result_status != status.SUCCESS.value:
+                        errors[name] += 1
+
+                if name == "leave" or result_status is None or not node.reader.buffered():
+                    break
+
+            if name == "leave" or result_status is None:
+                selector.unregister(node.socket)
+                node.close()
+                start(node)  # comes back as a new node with the same address
+            else:
+                fill(node)
+
+    for node in nodes:
+        if node.socket is not None:
+            node.close()
+
+    elapsed = max(deadline - measuring_from, 1e-9)
+    results.put((latencies, errors, elapsed))
+
+"""
+Report
+"""
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+def report(worker_results):
+    latencies = {name: [] for name in ACTIONS}
+    errors = {name: 0 for name in ACTIONS}
+    elapsed = max(result[2] for result in worker_results)
+
+    for worker_latencies, worker_errors, _ in worker_results:
+        for name in ACTIONS:
+            latencies[name].extend(worker_latencies[name])
+            errors[name] += worker_errors[name]
+
+    print("%15s %10s %10s %10s %10s %10s %8s" % ("action", "requests", "req/s", "p50 (ms)", "p99 (ms)", "max (ms)", "errors"))
+
+    all_latencies = []
+    for name in ACTIONS:
+        values = sorted(latencies[name])
+        all_latencies.extend(values)
+        if not values and not errors[name]:
+            continue
+        print("%15s %10d %10.0f %10.3f %10.3f %10.3f %8d" % (
+            name, len(values), len(values) / elapsed,
+            percentile(values, 0.5) * 1e3, percentile(values, 0.99) * 1e3, (values[-1] if values else 0) * 1e3,
+            errors[name]
+        ))
+
+    all_latencies.sort()
+    print("%15s %10d %10.0f %10.3f %10.3f %10.3f %8d" % (
+        "total", len(all_latencies), len(all_latencies) / elapsed,
+        percentile(all_latencies, 0.5) * 1e3, percentile(all_latencies, 0.99) * 1e3,
+        (all_latencies[-1] if all_latencies else 0) * 1e3, sum(errors.values())
+    ))
+
+"""
+Local tracker
+"""
+
+def run_tracker(config, db_file):
+    """
+    Body of the local tracker process (its own process, so it does not share the GIL with
+    the load and is simply terminated at the end)
+    """
+    from fs_tracker import FS_Tracker
+
+    raise_file_limit()
+    tracker = FS_Tracker(
+        db=db_file,
+        port=config.port,
+        max_connections=max(128, config.nodes),
+        mode=config.tracker_mode,
+        n_loops=config.tracker_loops,
+    )
+    tracker.run()
+
+def wait_for_tracker(config, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection((config.address, config.port), timeout=1).close()
+            return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+"""
+Function to parse command line arguments
+"""
+
+def parse_args():
+    try:
+        parser = argparse.ArgumentParser(description='FS Tracker load generator')
+        parser.add_argument('-a', '--address', default="127.0.0.1", help='Tracker address')
+        parser.add_argument('-p', '--port', type=int, default=9090, help='Tracker port')
+        parser.add_argument('-n', '--nodes', type=int, default=1000, help='Number of simulated nodes')
+        parser.add_argument('-w', '--workers', type=int, default=1, help='Number of load processes')
+        parser.add_argument('-P', '--pipeline', type=int, default=1, help='Requests each node keeps in flight')
+        parser.add_argument('-d', '--duration', type=float, default=10, help='Seconds of load (including the warmup)')
+        parser.add_argument('-W', '--warmup', type=float, default=2, help='Seconds before measurements start')
+        parser.add_argument('-m', '--mix', default="update_full=1,update_partial=2,locate_hash=10,locate_name=4,leave=0.1", help='Weights of each action')
+        parser.add_argument('-f', '--files', type=int, default=10000, help='Number of distinct files')
+        parser.add_argument('-F', '--files_per_node', type=int, default=20, help='Files owned by each node')
+        parser.add_argument('-u', '--files_per_update', type=int, default=5, help='Files sent in each UPDATE request')
+        parser.add_argument('-B', '--batch', type=int, default=100, help='Hashes in each LOCATE_HASH_BATCH request')
+        parser.add_argument('-b', '--blocks', type=int, default=1000, help='Blocks per file')
+        parser.add_argument('-D', '--division_size', type=int, default=512, help='Division (block) size')
+        parser.add_argument('-s', '--seed', type=int, default=1, help='Seed of the request sequence')
+        parser.add_argument('-L', '--local', default=False, action='store_true', help='Start a tracker on a temporary database in a child process')
+        parser.add_argument('-M', '--tracker_mode', choices=["thread", "selectors"], default="selectors", help='Serving mode of the local tracker')
+        parser.add_argument('-l', '--tracker_loops', type=int, default=1, help='Event loops of the local tracker')
+
+        return parser.parse_args()
+    except argparse.ArgumentError as e:
+        print(f"Error parsing command line arguments: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    config = parse_args()
+    parse_mix(config.mix)
+    raise_file_limit()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        context = multiprocessing.get_context("spawn")
+        tracker = None
+
+        if config.local:
+            tracker = context.Process(target=run_tracker, args=(config, os.path.join(tmp_dir, "load.sqlite3")), daemon=True)
+            tracker.start()
+            wait_for_tracker(config)
+
+        results = context.Queue()
+        workers = [
+            context.Process(target=run_worker, args=(i, range(i, config.nodes, config.workers), config, results))
+            for i in range(config.workers)
+        ]
+
+        for worker in workers:
+            worker.start()
+
+        worker_results = [results.get(timeout=config.duration + 60) for _ in workers]
+
+        for worker in workers:
+            worker.join()
+
+        report(worker_results)
+
+        if tracker is not None:
+            tracker.terminate()
+            tracker.join()
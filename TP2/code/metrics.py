@@ -0,0 +1,222 @@
+import os
+import json
+import socket
+import threading
+import time
+from datetime import datetime
+from utils import action
+
+"""
+Tracker metrics.
+
+Recording only updates counters and histogram buckets (no locks, no allocation), so counts may
+be slightly off under contention; everything else (percentiles, JSON) is computed when someone
+reads a snapshot through the stats socket or the dump file.
+"""
+
+# phases of a request; a request timer is [start, db, encode, socket]
+DB = 1
+ENCODE = 2
+SOCKET = 3
+
+class Histogram:
+    """
+    Durations in power-of-two microsecond buckets
+    """
+    n_buckets = 32
+
+    def __init__(self):
+        self.buckets = [0] * self.n_buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        bucket = int(seconds * 1e6).bit_length()
+        self.buckets[bucket if bucket < self.n_buckets else -1] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """
+        Upper bound, in microseconds, of the bucket holding the p-th fraction of the values
+        """
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return 1 << i
+        return 0
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_us": round(self.total / self.count * 1e6, 1) if self.count else 0,
+            "p50_us": self.percentile(0.5),
+            "p90_us": self.percentile(0.9),
+            "p99_us": self.percentile(0.99),
+            "max_us": round(self.max * 1e6, 1),
+        }
+
+
+class Action_metrics:
+    """
+    Latency of the requests of one action and the time they spent in each phase
+    """
+    def __init__(self):
+        self.latency = Histogram()
+        self.db = Histogram()
+        self.encode = Histogram()
+        self.socket = Histogram()
+
+    def summary(self):
+        return {
+            "latency": self.latency.summary(),
+            "db": self.db.summary(),
+            "encode": self.encode.summary(),
+            "socket": self.socket.summary(),
+        }
+
+
+class Tracker_metrics:
+    def __init__(self):
+        self.start_time = time.time()
+        self.actions = {a.value: Action_metrics() for a in action}
+        self.connected_nodes = 0
+        self.connections = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.local = threading.local()
+
+    def begin(self):
+        """
+        Starts timing the request handled by the calling thread
+        """
+        try:
+            timer = self.local.timer
+        except AttributeError:
+            timer = self.local.timer = [0.0, 0.0, 0.0, 0.0]
+        timer[0] = time.perf_counter()
+        timer[DB] = timer[ENCODE] = timer[SOCKET] = 0.0
+        return timer
+
+    def add(self, phase, start):
+        try:
+            self.local.timer[phase] += time.perf_counter() - start
+        except AttributeError:  # outside of a request (e.g. a disconnection)
+            pass
+
+    def end(self, action_value, timer):
+        metrics = self.actions.get(action_value)
+        if metrics is None:
+            return
+
+        metrics.latency.record(time.perf_counter() - timer[0])
+        if timer[DB]:
+            metrics.db.record(timer[DB])
+        if timer[ENCODE]:
+            metrics.encode.record(timer[ENCODE])
+        if timer[SOCKET]:
+            metrics.socket.record(timer[SOCKET])
+
+    def node_connected(self):
+        self.connected_nodes += 1
+        self.connections += 1
+
+    def node_disconnected(self):
+        self.connected_nodes -= 1
+
+    def snapshot(self):
+        uptime = time.time() - self.start_time
+        return {
+            "time": str(datetime.now()),
+            "uptime": round(uptime, 1),
+            "connected_nodes": self.connected_nodes,
+            "connections": self.connections,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "actions": {
+                action(value).name: dict(metrics.summary(), requests_per_second=round(metrics.latency.count / uptime, 2))
+                for value, metrics in self.actions.items()
+                if metrics.latency.count
+            },
+        }
+
+
+class Null_metrics(Tracker_metrics):
+    """
+    Metrics of a tracker nobody reads: the hooks do nothing
+    """
+    def begin(self):
+        return None
+
+    def add(self, phase, start):
+        pass
+
+    def end(self, action_value, timer):
+        pass
+
+
+class Stats_server(threading.Thread):
+    """
+    Sends a JSON snapshot to every connection on a local port (e.g. nc 127.0.0.1 9091) and closes it
+    """
+    def __init__(self, snapshot, port, address="127.0.0.1"):
+        threading.Thread.__init__(self, daemon=True, name="stats-server")
+        self.snapshot = snapshot
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((address, port))
+        self.socket.listen(5)
+        self.done = False
+
+    def run(self):
+        while not self.done:
+            try:
+                client, _ = self.socket.accept()
+            except OSError:
+                break
+
+            try:
+                client.sendall(json.dumps(self.snapshot(), indent=2).encode("utf-8") + b"\n")
+            except OSError:
+                pass
+            finally:
+                client.close()
+
+    def stop(self):
+        self.done = True
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+
+class Stats_dumper(threading.Thread):
+    """
+    Rewrites a JSON snapshot file every interval seconds (atomically, readers never see half a file)
+    """
+    def __init__(self, snapshot, file_name, interval=10):
+        threading.Thread.__init__(self, daemon=True, name="stats-dumper")
+        self.snapshot = snapshot
+        self.file_name = file_name
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.dump()
+
+    def dump(self):
+        temporary_file_name = self.file_name + ".tmp"
+        with open(temporary_file_name, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(temporary_file_name, self.file_name)
+
+    def stop(self):
+        self.stopped.set()
+        self.dump()
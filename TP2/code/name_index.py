@@ -0,0 +1,101 @@
+from bisect import bisect_left, insort
+from utils import search_mode
+
+"""
+File name index.
+
+Names are kept in a sorted list (prefix queries are a bisection followed by a scan of the matching run)
+and in trigram posting sets (a substring query only checks the names holding every trigram of the query).
+Queries shorter than a trigram scan the sorted names.
+"""
+
+def trigrams(name):
+    return {name[i:i+3] for i in range(len(name) - 2)}
+
+
+class Name_index:
+    """
+    Names of the files some node has -> their hashes, searchable by exact name, prefix and substring
+    """
+    def __init__(self):
+        self.hashes = {}  # name -> set of file hashes
+        self.names = []  # sorted names
+        self.trigrams = {}  # trigram -> set of names
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, name, file_hash):
+        file_hashes = self.hashes.get(name)
+        if file_hashes is None:
+            file_hashes = self.hashes[name] = set()
+            insort(self.names, name)
+            for trigram in trigrams(name):
+                self.trigrams.setdefault(trigram, set()).add(name)
+
+        file_hashes.add(file_hash)
+
+    def remove(self, name, file_hash):
+        file_hashes = self.hashes.get(name)
+        if file_hashes is None:
+            return
+
+        file_hashes.discard(file_hash)
+        if file_hashes:
+            return
+
+        del self.hashes[name]
+        del self.names[bisect_left(self.names, name)]
+        for trigram in trigrams(name):
+            names = self.trigrams[trigram]
+            names.discard(name)
+            if not names:
+                del self.trigrams[trigram]
+
+    def load(self, files):
+        """
+        Adds many (file_hash, name) pairs, sorting the names once
+        """
+        for file_hash, name in files:
+            file_hashes = self.hashes.get(name)
+            if file_hashes is None:
+                file_hashes = self.hashes[name] = set()
+                for trigram in trigrams(name):
+                    self.trigrams.setdefault(trigram, set()).add(name)
+            file_hashes.add(file_hash)
+
+        self.names = sorted(self.hashes)
+
+    def matches(self, query, mode):
+        """
+        Yields the names matching the query, in order
+        """
+        if mode == search_mode.EXACT:
+            if query in self.hashes:
+                yield query
+
+        elif mode == search_mode.PREFIX:
+            for i in range(bisect_left(self.names, query), len(self.names)):
+                if not self.names[i].startswith(query):
+                    break
+                yield self.names[i]
+
+        elif len(query) < 3:
+            for name in self.names:
+                if query in name:
+                    yield name
+
+        else:
+            postings = []
+            for trigram in trigrams(query):
+                names = self.trigrams.get(trigram)
+                if names is None:
+                    return
+                postings.append(names)
+
+            postings.sort(key=len)
+            candidates = postings[0].intersection(*postings[1:])
+            # the trigrams can all be in a name without being contiguous
+            for name in sorted(candidates):
+                if query in name:
+                    yield name
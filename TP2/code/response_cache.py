@@ -0,0 +1,104 @@
+import threading
+from collections import OrderedDict
+
+
+class Response_cache:
+    """
+    LRU cache of encoded LOCATE_HASH / LOCATE_NAME response bodies (without the trailing counter),
+    bounded in bytes; entries are tagged with the files they depend on so updates can invalidate them
+    """
+    def __init__(self, max_size=64*1024*1024):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()  # key -> (body, tags)
+        self.tags = {}  # tag -> set of keys
+        self.invalidated = OrderedDict()  # tag -> epoch of its last invalidation, oldest first
+        self.in_flight = OrderedDict()  # epoch -> number of bodies being computed since then, oldest first
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        
+    def begin(self):
+        """
+        Returns the epoch a body starts being computed at; end must be called with it once the body was put (or not)
+        """
+        with self.lock:
+            self.in_flight[self.epoch] = self.in_flight.get(self.epoch, 0) + 1
+            return self.epoch
+        
+    def end(self, epoch):
+        with self.lock:
+            self.in_flight[epoch] -= 1
+            if self.in_flight[epoch] == 0:
+                del self.in_flight[epoch]
+                self.prune()
+        
+    def put(self, key, body, tags, epoch):
+        """
+        Stores a body computed since the given epoch (from begin),
+        unless one of its tags was invalidated while it was being computed
+        """
+        with self.lock:
+            if any(self.invalidated.get(tag, -1) >= epoch for tag in tags):
+                return
+            
+            self.remove(key)
+            self.entries[key] = (body, tags)
+            self.size += len(body)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+                
+            while self.size > self.max_size and len(self.entries) > 0:
+                self.remove(next(iter(self.entries)))
+                
+    def invalidate(self, tags):
+        with self.lock:
+            for tag in tags:
+                self.invalidated[tag] = self.epoch
+                self.invalidated.move_to_end(tag)
+                for key in self.tags.pop(tag, ()):
+                    self.remove(key)
+            self.epoch += 1
+            self.prune()
+            
+    def prune(self):  # lock must be held
+        # an invalidation older than every body still being computed can't reject a put anymore
+        oldest = next(iter(self.in_flight), self.epoch)
+        while self.invalidated and next(iter(self.invalidated.values())) < oldest:
+            self.invalidated.popitem(last=False)
+            
+    def remove(self, key):  # lock must be held
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        
+        body, tags = entry
+        self.size -= len(body)
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self.tags[tag]
+                    
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "size": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidated_tags": len(self.invalidated),
+            }
@@ -0,0 +1,392 @@
+import os
+import time
+import threading
+import multiprocessing
+import heapq
+from itertools import islice
+from concurrent.futures import Future
+from datetime import datetime
+from utils import action, status
+from fs_tracker import FS_Tracker
+from codec import Buffer_reader
+from metrics import DB
+import codec
+
+
+class FS_Sharded_tracker(FS_Tracker):
+    """
+    Tracker that spreads the file hashes over n_shards worker processes, each one with its own
+    database, block index and response cache. This process only accepts the nodes and routes their
+    requests: LOCATE_HASH, UPDATE_* and ADD / REMOVE_BLOCKS go to the shards owning the hashes,
+    LOCATE_NAME and SEARCH_NAME are asked to every shard and merged, node status and LEAVE are applied on every shard.
+    Heartbeats are kept by this process and its evictions are applied on every shard.
+    The nodes see the same protocol as with a single FS_Tracker.
+    """
+    def __init__(self, db, n_shards=2, **kwargs):
+        self.n_shards = n_shards
+        FS_Tracker.__init__(self, db, **kwargs)
+
+        self.request_handlers = {
+            action.UPDATE_FULL_FILES.value: self.handle_update_full_request,
+            action.UPDATE_PARTIAL.value: self.handle_update_partial_request,
+            action.LOCATE_NAME.value: self.handle_locate_name_request,
+            action.LOCATE_HASH.value: self.handle_locate_hash_request,
+            action.CHECK_STATUS.value: self.handle_check_status_request,
+            action.UPDATE_STATUS.value: self.handle_update_status_request,
+            action.ADD_BLOCKS.value: self.handle_add_blocks_request,
+            action.REMOVE_BLOCKS.value: self.handle_remove_blocks_request,
+            action.HEARTBEAT.value: self.handle_heartbeat_request,
+            action.LOCATE_HASH_BATCH.value: self.handle_locate_hash_batch_request,
+            action.SEARCH_NAME.value: self.handle_search_name_request,
+        }
+
+    def open_state(self, db, persistent, cache_size):
+        # the shards expire their own stale nodes
+        self.stale_nodes_expired = True
+
+        context = multiprocessing.get_context("spawn")
+        root, extension = os.path.splitext(db)
+
+        self.shards = [
+            Tracker_shard(
+                context,
+                "%s.shard%d%s" % (root, i, extension),
+                debug=self.debug,
+                persistent=persistent,
+                stale_timeout=self.stale_timeout,
+                cache_size=cache_size // self.n_shards,
+                snapshot_interval=self.snapshot_interval,
+            )
+            for i in range(self.n_shards)
+        ]
+
+        if self.debug:
+            print(datetime.now(), "Started %d shard(s)" % self.n_shards)
+
+    def stop(self):
+        FS_Tracker.stop(self)
+        for shard in self.shards:
+            shard.stop()
+
+    """
+    Generic functions
+    """
+
+    def shard_of(self, file_hash):
+        return int(file_hash or "0", 16) % self.n_shards
+
+    def wait(self, futures):
+        # the time spent waiting for the shards is accounted as db time
+        start = time.perf_counter()
+        results = [future.result() for future in futures]
+        self.metrics.add(DB, start)
+        return results
+
+    def call_all(self, command, *args):
+        return self.wait([shard.call(command, *args) for shard in self.shards])
+
+    def combine_responses(self, responses):
+        """
+        Status of a request answered by several shards: the first error or SUCCESS
+        """
+        for response in responses:
+            reader = Buffer_reader(response)
+            reader.read_action()
+            result_status, _ = codec.decode_response(reader)
+            if result_status != status.SUCCESS.value:
+                return result_status
+        return status.SUCCESS.value
+
+    def combine_statuses(self, statuses):
+        for result_status in statuses:
+            if result_status != status.SUCCESS.value:
+                return result_status
+        return status.SUCCESS.value
+
+    def node_connected(self, host_name):
+        if self.debug:
+            print(datetime.now(), "Client connected", host_name)
+        self.metrics.node_connected()
+        for shard in self.shards:
+            shard.call("connect", host_name)
+
+    def delete_node(self, host_name):
+        return self.combine_statuses(self.call_all("delete", host_name))
+
+    def delete_nodes(self, host_names):
+        return self.combine_statuses(self.call_all("delete_nodes", host_names))
+
+    def stats(self):
+        snapshot = self.metrics.snapshot()
+        snapshot["liveness"] = self.liveness.stats()
+        snapshot["shards"] = self.call_all("stats")
+        return snapshot
+
+    """
+    Functions to route requests
+    """
+
+    def send_update(self, client, host_name, counter, files, encode):
+        files_by_shard = {}
+        for file in files:
+            files_by_shard.setdefault(self.shard_of(file[0]), []).append(file)
+
+        if not files_by_shard:
+            files_by_shard[0] = []
+
+        futures = [
+            self.shards[i].call("request", host_name, encode(shard_files), counter)
+            for i, shard_files in files_by_shard.items()
+        ]
+
+        result = self.combine_responses(self.wait(futures))
+        self.send_response(client, result, counter)
+
+    def handle_update_full_request(self, client, reader, host_name, counter):
+        files = codec.decode_update_full_request(reader)
+        self.send_update(client, host_name, counter, files, codec.encode_update_full_request)
+
+    def handle_update_partial_request(self, client, reader, host_name, counter):
+        files = codec.decode_update_partial_request(reader)
+        self.send_update(client, host_name, counter, files, codec.encode_update_partial_request)
+
+    def handle_add_blocks_request(self, client, reader, host_name, counter):
+        files = codec.decode_block_delta_request(reader)
+        self.send_update(client, host_name, counter, files, codec.encode_add_blocks_request)
+
+    def handle_remove_blocks_request(self, client, reader, host_name, counter):
+        files = codec.decode_block_delta_request(reader)
+        self.send_update(client, host_name, counter, files, codec.encode_remove_blocks_request)
+
+    def handle_locate_hash_request(self, client, reader, host_name, counter):
+        file_hash = codec.decode_locate_hash_request(reader)
+        shard = self.shards[self.shard_of(file_hash)]
+
+        response = self.wait([shard.call("request", host_name, codec.encode_locate_hash_request(file_hash), counter)])[0]
+        self.send(client, response)
+
+        if self.debug:
+            print(datetime.now(), "-> Response sent to client")
+
+    def handle_locate_hash_batch_request(self, client, reader, host_name, counter):
+        file_hashes = codec.decode_locate_hash_batch_request(reader)
+
+        hashes_by_shard = {}
+        for file_hash in dict.fromkeys(file_hashes):
+            hashes_by_shard.setdefault(self.shard_of(file_hash), []).append(file_hash)
+
+        responses = self.wait([
+            self.shards[i].call("request", host_name, codec.encode_locate_hash_batch_request(shard_hashes), counter)
+            for i, shard_hashes in hashes_by_shard.items()
+        ])
+
+        # the entries are copied as they are, in the order of the request
+        entries = {}
+        for shard_hashes, response in zip(hashes_by_shard.values(), responses):
+            reader = Buffer_reader(response)
+            if reader.read_action() != action.RESPONSE_LOCATE_HASH_BATCH.value:
+                self.send(client, response)  # the error of a shard
+                return
+            entries.update(zip(shard_hashes, codec.split_locate_hash_batch_response(reader)))
+
+        self.send(client, codec.encode_locate_hash_batch_header(len(file_hashes)))
+        for file_hash in file_hashes:
+            self.send(client, entries[file_hash])
+        self.send(client, codec.encode_counter(counter))
+
+        if self.debug:
+            print(datetime.now(), "-> Response sent to client")
+
+    def handle_locate_name_request(self, client, reader, host_name, counter):
+        file_name = codec.decode_locate_name_request(reader)
+        responses = self.call_all("request", host_name, codec.encode_locate_name_request(file_name), counter)
+
+        results = []  # (file_hash, host_name)
+        error = None
+
+        for response in responses:
+            reader = Buffer_reader(response)
+            if reader.read_action() == action.RESPONSE_LOCATE_NAME.value:
+                output, _ = codec.decode_locate_name_response(reader)
+                results.extend((file_hash, host) for file_hash, hosts in output.items() for host in hosts)
+            elif error is None:
+                error = response
+
+        # a shard that failed only matters if none could answer
+        if error is not None and not results:
+            self.send(client, error)
+        else:
+            self.send(client, codec.encode_locate_name_body(results) + codec.encode_counter(counter))
+
+        if self.debug:
+            print(datetime.now(), "-> Response sent to client")
+
+    def handle_search_name_request(self, client, reader, host_name, counter):
+        query, mode, limit = codec.decode_search_name_request(reader)
+        responses = self.call_all("request", host_name, codec.encode_search_name_request(query, mode, limit), counter)
+
+        shard_results = []  # [(file_name, file_hash, [host_name])] of each shard, ordered by name and hash
+        error = None
+
+        for response in responses:
+            reader = Buffer_reader(response)
+            if reader.read_action() == action.RESPONSE_SEARCH_NAME.value:
+                shard_results.append(codec.decode_search_name_results(reader))
+            elif error is None:
+                error = response
+
+        if error is not None and not shard_results:
+            self.send(client, error)
+        else:
+            # every shard returned its first limit files, the first limit of the merge are the answer
+            results = heapq.merge(*shard_results, key=lambda result: result[:2])
+            results = list(islice(results, limit) if limit else results)
+            self.send(client, codec.encode_search_name_body(results) + codec.encode_counter(counter))
+
+        if self.debug:
+            print(datetime.now(), "-> Response sent to client")
+
+    def handle_check_status_request(self, client, reader, host_name, counter):
+        # every shard stores every node, any of them can answer
+        checked_host_name = codec.decode_check_status_request(reader)
+        message = codec.encode_check_status_request(checked_host_name)
+
+        response = self.wait([self.shards[0].call("request", host_name, message, counter)])[0]
+        self.send(client, response)
+
+        if self.debug:
+            print(datetime.now(), "-> Response sent to client")
+
+    def handle_update_status_request(self, client, reader, host_name, counter):
+        message = codec.encode_update_status_request(codec.decode_update_status_request(reader))
+        result = self.combine_responses(self.call_all("request", host_name, message, counter))
+        self.send_response(client, result, counter)
+
+
+class Tracker_shard:
+    """
+    Handle of a shard process; calls from many client threads share its pipe
+    and are matched to the replies by id
+    """
+    def __init__(self, context, db, debug=False, persistent=False, stale_timeout=60, cache_size=64*1024*1024, snapshot_interval=60):
+        self.connection, shard_connection = context.Pipe()
+        self.process = context.Process(
+            target=run_shard,
+            args=(shard_connection, db, debug, persistent, stale_timeout, cache_size, snapshot_interval),
+            daemon=True
+        )
+        self.process.start()
+        shard_connection.close()
+
+        self.lock = threading.Lock()
+        self.pending = {}  # id -> future of the reply
+        self.next_id = 0
+
+        self.receiver = threading.Thread(target=self.receive, daemon=True)
+        self.receiver.start()
+
+    def call(self, command, *args):
+        future = Future()
+
+        with self.lock:
+            self.next_id += 1
+            self.pending[self.next_id] = future
+            self.connection.send((self.next_id, command, args))
+
+        return future
+
+    def receive(self):
+        while True:
+            try:
+                call_id, result = self.connection.recv()
+            except (EOFError, OSError):
+                break
+
+            with self.lock:
+                future = self.pending.pop(call_id)
+            future.set_result(result)
+
+        with self.lock:
+            for future in self.pending.values():
+                future.set_exception(ConnectionError("Shard process exited"))
+            self.pending.clear()
+
+    def stop(self):
+        try:
+            self.call("stop").result(timeout=5)
+        except Exception:
+            pass
+        self.process.join(timeout=5)
+        self.connection.close()
+
+
+class Captured_client:
+    """
+    Stands in for the node socket inside a shard: keeps what the handlers send
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def sendall(self, data):
+        self.chunks.append(data)
+
+    def flush(self):
+        pass  # the front tracker sends the captured response with its own writer
+
+    def getvalue(self):
+        return b"".join(self.chunks)
+
+
+def run_shard(connection, db, debug, persistent, stale_timeout, cache_size, snapshot_interval):
+    """
+    Body of a shard process: answers the calls of the front tracker one at a time
+    with the request handlers of a (never started) FS_Tracker
+    """
+    tracker = FS_Tracker(
+        db=db,
+        debug=debug,
+        n_resolvers=1,
+        persistent=persistent,
+        stale_timeout=stale_timeout,
+        cache_size=cache_size,
+        snapshot_interval=snapshot_interval,
+    )
+
+    while True:
+        try:
+            call_id, command, args = connection.recv()
+        except (EOFError, OSError, KeyboardInterrupt):
+            break
+
+        result = None
+
+        if command == "request":
+            host_name, message, counter = args
+            reader = Buffer_reader(message)
+            client = Captured_client()
+            try:
+                tracker.handle_request(client, reader, host_name, reader.read_action(), counter)
+                result = client.getvalue()
+            except Exception as e:
+                if debug:
+                    print("[run_shard]", datetime.now(), e)
+                result = codec.encode_response(status.SERVER_ERROR.value, counter)
+        elif command == "connect":
+            tracker.node_connected(*args)
+        elif command == "delete":
+            result = tracker.delete_node(*args)
+        elif command == "delete_nodes":
+            result = tracker.delete_nodes(*args)
+        elif command == "stats":
+            result = tracker.cache.stats()
+        elif command == "stop":
+            connection.send((call_id, None))
+            break
+
+        connection.send((call_id, result))
+
+    tracker.resolver.shutdown()
+    if tracker.snapshots is not None:
+        tracker.snapshots.stop()
+    tracker.db.close()
+    connection.close()
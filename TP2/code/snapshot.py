@@ -0,0 +1,277 @@
+import os
+import sys
+import struct
+import threading
+import time
+import uuid
+import zlib
+from array import array
+from contextlib import contextmanager
+from datetime import datetime
+from utils import status
+
+"""
+Binary snapshots of the tracker state.
+
+Rebuilding the block index from the database means materializing one Python row per block range;
+a snapshot stores the ranges of each (file, node, division size) as two packed arrays instead,
+so restoring costs one array copy per entry. The snapshot is only used if the database still holds
+the snapshot's id: every write changing nodes, files or block ranges deletes it in its own transaction,
+so a stale snapshot is ignored and the index is loaded from the database as before.
+
+File layout (little endian):
+    header: magic, version, snapshot id, creation time, number of nodes, files and entries
+    nodes: length-prefixed host names
+    files: length-prefixed hashes and names
+    entries: file number, node number, division size, last block size, number of ranges,
+             then the first blocks and the last blocks of the ranges
+    crc32 of everything before it
+"""
+
+MAGIC = b"FSTS"
+VERSION = 1
+
+HEADER = struct.Struct("<4sB16sdIII")
+STRING_LENGTH = struct.Struct("<H")
+ENTRY = struct.Struct("<IIIII")  # file, node, division size, last block size, number of ranges
+CRC = struct.Struct("<I")
+
+BLOCK_TYPECODE = "I" if array("I").itemsize == 4 else "L"  # 32-bit block numbers
+
+
+class Snapshot_error(Exception):
+    pass
+
+
+def new_snapshot_id():
+    return uuid.uuid4().bytes
+
+
+def pack_string(string):
+    data = string.encode("utf-8")
+    return STRING_LENGTH.pack(len(data)) + data
+
+
+def pack_blocks(numbers):
+    blocks = array(BLOCK_TYPECODE, numbers)
+    if sys.byteorder == "big":
+        blocks.byteswap()
+    return blocks.tobytes()
+
+
+def encode_snapshot(index, snapshot_id):
+    """
+    Returns the snapshot of the block index as bytes
+    (the index must not change meanwhile; no lock is taken, the updates are paused instead)
+    """
+    host_names = list(index.nodes)
+    file_hashes = list(index.files)
+    node_numbers = {host_name: i for i, host_name in enumerate(host_names)}
+
+    entries = [
+        (i, node_numbers[host_name], entry)
+        for i, file_hash in enumerate(file_hashes)
+        for host_name, division_sizes in index.files[file_hash].items()
+        for entry in division_sizes.values()
+    ]
+
+    data = bytearray()
+    data += HEADER.pack(MAGIC, VERSION, snapshot_id, time.time(), len(host_names), len(file_hashes), len(entries))
+    data += b"".join(pack_string(host_name) for host_name in host_names)
+    data += b"".join(
+        pack_string(file_hash) + pack_string(index.names.get(file_hash, ""))
+        for file_hash in file_hashes
+    )
+
+    for file_number, node_number, entry in entries:
+        blocks = entry.blocks
+        data += ENTRY.pack(file_number, node_number, entry.division_size, entry.last_block_size, len(blocks.starts))
+        data += pack_blocks(blocks.starts)
+        data += pack_blocks(blocks.ends)
+
+    data += CRC.pack(zlib.crc32(data))
+    return data
+
+
+def write_snapshot_data(file_name, data):
+    """
+    Writes an encoded snapshot to file_name atomically: the data goes to a temporary file that is
+    fsynced and renamed over the previous snapshot, then the directory is fsynced
+    """
+    temporary_file_name = file_name + ".tmp"
+
+    with open(temporary_file_name, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temporary_file_name, file_name)
+
+    # the rename is only durable once the directory is
+    if hasattr(os, "O_DIRECTORY"):
+        directory = os.open(os.path.dirname(os.path.abspath(file_name)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+
+def write_snapshot(file_name, index, snapshot_id):
+    write_snapshot_data(file_name, encode_snapshot(index, snapshot_id))
+
+
+def read_snapshot(file_name):
+    """
+    Returns (snapshot id, [(file_hash, file_name)], entries) where entries yields
+    (file_hash, host_name, division_size, last_block_size, first blocks, last blocks);
+    raises Snapshot_error if the file is not a complete snapshot
+    """
+    with open(file_name, "rb") as f:
+        data = f.read()
+
+    if len(data) < HEADER.size + CRC.size:
+        raise Snapshot_error("Truncated snapshot")
+
+    magic, version, snapshot_id, _, n_nodes, n_files, n_entries = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise Snapshot_error("Not a snapshot (or another version)")
+    if zlib.crc32(memoryview(data)[:-CRC.size]) != CRC.unpack_from(data, len(data) - CRC.size)[0]:
+        raise Snapshot_error("Corrupted snapshot")
+
+    view = memoryview(data)
+    offset = HEADER.size
+
+    def read_string():
+        nonlocal offset
+        length = STRING_LENGTH.unpack_from(data, offset)[0]
+        offset += STRING_LENGTH.size
+        string = str(view[offset:offset + length], "utf-8")
+        offset += length
+        return string
+
+    host_names = [read_string() for _ in range(n_nodes)]
+    files = [(read_string(), read_string()) for _ in range(n_files)]
+
+    def entries():
+        offset = entries_offset
+        swap = sys.byteorder == "big"
+        unpack_entry = ENTRY.unpack_from
+
+        for _ in range(n_entries):
+            file_number, node_number, division_size, last_block_size, n_ranges = unpack_entry(data, offset)
+            offset += ENTRY.size
+
+            blocks = array(BLOCK_TYPECODE)
+            blocks.frombytes(view[offset:offset + 8 * n_ranges])
+            offset += 8 * n_ranges
+            if swap:
+                blocks.byteswap()
+
+            numbers = blocks.tolist()
+            yield files[file_number][0], host_names[node_number], division_size, last_block_size, numbers[:n_ranges], numbers[n_ranges:]
+
+    entries_offset = offset
+    return snapshot_id, files, entries()
+
+
+class Update_gate:
+    """
+    Lets the updates (a database write followed by the same change to the block index) run
+    concurrently, and the snapshot writer wait until none of them is halfway through
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.running = 0
+        self.paused = False
+
+    def __enter__(self):
+        with self.condition:
+            while self.paused:
+                self.condition.wait()
+            self.running += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.condition:
+            self.running -= 1
+            if self.running == 0:
+                self.condition.notify_all()
+
+    @contextmanager
+    def pause(self):
+        with self.condition:
+            while self.paused:
+                self.condition.wait()
+            self.paused = True
+            while self.running:
+                self.condition.wait()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.paused = False
+                self.condition.notify_all()
+
+
+class Snapshot_writer(threading.Thread):
+    """
+    Writes a snapshot of the block index every interval seconds if the database changed since the last one.
+    The updates are only paused while the database is marked and the index is encoded in memory;
+    the file is written and synced once they resume. (The process is not forked to write from a
+    copy-on-write image of the index: the child of a process running threads can deadlock on a
+    lock one of them held)
+    """
+    def __init__(self, file_name, db, index, updates, interval=60, debug=False):
+        threading.Thread.__init__(self, daemon=True, name="snapshot-writer")
+        self.file_name = file_name
+        self.db = db
+        self.index = index
+        self.updates = updates
+        self.interval = interval
+        self.debug = debug
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()  # one snapshot at a time
+        self.n_written = 0
+        self.last_duration = 0.0
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        with self.lock:
+            if self.db.snapshot_id is not None:  # the last snapshot is still current
+                return
+
+            start = time.perf_counter()
+            snapshot_id = new_snapshot_id()
+
+            with self.updates.pause():
+                if self.db.mark_snapshot(snapshot_id) != status.SUCCESS.value:
+                    return
+                data = encode_snapshot(self.index, snapshot_id)
+
+            # an update made meanwhile deletes the marker, the file is then ignored like any stale snapshot
+            if not self.write_file(data):
+                self.db.clear_snapshot_marker()
+                return
+
+            self.n_written += 1
+            self.last_duration = time.perf_counter() - start
+            if self.debug:
+                print(datetime.now(), "Wrote snapshot %s in %.3f s" % (self.file_name, self.last_duration))
+
+    def write_file(self, data):
+        try:
+            write_snapshot_data(self.file_name, data)
+            return True
+        except OSError as e:
+            if self.debug:
+                print("[snapshot] Error: ", e)
+            return False
+
+    def stop(self):
+        self.stopped.set()
+        self.write()
+
+    def stats(self):
+        return {"written": self.n_written, "last_duration": round(self.last_duration, 3)}
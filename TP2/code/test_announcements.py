@@ -0,0 +1,66 @@
+import pytest
+import utils
+from concurrent.futures import Future
+from file_manager import File_manager
+from fs_node import FS_Node
+from utils import status, Interval_set
+
+
+@pytest.fixture
+def node(tmp_path):
+    node = FS_Node(str(tmp_path), None, 0, 512, False, heartbeat_interval=0)
+    node.local_blocks = {}  # (file_hash, division_size) -> [(first, last)]
+    node.local_block_ranges = lambda: {
+        key: ("file", Interval_set(intervals), 512) for key, intervals in node.local_blocks.items()
+    }
+    node.sent = []  # [(message, future)]
+    
+    def send_requests(messages):
+        futures = [Future() for _ in messages]
+        node.sent.extend(zip(messages, futures))
+        return futures
+    
+    node.send_requests = send_requests
+    yield node
+    utils.SingletonMeta._instances.pop(File_manager, None)
+
+
+def announced(node):
+    return {key: blocks.intervals() for key, blocks in node.announced.items() if len(blocks) > 0}
+
+
+def test_changes_are_sent_once(node):
+    node.local_blocks[("aa", 512)] = [(1, 10)]
+    assert len(node.announce_changes()) == 1
+    # the first announcement isn't answered yet: the second one has nothing new to send
+    assert node.announce_changes() == []
+    
+    node.local_blocks[("aa", 512)] = [(1, 4)]
+    assert len(node.announce_changes()) == 1
+    assert announced(node) == {("aa", 512): [(1, 4)]}
+
+
+def test_rejected_changes_are_sent_again(node):
+    node.local_blocks[("aa", 512)] = [(1, 10)]
+    future, = node.announce_changes()
+    future.set_result((status.SERVER_ERROR.value, 1))
+    assert announced(node) == {}
+    
+    future, = node.announce_changes()
+    future.set_result((status.SUCCESS.value, 2))
+    assert announced(node) == {("aa", 512): [(1, 10)]}
+
+
+def test_announcement_before_eviction_is_ignored(node):
+    node.local_blocks[("aa", 512)] = [(1, 10)]
+    old, = node.announce_changes()
+    
+    node.local_blocks[("bb", 512)] = [(1, 2)]
+    new = node.announce_all()
+    assert len(new) == 1 and len(node.sent) == 2  # every block, in one ADD_BLOCKS
+    
+    # the connection closed before the old announcement was answered: what the new one sent stays announced
+    old.set_exception(ConnectionError())
+    new[0].set_result((status.SUCCESS.value, 2))
+    assert announced(node) == {("aa", 512): [(1, 10)], ("bb", 512): [(1, 2)]}
+    assert node.announce_changes() == []
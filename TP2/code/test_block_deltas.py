@@ -0,0 +1,73 @@
+import socket
+import pytest
+import utils
+import codec
+from db import DB_manager
+from fs_tracker import FS_Tracker
+from utils import status, Socket_reader
+
+
+FILE_HASH = "%040x" % 1
+
+
+@pytest.fixture
+def tracker(tmp_path):
+    tracker = FS_Tracker(str(tmp_path / "tracker.sqlite3"))
+    yield tracker
+    tracker.db.close()
+    utils.SingletonMeta._instances.pop(DB_manager, None)  # the next DB_manager opens its own file
+
+
+def request(tracker, message, host_name, decode):
+    """
+    Runs the handler of an encoded request the way the serving loops do; returns the decoded response
+    """
+    node_socket, tracker_socket = socket.socketpair()
+    with node_socket, tracker_socket:
+        node_socket.sendall(message)
+        reader = Socket_reader(tracker_socket)
+        tracker.request_handlers[reader.read_action()](tracker_socket, reader, host_name, 1)
+        
+        response = Socket_reader(node_socket)
+        response.read_action()
+        return decode(response)
+
+
+def send_delta(tracker, encode, host_name, intervals, last_block_size=512):
+    message = encode([(FILE_HASH, "file", [(512, last_block_size, intervals)])])
+    return request(tracker, message, host_name, codec.decode_response)[0]
+
+
+def locate(tracker, host_name):
+    output_full_files, output_partial_files, _ = request(
+        tracker, codec.encode_locate_hash_request(FILE_HASH), host_name, codec.decode_locate_hash_response
+    )
+    return output_full_files, output_partial_files
+
+
+def stored_intervals(tracker, host_name):
+    rows = []
+    tracker.db.get_block_ranges(rows.extend)
+    return [(first, last) for other_host_name, _, _, first, last, _ in rows if other_host_name == host_name]
+
+
+def test_add_and_remove_blocks(tracker):
+    assert send_delta(tracker, codec.encode_add_blocks_request, "node1", [(1, 4), (8, 9)]) == status.SUCCESS.value
+    assert locate(tracker, "node2") == ({}, {"node1": [(512, 512, [1, 2, 3, 4, 8, 9])]})
+    
+    # the cached response is dropped by the next change
+    assert send_delta(tracker, codec.encode_add_blocks_request, "node1", [(5, 7), (10, 10)], 100) == status.SUCCESS.value
+    assert locate(tracker, "node2") == ({"node1": [(512, 100, 10)]}, {})
+    
+    assert send_delta(tracker, codec.encode_remove_blocks_request, "node1", [(3, 6)]) == status.SUCCESS.value
+    assert locate(tracker, "node2") == ({}, {"node1": [(512, 100, [1, 2, 7, 8, 9, 10])]})
+    
+    # the database holds the same ranges as the index answering the requests
+    assert stored_intervals(tracker, "node1") == [(1, 2), (7, 10)]
+    assert tracker.index.files[FILE_HASH]["node1"][512].blocks.intervals() == [(1, 2), (7, 10)]
+
+
+def test_remove_unknown_blocks(tracker):
+    assert send_delta(tracker, codec.encode_remove_blocks_request, "node1", [(1, 4)]) == status.SUCCESS.value
+    assert locate(tracker, "node2") == ({}, {})
+    assert stored_intervals(tracker, "node1") == []
@@ -0,0 +1,112 @@
+import random
+from block_index import Block_index
+from utils import Interval_set, numbers_to_intervals
+
+
+def random_interval(rng, n):
+    first = rng.randint(1, n)
+    return first, min(n, first + rng.randint(0, 10))
+
+
+def test_interval_set_matches_a_set():
+    rng = random.Random(0)
+    blocks = Interval_set()
+    model = set()
+
+    for _ in range(5000):
+        first, last = random_interval(rng, 200)
+        if rng.random() < 0.6:
+            blocks.add(first, last)
+            model.update(range(first, last + 1))
+        else:
+            blocks.remove(first, last)
+            model.difference_update(range(first, last + 1))
+
+        # sorted, disjoint and non-adjacent: the same intervals as built from the numbers
+        assert blocks.intervals() == numbers_to_intervals(model)
+        assert len(blocks) == len(model)
+
+    assert blocks.numbers() == sorted(model)
+    assert all((n in blocks) == (n in model) for n in range(0, 202))
+
+
+def test_interval_set_add_all():
+    rng = random.Random(1)
+    for _ in range(200):
+        existing = [random_interval(rng, 100) for _ in range(rng.randint(0, 8))]
+        incoming = Interval_set(random_interval(rng, 100) for _ in range(8)).intervals()
+
+        blocks = Interval_set(existing)
+        blocks.add_all(incoming)
+        expected = Interval_set(existing + incoming)
+        assert blocks.intervals() == expected.intervals()
+        assert len(blocks) == len(expected)
+
+
+def test_numbers_to_intervals():
+    assert numbers_to_intervals([]) == []
+    assert numbers_to_intervals([5, 1, 2, 3, 3, 7, 8]) == [(1, 3), (5, 5), (7, 8)]
+
+
+def test_locate_full_and_partial():
+    index = Block_index()
+    index.update_node_full_files("node1", [("aa", "file", [(512, 100, 10), (1024, 612, 5)])])
+    index.update_node_partial_files("node2", [("file", "aa", [(512, 512, [1, 2, 3, 7])])])
+
+    assert index.locate_file_hash("aa", "node3") == [
+        ("node1", [(1024, 612, 5, []), (512, 100, 10, [])]),
+        ("node2", [(512, 512, 0, [1, 2, 3, 7])]),
+    ]
+    # a node is not told about its own blocks
+    assert index.locate_file_hash("aa", "node1") == [("node2", [(512, 512, 0, [1, 2, 3, 7])])]
+    assert index.locate_file_hash("bb", "node3") == []
+
+    # blocks 1..n make a full file
+    index.add_block_ranges("node2", [("aa", "file", [(512, 100, [(4, 6), (8, 10)])])])
+    assert index.locate_file_hash("aa", "node1") == [("node2", [(512, 100, 10, [])])]
+
+
+def test_remove_splits_and_forgets_empty_entries():
+    index = Block_index()
+    index.update_node_full_files("node1", [("aa", "file", [(512, 100, 10)])])
+    index.update_node_full_files("node2", [("aa", "file", [(512, 100, 10)])])
+
+    index.remove_block_ranges("node1", [("aa", "file", [(512, 512, [(3, 4), (10, 10)])])])
+    # the last block is gone, its size with it
+    assert index.locate_file_hash("aa", "node2") == [("node1", [(512, 512, 0, [1, 2, 5, 6, 7, 8, 9])])]
+
+    index.remove_block_ranges("node1", [("aa", "file", [(512, 512, [(1, 10)])])])
+    assert index.locate_file_hash("aa", "node2") == []
+    assert index.get_node_file_hashes("node1") == []
+
+    index.delete_node("node2")
+    assert "aa" not in index.files
+    assert len(index.name_index) == 0
+
+
+def test_matches_the_stored_blocks():
+    rng = random.Random(2)
+    index = Block_index()
+    model = {}  # (host_name, division_size) -> set of block numbers
+
+    for _ in range(2000):
+        host_name = rng.choice(["node1", "node2", "node3"])
+        division_size = rng.choice([512, 1024])
+        first, last = random_interval(rng, 60)
+        blocks = model.setdefault((host_name, division_size), set())
+
+        if rng.random() < 0.6:
+            index.add_block_ranges(host_name, [("aa", "file", [(division_size, division_size, [(first, last)])])])
+            blocks.update(range(first, last + 1))
+        else:
+            index.remove_block_ranges(host_name, [("aa", "file", [(division_size, division_size, [(first, last)])])])
+            blocks.difference_update(range(first, last + 1))
+
+    host_names = index.files.get("aa", {})
+    for (host_name, division_size), blocks in model.items():
+        entry = host_names.get(host_name, {}).get(division_size)
+        assert (entry.blocks.intervals() if entry else []) == numbers_to_intervals(blocks)
+        
+    for host_name in ("node1", "node2", "node3"):
+        has_blocks = any(blocks for (other_host_name, _), blocks in model.items() if other_host_name == host_name)
+        assert index.get_node_file_hashes(host_name) == (["aa"] if has_blocks else [])
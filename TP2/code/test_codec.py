@@ -0,0 +1,20 @@
+import pytest
+import codec
+from codec_cases import make_codec_cases
+
+
+@pytest.mark.parametrize("name, encode, decode, expected", make_codec_cases(), ids=lambda value: value if isinstance(value, str) else "")
+def test_round_trip(name, encode, decode, expected):
+    assert decode(encode()) == expected
+
+
+def test_udp_ack_without_sack_is_three_bytes():
+    # nodes that predate the selective acks send and expect this format
+    assert len(codec.encode_udp_ack(3)) == codec.UDP_ACK.size
+
+
+def test_udp_ack_sack_is_capped():
+    # a receiver holding datagrams far past the ack only lists the ones the bitmap length can cover
+    message = codec.encode_udp_ack(1, [3, 2041, 2042, 5000])
+    assert len(message) == codec.UDP_ACK.size + 1 + codec.MAX_SACK_BITMAP
+    assert codec.decode_udp_ack(message) == (1, [3, 2041])
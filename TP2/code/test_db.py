@@ -0,0 +1,105 @@
+import random
+import utils
+import pytest
+from db import DB_manager
+from block_index import Block_index
+from utils import status, Interval_set, numbers_to_intervals
+
+
+@pytest.fixture(scope="module")
+def db(tmp_path_factory):
+    db = DB_manager(str(tmp_path_factory.mktemp("db") / "tracker.sqlite3"))
+    yield db
+    db.close()
+    utils.SingletonMeta._instances.pop(DB_manager, None)  # the next DB_manager opens its own file
+
+
+def test_locate_queries_use_indexes(db):
+    assert db.check_query_plans() == []
+
+
+def test_locate_queries_use_indexes_with_data(db):
+    for i in range(50):
+        files = [("%040x" % (i * 100 + j), "file_%d_%d" % (i, j), [(512, 100, 30)]) for j in range(20)]
+        assert db.update_node_full_files("node%d" % i, files) == status.SUCCESS.value
+    db.conn.execute("ANALYZE")
+    assert len(db.locate_file_hash("%040x" % 101, "node0")[0]) == 1
+
+    assert db.check_query_plans() == []
+
+
+def stored_ranges(db, host_name, file_hash):
+    # division_size -> [(first, last, last_block_size)]
+    rows = []
+    db.get_block_ranges(rows.extend)
+    ranges = {}
+    for other_host_name, other_file_hash, division_size, first, last, last_block_size in rows:
+        if (other_host_name, other_file_hash) == (host_name, file_hash):
+            ranges.setdefault(division_size, []).append((first, last, last_block_size))
+    return ranges
+
+
+def test_block_deltas_merge_and_split(db):
+    file_hash = "%040x" % 10**6
+    assert db.add_node_block_ranges("delta1", [(file_hash, "file", [(512, 100, [(1, 10)])])]) == status.SUCCESS.value
+    assert stored_ranges(db, "delta1", file_hash) == {512: [(1, 10, 100)]}
+    
+    # the size of the last block goes with it
+    assert db.remove_node_block_ranges("delta1", [(file_hash, "file", [(512, 512, [(10, 10)])])]) == status.SUCCESS.value
+    assert stored_ranges(db, "delta1", file_hash) == {512: [(1, 9, 512)]}
+    
+    # adjacent and overlapping intervals are merged into the stored range
+    assert db.add_node_block_ranges("delta1", [(file_hash, "file", [(512, 50, [(5, 12), (14, 15)])])]) == status.SUCCESS.value
+    assert stored_ranges(db, "delta1", file_hash) == {512: [(1, 12, 512), (14, 15, 50)]}
+    
+    assert db.remove_node_block_ranges("delta1", [(file_hash, "file", [(512, 512, [(3, 4), (13, 14)])])]) == status.SUCCESS.value
+    assert stored_ranges(db, "delta1", file_hash) == {512: [(1, 2, 512), (5, 12, 512), (15, 15, 50)]}
+
+
+def test_block_deltas_match_a_set(db):
+    rng = random.Random(0)
+    file_hash = "%040x" % (10**6 + 1)
+    index = Block_index()
+    model = {}  # (host_name, division_size) -> set of block numbers
+    
+    for _ in range(500):
+        host_name = rng.choice(["delta2", "delta3"])
+        division_size = rng.choice([512, 1024])
+        intervals = Interval_set(
+            (first, first + rng.randint(0, 20)) for first in (rng.randint(1, 300) for _ in range(rng.randint(1, 4)))
+        ).intervals()
+        files = [(file_hash, "file", [(division_size, division_size, intervals)])]
+        blocks = model.setdefault((host_name, division_size), set())
+        
+        if rng.random() < 0.6:
+            assert db.add_node_block_ranges(host_name, files) == status.SUCCESS.value
+            index.add_block_ranges(host_name, files)
+            blocks.update(n for first, last in intervals for n in range(first, last + 1))
+        else:
+            assert db.remove_node_block_ranges(host_name, files) == status.SUCCESS.value
+            index.remove_block_ranges(host_name, files)
+            blocks.difference_update(n for first, last in intervals for n in range(first, last + 1))
+            
+    for (host_name, division_size), blocks in model.items():
+        # the stored ranges are merged: the same intervals as built from the numbers
+        stored = [(first, last) for first, last, _ in stored_ranges(db, host_name, file_hash).get(division_size, [])]
+        assert stored == numbers_to_intervals(blocks)
+        entry = index.files.get(file_hash, {}).get(host_name, {}).get(division_size)
+        assert (entry.blocks.intervals() if entry else []) == stored
+
+
+@pytest.mark.parametrize("n_intervals", [10, 200])  # below and above add_block_ranges' max_seeks
+def test_bulk_updates_merge_with_stored_ranges(db, n_intervals):
+    rng = random.Random(n_intervals)
+    file_hash = "%040x" % (10**6 + 2 + n_intervals)
+    host_name = "bulk%d" % n_intervals
+    model = set(range(1, 51))
+    assert db.update_node_full_files(host_name, [(file_hash, "file", [(512, 100, 50)])]) == status.SUCCESS.value
+    
+    for _ in range(5):
+        blocks = set(rng.sample(range(1, 4 * n_intervals), 2 * n_intervals))
+        assert db.update_node_partial_files(host_name, [("file", file_hash, [(512, 512, sorted(blocks))])]) == status.SUCCESS.value
+        model.update(blocks)
+        
+        stored = [(first, last) for first, last, _ in stored_ranges(db, host_name, file_hash)[512]]
+        assert stored == numbers_to_intervals(model)
@@ -0,0 +1,40 @@
+import threading
+from liveness import Liveness_table
+
+
+def test_node_heartbeating_during_its_eviction_is_told_after():
+    answers = []
+    evicted = threading.Event()
+    
+    def evict(host_names):
+        # the node comes back while its blocks are being deleted: the deletion isn't over, it must not announce yet
+        answers.append(table.heartbeat("node1"))
+        evicted.set()
+    
+    table = Liveness_table(evict, timeout=0.05, tick=0.01)
+    table.heartbeat("node1")
+    table.start()
+    assert evicted.wait(5)
+    table.stop()
+    table.join()
+    
+    assert answers == [True]
+    assert table.heartbeat("node1") is False  # its blocks are gone now
+    assert table.heartbeat("node1") is True
+
+
+def test_forgotten_node_is_not_marked_evicted():
+    evicted = threading.Event()
+    
+    def evict(host_names):
+        table.forget("node1")  # its connection ended meanwhile
+        evicted.set()
+    
+    table = Liveness_table(evict, timeout=0.05, tick=0.01)
+    table.heartbeat("node1")
+    table.start()
+    assert evicted.wait(5)
+    table.stop()
+    table.join()
+    
+    assert table.heartbeat("node1") is True
@@ -0,0 +1,56 @@
+import random
+import pytest
+from name_index import Name_index
+from utils import search_mode
+
+
+NAMES = ["a", "ab", "abc.txt", "abcd.txt", "b.txt", "xabcx", "report.pdf", "report_2023.pdf", "old_report.pdf", "zz"]
+
+
+def expected(names, query, mode):
+    if mode == search_mode.EXACT:
+        return [name for name in sorted(names) if name == query]
+    if mode == search_mode.PREFIX:
+        return [name for name in sorted(names) if name.startswith(query)]
+    return [name for name in sorted(names) if query in name]
+
+
+@pytest.fixture
+def index():
+    index = Name_index()
+    for i, name in enumerate(NAMES):
+        index.add(name, "%040x" % i)
+    return index
+
+
+@pytest.mark.parametrize("mode", list(search_mode))
+@pytest.mark.parametrize("query", ["", "a", "ab", "abc", "bc.", "report", "port_", "pdf", "x", "missing", "a.t"])
+def test_matches(index, query, mode):
+    assert list(index.matches(query, mode)) == expected(NAMES, query, mode)
+
+
+def test_matches_after_removes_and_load():
+    rng = random.Random(0)
+    names = ["%s_%d.%s" % (rng.choice(["report", "photo", "data"]), rng.randint(0, 50), rng.choice(["txt", "pdf"])) for _ in range(300)]
+    index = Name_index()
+    held = {}  # name -> hashes
+    
+    for i, name in enumerate(names):
+        index.add(name, i)
+        held.setdefault(name, set()).add(i)
+    for i, name in enumerate(names):
+        if rng.random() < 0.5:
+            index.remove(name, i)
+            held[name].discard(i)
+            if not held[name]:
+                del held[name]
+                
+    loaded = Name_index()
+    loaded.load((file_hash, name) for name, file_hashes in held.items() for file_hash in file_hashes)
+    
+    for query in ["report", "report_1", "_1", "o_", "1.p", "t_4", "pdf", "p"]:
+        for mode in search_mode:
+            assert list(index.matches(query, mode)) == expected(held, query, mode)
+            assert list(loaded.matches(query, mode)) == expected(held, query, mode)
+    assert index.hashes == loaded.hashes
+    assert sorted(index.trigrams) == sorted(loaded.trigrams)
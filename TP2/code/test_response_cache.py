@@ -0,0 +1,27 @@
+from response_cache import Response_cache
+
+
+def test_put_rejected_after_concurrent_invalidation():
+    cache = Response_cache()
+    epoch = cache.begin()
+    cache.invalidate([("hash", "aa")])
+    cache.put("key", b"body", [("hash", "aa")], epoch)
+    cache.end(epoch)
+
+    assert cache.get("key") is None
+
+
+def test_invalidations_are_pruned():
+    cache = Response_cache()
+    for i in range(1000):
+        cache.invalidate([("hash", "%040x" % i), ("name", "file_%d" % i)])
+    assert len(cache.invalidated) == 0
+
+    # only the invalidations since the oldest computation in flight are kept
+    epoch = cache.begin()
+    for i in range(10):
+        cache.invalidate([("hash", "%040x" % i)])
+    assert len(cache.invalidated) == 10
+
+    cache.end(epoch)
+    assert len(cache.invalidated) == 0
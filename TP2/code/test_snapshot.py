@@ -0,0 +1,137 @@
+import os
+import random
+import shutil
+import pytest
+import utils
+from db import DB_manager
+from block_index import Block_index
+from fs_tracker import FS_Tracker
+from snapshot import write_snapshot, read_snapshot, new_snapshot_id, Snapshot_error
+from utils import status, search_mode, Interval_set
+
+
+def random_files(rng, n_files):
+    # [(file_hash, file_name, [(division_size, last_block_size, sorted intervals)])]
+    return [
+        ("%040x" % rng.getrandbits(160), "file_%d.bin" % i, [
+            (division_size, rng.randint(1, division_size), Interval_set(
+                (first, first + rng.randint(0, 5)) for first in (rng.randint(1, 500) for _ in range(rng.randint(1, 20)))
+            ).intervals())
+            for division_size in rng.sample([512, 1024, 2048], rng.randint(1, 3))
+        ])
+        for i in range(n_files)
+    ]
+
+
+def index_content(index):
+    blocks = {
+        (file_hash, host_name, division_size): (entry.blocks.intervals(), entry.last_block_size)
+        for file_hash, host_names in index.files.items()
+        for host_name, division_sizes in host_names.items()
+        for division_size, entry in division_sizes.items()
+    }
+    nodes = {host_name: file_hashes for host_name, file_hashes in index.nodes.items() if file_hashes}
+    names = {file_hash: index.names[file_hash] for file_hash in index.files}
+    return blocks, nodes, names
+
+
+def test_round_trip(tmp_path):
+    rng = random.Random(0)
+    index = Block_index()
+    for i in range(20):
+        index.add_block_ranges("node%d" % i, random_files(rng, 10))
+    # a node left: its files that no one else has are gone, the names of the others stay searchable
+    index.delete_node("node0")
+    
+    file_name = str(tmp_path / "tracker.snapshot")
+    snapshot_id = new_snapshot_id()
+    write_snapshot(file_name, index, snapshot_id)
+    
+    read_id, files, entries = read_snapshot(file_name)
+    restored = Block_index()
+    restored.restore(entries, files)
+    
+    assert read_id == snapshot_id
+    assert index_content(restored) == index_content(index)
+    for mode in search_mode:
+        assert list(restored.name_index.matches("file_1", mode)) == list(index.name_index.matches("file_1", mode))
+        
+        
+def test_damaged_snapshots_are_rejected(tmp_path):
+    index = Block_index()
+    index.add_block_ranges("node1", random_files(random.Random(1), 5))
+    file_name = str(tmp_path / "tracker.snapshot")
+    write_snapshot(file_name, index, new_snapshot_id())
+    
+    with open(file_name, "rb") as f:
+        data = f.read()
+        
+    for damaged in (data[:len(data) // 2], data[:-1], data[:40] + bytes([data[40] ^ 1]) + data[41:], b"FSTX" + data[4:]):
+        with open(file_name, "wb") as f:
+            f.write(damaged)
+        with pytest.raises(Snapshot_error):
+            read_snapshot(file_name)
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    yield str(tmp_path / "tracker.sqlite3")
+    utils.SingletonMeta._instances.pop(DB_manager, None)
+
+
+def open_tracker(db_file):
+    return FS_Tracker(db_file, persistent=True, snapshot_interval=3600)
+
+
+def close_tracker(tracker):
+    tracker.stop()  # writes a snapshot if the database changed since the last one
+    tracker.db.close()
+    utils.SingletonMeta._instances.pop(DB_manager, None)
+
+
+def add_blocks(tracker, host_name, files):
+    assert tracker.db.add_node_block_ranges(host_name, files) == status.SUCCESS.value
+    tracker.index.add_block_ranges(host_name, files)
+
+
+def test_restart_restores_the_snapshot(db_file):
+    rng = random.Random(2)
+    tracker = open_tracker(db_file)
+    for i in range(5):
+        add_blocks(tracker, "node%d" % i, random_files(rng, 10))
+    content = index_content(tracker.index)
+    close_tracker(tracker)
+    
+    tracker = open_tracker(db_file)
+    assert tracker.db.snapshot_id is not None  # the marker only stays if the snapshot was used
+    assert index_content(tracker.index) == content
+    close_tracker(tracker)
+
+
+def test_restart_ignores_a_stale_snapshot(db_file):
+    rng = random.Random(3)
+    snapshot_file = os.path.splitext(db_file)[0] + ".snapshot"
+    
+    tracker = open_tracker(db_file)
+    add_blocks(tracker, "node1", random_files(rng, 10))
+    close_tracker(tracker)
+    shutil.copy(snapshot_file, snapshot_file + ".old")
+    
+    # changed after the snapshot was written: the write deletes the marker
+    tracker = open_tracker(db_file)
+    tracker.stop()
+    add_blocks(tracker, "node2", random_files(rng, 10))
+    content = index_content(tracker.index)
+    tracker.db.close()
+    utils.SingletonMeta._instances.pop(DB_manager, None)
+    
+    tracker = open_tracker(db_file)
+    assert index_content(tracker.index) == content
+    close_tracker(tracker)
+    
+    # the database is marked with a newer snapshot than the file
+    os.replace(snapshot_file + ".old", snapshot_file)
+    tracker = open_tracker(db_file)
+    assert tracker.db.snapshot_id is None  # the marker naming a snapshot that could not be used is cleared
+    assert index_content(tracker.index) == content
+    close_tracker(tracker)
@@ -0,0 +1,17 @@
+import pytest
+from udp_harness import run_udp_flows, UDP_FLOWS_MODES
+
+
+@pytest.mark.slow
+def test_flows_share_the_bottleneck(tmp_path):
+    # 4 transfers of 100 KB through a 200 KB/s bottleneck with a 10 datagram buffer, windows of 64 datagrams
+    fixed, congestion_control = run_udp_flows(
+        n_flows=4, size=100000, delay=0.005, loss=0.0, rate=200000, limit=10, block_size=512, window_size=64,
+        ack_timeout=0.4, transfer_timeout=15, tmp_dir=str(tmp_path), modes=UDP_FLOWS_MODES[:2]
+    )
+
+    assert congestion_control["failed"] == 0
+    assert congestion_control["intact"]
+    assert congestion_control["jain"] >= 0.9
+    # no collapse: the link carries at least as much as when every sender keeps a full window in flight
+    assert congestion_control["aggregate"] >= fixed["aggregate"]
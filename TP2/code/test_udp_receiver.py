@@ -0,0 +1,71 @@
+from fs_node import UDP_receiver_connection
+
+
+class Stub_file_manager:
+    def __init__(self):
+        self.saved = []  # (block_number, is_last, data), in the order they were saved
+        
+    def save_block(self, file_name, division_size, block_number, is_last, data):
+        self.saved.append((block_number, is_last, data))
+
+
+def make_connection(buffer_size=4, ends_file=True):
+    file_manager = Stub_file_manager()
+    conn = UDP_receiver_connection("127.0.0.1", 9090, 1, "file", 512, file_manager, buffer_size=buffer_size, ends_file=ends_file)
+    return conn, file_manager
+
+
+def arrive(conn, seq_nums, n):
+    # block numbers don't follow the sequence numbers (partial transfers), the data tells the datagrams apart
+    return [conn.ack(seq_num, 100 + seq_num, b"data %d" % seq_num, end=seq_num == n) for seq_num in seq_nums]
+
+
+def expected_blocks(n, is_last=True):
+    return [(100 + seq_num, is_last and seq_num == n, b"data %d" % seq_num) for seq_num in range(1, n + 1)]
+
+
+def test_in_order():
+    conn, file_manager = make_connection()
+    assert arrive(conn, [1, 2, 3], 3) == [(2, []), (3, []), (4, [])]
+    assert file_manager.saved == expected_blocks(3)
+    assert conn.finished()
+
+
+def test_out_of_order_and_duplicates():
+    conn, file_manager = make_connection()
+    acks = arrive(conn, [2, 4, 2, 1, 1, 3, 5, 4], 5)
+    
+    assert acks == [(1, [2]), (1, [2, 4]), (1, [2, 4]), (3, [4]), (3, [4]), (5, []), (6, []), (6, [])]
+    assert file_manager.saved == expected_blocks(5)
+    assert conn.finished()
+
+
+def test_beyond_the_window_is_dropped():
+    conn, file_manager = make_connection(buffer_size=4)
+    acks = arrive(conn, [5, 4, 2], 8)
+    # the window starts at the missing datagram: 5 is past it, neither kept nor acknowledged
+    assert acks == [(1, []), (1, [4]), (1, [2, 4])]
+    assert file_manager.saved == []
+    
+    arrive(conn, [1, 3, 5, 6, 7, 8], 8)
+    assert file_manager.saved == expected_blocks(8)
+    assert conn.finished()
+
+
+def test_finished_after_early_end():
+    conn, file_manager = make_connection()
+    arrive(conn, [1, 4, 2], 4)
+    # the last datagram arrived, not every one before it
+    assert conn.end_seq_num == 4
+    assert not conn.finished()
+    
+    arrive(conn, [3], 4)
+    assert conn.finished()
+    assert file_manager.saved == expected_blocks(4)
+
+
+def test_partial_transfer_has_no_last_block():
+    conn, file_manager = make_connection(ends_file=False)
+    arrive(conn, [2, 1], 2)
+    assert file_manager.saved == expected_blocks(2, is_last=False)
+    assert conn.finished()
@@ -0,0 +1,246 @@
+import os
+import time
+import random
+import socket
+import threading
+import multiprocessing
+from queue import Queue, Empty
+from fs_node import FS_Node
+from file_manager import generate_file_hash
+
+"""
+Emulated network for UDP transfers between nodes.
+
+The nodes of a transfer run in different processes (the file manager is a singleton) and talk through
+relays whose links delay, drop and rate limit the datagrams, like netem does to an interface.
+Every socket binds an ephemeral port, so runs never collide with each other or with a running node.
+Used by the udp benchmarks and by the tests.
+"""
+
+class Link:
+    """
+    One direction of an emulated link (what netem does to an interface): each datagram is delayed by delay seconds and
+    dropped with probability loss. With a rate (bytes per second), datagrams also wait for the ones ahead of them to be
+    transmitted, and those arriving while limit datagrams are waiting are dropped (a drop-tail queue)
+    """
+    def __init__(self, delay, loss=0.0, rate=None, limit=None, seed=1):
+        self.delay = delay
+        self.loss = loss
+        self.rate = rate
+        self.limit = limit
+        self.random = random.Random(seed)
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        self.busy_until = 0.0  # when the last datagram queued is transmitted
+        self.n_dropped = 0
+        threading.Thread(target=self.forward, daemon=True).start()
+
+    def send(self, sending_socket, data, destination):
+        with self.lock:
+            now = time.monotonic()
+            backlog = max(self.busy_until - now, 0) * self.rate if self.rate else 0  # bytes waiting
+
+            if self.random.random() < self.loss or (self.limit is not None and backlog >= self.limit * len(data)):
+                self.n_dropped += 1
+                return
+
+            departure = now
+            if self.rate:
+                departure = self.busy_until = max(now, self.busy_until) + len(data) / self.rate
+            self.queue.put((departure + self.delay, sending_socket, data, destination))
+
+    def forward(self):
+        # the datagrams leave in the order they were queued, so they are due in that order too
+        while True:
+            due, sending_socket, data, destination = self.queue.get()
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            sending_socket.sendto(data, destination)
+
+
+class Relay:
+    """
+    Stands between a client node and a server node: what the client sends to address goes to the server through
+    the uplink, what the server answers goes back through the downlink (relays can share links)
+    """
+    def __init__(self, client_address, server_address, uplink, downlink):
+        self.received = {"client": 0, "server": 0}  # datagrams sent by each side
+
+        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # the client sends here
+        self.client_socket.bind(("127.0.0.1", 0))
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # the server answers here
+        self.server_socket.bind(("127.0.0.1", 0))
+        self.address = self.client_socket.getsockname()
+
+        for receiving_socket, sending_socket, destination, link, side in (
+            (self.client_socket, self.server_socket, server_address, uplink, "client"),
+            (self.server_socket, self.client_socket, client_address, downlink, "server"),
+        ):
+            threading.Thread(
+                target=self.relay, args=(receiving_socket, sending_socket, destination, link, side), daemon=True
+            ).start()
+
+    def relay(self, receiving_socket, sending_socket, destination, link, side):
+        while True:
+            data, _ = receiving_socket.recvfrom(65535)
+            self.received[side] += 1
+            link.send(sending_socket, data, destination)
+
+
+def start_udp_node(dir, block_size, window_size, ack_timeout, congestion_control=True, pacing=False, receiver_window=64):
+    node = FS_Node(
+        dir, None, 0, block_size, False,
+        udp_host="127.0.0.1", udp_port=0, udp_ack_timeout=ack_timeout, udp_window_size=window_size,
+        udp_congestion_control=congestion_control, udp_pacing=pacing, udp_receiver_window_size=receiver_window
+    )
+    node.file_manager.run()
+    node.create_udp_socket()
+    # the port bound; shutdown wakes the receiving thread up with a datagram to port
+    node.udp_port = node.port = node.udp_socket.getsockname()[1]
+    node.udp_thread.start()
+    return node
+
+
+def run_udp_server(dir, block_size, window_size, ack_timeout, congestion_control, pacing, ready, stop, results):
+    node = start_udp_node(dir, block_size, window_size, ack_timeout, congestion_control, pacing)
+    ready.put(node.udp_port)
+    stop.wait()
+
+    while node.udp_threads:  # the ack of the last datagram may still be on its way
+        time.sleep(0.01)
+    results.put(list(node.udp_rtt_stats().values())[0])
+    node.shutdown()
+
+
+def start_udp_server(context, dir, block_size, window_size, ack_timeout, congestion_control, pacing):
+    """
+    Returns the server process, its address, its stop event and the queue its round trip time stats are put in when it stops
+    """
+    ready, stop, results = context.Queue(), context.Event(), context.Queue()
+    server = context.Process(
+        target=run_udp_server,
+        args=(dir, block_size, window_size, ack_timeout, congestion_control, pacing, ready, stop, results)
+    )
+    server.start()
+    return server, ("127.0.0.1", ready.get()), stop, results
+
+
+def write_random_file(file_path, size, seed):
+    data = random.Random(seed).randbytes(size)
+    os.makedirs(os.path.dirname(file_path))
+    with open(file_path, "wb") as f:
+        f.write(data)
+    return data, generate_file_hash(file_path)
+
+
+def received_data(node, file_name, division_size):
+    blocks = sorted(node.file_manager.files[file_name].blocks[division_size])
+    data = bytearray()
+    for block in blocks:
+        with open(block.path, "rb") as block_file:
+            data += block_file.read()
+    return bytes(data)
+
+
+def get_udp_file(client, relay, file_hash, block_size, resend_interval, transfer_timeout):
+    """
+    Requests a file through the relay, sending the request again until the sender answers
+    (the requests are not retransmitted by the nodes, a lossy link drops some of them);
+    returns the seconds until the transfer ended, or None if it was not over after transfer_timeout
+    """
+    sent = relay.received["server"]
+    start = time.perf_counter()
+    deadline = start + transfer_timeout
+
+    while True:
+        timeout = deadline - time.perf_counter()
+        if relay.received["server"] == sent:
+            client.send_udp_get_full_file_request(relay.address, file_hash, block_size)
+            timeout = min(timeout, resend_interval)
+        try:
+            client.udp_response_queue.get(timeout=max(timeout, 0))
+            return time.perf_counter() - start
+        except Empty:
+            if time.perf_counter() >= deadline:
+                return None
+
+
+def jain_index(rates):
+    # 1 when every flow gets the same rate, 1/n when one flow gets everything
+    return sum(rates) ** 2 / (len(rates) * sum(rate * rate for rate in rates))
+
+
+UDP_FLOWS_MODES = (  # (name, congestion control, pacing)
+    ("fixed window", False, False),
+    ("congestion control", True, False),
+    ("congestion control+pacing", True, True),
+)
+
+
+def run_udp_flows(n_flows, size, delay, loss, rate, limit, block_size, window_size, ack_timeout, transfer_timeout, tmp_dir, modes=UDP_FLOWS_MODES):
+    """
+    n_flows transfers started together from different nodes, sharing a bottleneck downlink, once with each sender mode
+    (a transfer not over after transfer_timeout seconds counts as failed, its sender gave up);
+    returns a dict of results for each mode, in order
+    """
+    files = []  # (server dir, file name, data, hash)
+    for i in range(n_flows):
+        server_dir = os.path.join(tmp_dir, "server_%d" % i)
+        file_name = "flow_%d.bin" % i
+        data, file_hash = write_random_file(os.path.join(server_dir, "files", file_name), size, i)
+        files.append((server_dir, file_name, data, file_hash))
+    n_blocks = (size + block_size - 1) // block_size
+
+    client = start_udp_node(os.path.join(tmp_dir, "client"), block_size, window_size, ack_timeout)
+    client_address = ("127.0.0.1", client.udp_port)
+    context = multiprocessing.get_context("spawn")
+    runs = []
+
+    for mode, congestion_control, pacing in modes:
+        servers = [
+            start_udp_server(context, server_dir, block_size, window_size, ack_timeout, congestion_control, pacing)
+            for server_dir, _, _, _ in files
+        ]
+        uplink = Link(delay, seed=1)
+        downlink = Link(delay, loss, rate, limit, seed=2)
+        relays = [Relay(client_address, server_address, uplink, downlink) for _, server_address, _, _ in servers]
+
+        client.file_manager.reset_block_dir()
+        addresses = {relay.address for relay in relays}
+        times = {}  # file name -> seconds until the transfer ended
+
+        start = time.perf_counter()
+        for relay, (_, _, _, file_hash) in zip(relays, files):
+            client.send_udp_get_full_file_request(relay.address, file_hash, block_size)
+        try:
+            while len(times) < n_flows:
+                address, file_name, _ = client.udp_response_queue.get(timeout=max(start + transfer_timeout - time.perf_counter(), 0))
+                if address in addresses:  # not a transfer of the previous sender that ended late
+                    times[file_name] = time.perf_counter() - start
+        except Empty:
+            pass
+
+        for server, _, stop, results in servers:
+            stop.set()
+            results.get()
+            server.join()
+
+        # the transfers that failed count as delivering nothing until the timeout
+        elapsed = max(times.values()) if len(times) == n_flows else transfer_timeout
+        rates = [size / times[file_name] / 1e3 if file_name in times else 0.0 for _, file_name, _, _ in files]
+
+        runs.append({
+            "mode": mode,
+            "failed": n_flows - len(times),
+            "intact": all(received_data(client, file_name, block_size) == data for _, file_name, data, _ in files if file_name in times),
+            "elapsed": elapsed,
+            "rates": rates,
+            "aggregate": len(times) * size / elapsed / 1e3,
+            "jain": jain_index(rates) if any(rates) else 0.0,
+            "retransmissions": sum(relay.received["server"] for relay in relays) - n_flows * n_blocks,
+            "dropped": downlink.n_dropped,
+        })
+
+    client.shutdown()
+    return runs
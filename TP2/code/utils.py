@@ -3,7 +3,13 @@ import threading
 from queue import Queue
 import queue
 import binascii
+import struct
+import socket
 import time
+from collections import OrderedDict, deque
+from bisect import bisect_left, bisect_right
+import heapq
+from concurrent.futures import ThreadPoolExecutor, Future
 
 """
 Enums for the packet types
@@ -21,6 +27,19 @@ class action(IntEnum):
     RESPONSE_LOCATE_HASH = 9
     RESPONSE_LOCATE_NAME = 10
     RESPONSE_CHECK_STATUS = 11
+    ADD_BLOCKS = 12
+    REMOVE_BLOCKS = 13
+    HEARTBEAT = 14
+    LOCATE_HASH_BATCH = 15
+    RESPONSE_LOCATE_HASH_BATCH = 16
+    SEARCH_NAME = 17
+    RESPONSE_SEARCH_NAME = 18
+
+
+class search_mode(IntEnum):
+    EXACT = 0
+    PREFIX = 1
+    SUBSTRING = 2
 
 
 class action_udp(IntEnum):
@@ -93,6 +112,484 @@ class Queue_dictionary:
         else:
             return None
 
+"""
+Round trip time estimation
+"""
+
+class Rtt_estimator:
+    """
+    Retransmission timeout of a peer from the round trip times measured (RFC 6298): smoothed RTT and RTT variation,
+    RTO = SRTT + 4 * RTTVAR. Callers only sample datagrams sent once (Karn's rule), and each timeout doubles the RTO
+    until a new sample arrives
+    """
+    def __init__(self, initial_rto, min_rto=0.02, max_rto=4.0):
+        self.srtt = None
+        self.rttvar = None
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.rto = min(max(initial_rto, min_rto), max_rto)
+        self.n_samples = 0
+        self.n_backoffs = 0
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto), self.max_rto)
+        self.n_samples += 1
+
+    def backoff(self):
+        self.rto = min(2 * self.rto, self.max_rto)
+        self.n_backoffs += 1
+
+    def stats(self):
+        def ms(seconds):
+            return None if seconds is None else round(seconds * 1000, 3)
+        
+        return {
+            "srtt_ms": ms(self.srtt), "rttvar_ms": ms(self.rttvar), "rto_ms": ms(self.rto),
+            "samples": self.n_samples, "backoffs": self.n_backoffs
+        }
+
+"""
+Congestion control
+"""
+
+class Congestion_controller:
+    """
+    Congestion window of a transfer, in datagrams: slow start grows it by one datagram per datagram acknowledged
+    (doubling it every round trip) up to the slow start threshold, then by one datagram per round trip (additive increase).
+    A loss halves it (multiplicative decrease), a timeout sets it back to one datagram and restarts slow start
+    """
+    def __init__(self, max_window, initial_window=2):
+        self.max_window = max_window
+        self.cwnd = float(min(initial_window, max_window))
+        self.ssthresh = float(max_window)
+        self.n_losses = 0
+        self.n_timeouts = 0
+
+    def window(self):
+        return max(1, min(int(self.cwnd), self.max_window))
+
+    def on_ack(self, n_acked):
+        for _ in range(n_acked):
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1
+            else:
+                self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, self.max_window)  # growing past the window the sender may use is meaningless
+
+    def on_loss(self, in_flight):
+        self.ssthresh = max(in_flight / 2, 2)
+        self.cwnd = self.ssthresh
+        self.n_losses += 1
+
+    def on_timeout(self, in_flight):
+        self.ssthresh = max(in_flight / 2, 2)
+        self.cwnd = 1.0
+        self.n_timeouts += 1
+
+    def stats(self):
+        return {
+            "cwnd": round(self.cwnd, 2), "ssthresh": round(self.ssthresh, 2),
+            "losses": self.n_losses, "timeouts": self.n_timeouts
+        }
+
+"""
+Buffered socket reader
+"""
+
+class Socket_reader:
+    """
+    Reads exact-length fields from a stream socket through a reusable buffer,
+    so a message costs a few recv_into calls instead of one recv per field
+    """
+    def __init__(self, sock, buffer_size=64*1024):
+        self.socket = sock
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first unread byte
+        self.end = 0  # end of received data
+        self.received = 0  # bytes received, reset by whoever accounts for them
+        
+    def buffered(self):
+        return self.end - self.start
+    
+    def fill(self, n):
+        """
+        Receives until at least n bytes are buffered; returns False if the peer closed the connection
+        """
+        if self.start + n > len(self.buffer):
+            pending = self.end - self.start
+            
+            if n > len(self.buffer):
+                buffer = bytearray(max(n, 2 * len(self.buffer)))
+                buffer[:pending] = self.view[self.start:self.end]
+                self.buffer = buffer
+                self.view = memoryview(buffer)
+            else:
+                self.buffer[:pending] = self.view[self.start:self.end]
+                
+            self.start = 0
+            self.end = pending
+            
+        while self.end - self.start < n:
+            n_received = self.socket.recv_into(self.view[self.end:])
+            if n_received == 0:
+                return False
+            self.end += n_received
+            self.received += n_received
+            
+        return True
+    
+    def consume(self, n):
+        self.start += n
+        if self.start == self.end:
+            self.start = self.end = 0
+            
+    def read_action(self):
+        """
+        Reads the first byte of a message; returns None if the connection was closed
+        """
+        if self.start == self.end and not self.fill(1):
+            return None
+        
+        byte = self.buffer[self.start]
+        self.consume(1)
+        return byte
+    
+    def read(self, n):
+        if self.end - self.start < n and not self.fill(n):
+            raise ConnectionError("Connection closed in the middle of a message")
+        
+        data = bytes(self.view[self.start:self.start + n])
+        self.consume(n)
+        return data
+    
+    def unpack(self, format_string):  # a format string or a precompiled struct.Struct
+        precompiled = isinstance(format_string, struct.Struct)
+        size = format_string.size if precompiled else struct.calcsize(format_string)
+
+        if self.end - self.start < size and not self.fill(size):
+            raise ConnectionError("Connection closed in the middle of a message")
+
+        if precompiled:
+            values = format_string.unpack_from(self.buffer, self.start)
+        else:
+            values = struct.unpack_from(format_string, self.buffer, self.start)
+        self.consume(size)
+        return values
+
+class Socket_writer:
+    """
+    Collects the messages written to a stream socket until flush, so the responses to
+    pipelined requests leave in one sendall instead of one per request
+    """
+    def __init__(self, sock, buffer_size=64*1024):
+        self.socket = sock
+        self.buffer_size = buffer_size
+        self.chunks = []
+        self.size = 0
+        
+    def sendall(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= self.buffer_size:
+            self.flush()
+            
+    def flush(self):
+        if self.chunks:
+            data = self.chunks[0] if len(self.chunks) == 1 else b"".join(self.chunks)
+            self.chunks = []
+            self.size = 0
+            self.socket.sendall(data)
+
+"""
+Non-blocking socket reader / writer (event loops)
+"""
+
+class Incomplete_message(Exception):
+    """
+    Raised by a Nonblocking_socket_reader when a message is longer than what was received so far
+    """
+    pass
+
+class Nonblocking_socket_reader(Socket_reader):
+    """
+    Socket_reader over a non-blocking socket: receive() takes whatever the socket has, and reading
+    past the received bytes raises Incomplete_message instead of waiting. The caller marks the start
+    of each message and rewinds to it on Incomplete_message, so the message is decoded again
+    once enough bytes arrived (needed: bytes from the mark the last attempt asked for)
+    """
+    def __init__(self, sock, buffer_size=64*1024):
+        Socket_reader.__init__(self, sock, buffer_size)
+        self.mark = 0
+        self.needed = 1
+        self.closed = False
+
+    def begin_message(self):
+        self.mark = self.start
+
+    def rewind(self):
+        self.start = self.mark
+
+    def has_message(self):
+        """
+        True if the buffered bytes may hold a whole message
+        """
+        return self.end - self.start >= self.needed
+
+    def receive(self):
+        """
+        Receives until the socket would block; returns False once the peer closed the connection
+        """
+        while not self.closed:
+            if self.end == len(self.buffer):
+                self.make_room()
+            try:
+                n_received = self.socket.recv_into(self.view[self.end:])
+            except (BlockingIOError, InterruptedError):
+                break
+            if n_received == 0:
+                self.closed = True
+            self.end += n_received
+            self.received += n_received
+
+        return not self.closed
+
+    def make_room(self):
+        # the bytes before the current message were decoded, a message that fills the buffer needs a bigger one
+        pending = self.end - self.start
+        if pending * 2 > len(self.buffer):
+            buffer = bytearray(2 * len(self.buffer))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            self.buffer[:pending] = self.view[self.start:self.end]
+        self.end = pending
+        self.start = self.mark = 0
+
+    def fill(self, n):
+        self.needed = self.start + n - self.mark
+        raise Incomplete_message()
+
+    def consume(self, n):
+        # the buffer is only compacted by receive(), a rewind may still need the consumed bytes
+        self.start += n
+        self.needed = 1
+
+    def read_action(self):
+        self.begin_message()
+        return Socket_reader.read_action(self)
+
+class Nonblocking_socket_writer(Socket_writer):
+    """
+    Socket_writer over a non-blocking socket: flush sends what the socket takes and keeps the rest
+    until the event loop reports the socket writable again (send_pending)
+    """
+    def __init__(self, sock, buffer_size=64*1024):
+        Socket_writer.__init__(self, sock, buffer_size)
+        self.pending = deque()  # data not sent yet, the first chunk from pending_offset
+        self.pending_offset = 0
+        self.pending_size = 0
+
+    def flush(self):
+        if self.chunks:
+            data = self.chunks[0] if len(self.chunks) == 1 else b"".join(self.chunks)
+            self.chunks = []
+            self.size = 0
+            self.pending.append(data)
+            self.pending_size += len(data)
+        self.send_pending()
+
+    def send_pending(self):
+        """
+        Sends until the socket would block; returns True if nothing is left to send
+        """
+        while self.pending:
+            data = self.pending[0]
+            try:
+                n_sent = self.socket.send(memoryview(data)[self.pending_offset:])
+            except (BlockingIOError, InterruptedError):
+                break
+            self.pending_offset += n_sent
+            self.pending_size -= n_sent
+            if self.pending_offset == len(data):
+                self.pending.popleft()
+                self.pending_offset = 0
+
+        return not self.pending
+
+"""
+Reverse DNS resolver
+"""
+
+class Host_name_resolver:
+    """
+    Resolves IP addresses to host names on a pool of threads;
+    results are kept in an LRU cache with a TTL and concurrent lookups of the same IP are merged
+    """
+    def __init__(self, n_workers=4, cache_size=4096, ttl=60*5, negative_ttl=30):
+        self.executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="resolver")
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache = OrderedDict()  # ip -> (host_name, expiration time)
+        self.lookups = {}  # ip -> future of a lookup in progress
+        self.lock = threading.Lock()
+        
+    def resolve(self, ip):
+        """
+        Returns a future with the host name of the IP (the IP itself if it can't be resolved)
+        """
+        with self.lock:
+            entry = self.cache.get(ip)
+            if entry is not None and entry[1] > time.time():
+                self.cache.move_to_end(ip)
+                future = Future()
+                future.set_result(entry[0])
+                return future
+            
+            future = self.lookups.get(ip)
+            if future is None:
+                future = self.executor.submit(self.lookup, ip)
+                self.lookups[ip] = future
+            return future
+        
+    def lookup(self, ip):
+        try:
+            host_name = socket.gethostbyaddr(ip)[0]
+            ttl = self.ttl
+        except OSError:
+            host_name = ip
+            ttl = self.negative_ttl
+            
+        with self.lock:
+            self.cache[ip] = (host_name, time.time() + ttl)
+            self.cache.move_to_end(ip)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            self.lookups.pop(ip, None)
+            
+        return host_name
+    
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+"""
+Interval set
+"""
+
+class Interval_set:
+    """
+    Set of integers (block numbers) stored as sorted, disjoint and non-adjacent [first, last] intervals
+    """
+    def __init__(self, intervals=()):
+        self.starts = []
+        self.ends = []
+        self.count = 0
+        for first, last in intervals:
+            self.add(first, last)
+    
+    def add(self, first, last):
+        if not self.ends or first > self.ends[-1] + 1:
+            self.starts.append(first)
+            self.ends.append(last)
+            self.count += last - first + 1
+            return
+        
+        # intervals that overlap or touch [first, last] are merged into one
+        i = bisect_left(self.ends, first - 1)
+        j = bisect_right(self.starts, last + 1)
+        
+        if i < j:
+            self.count -= sum(self.ends[k] - self.starts[k] + 1 for k in range(i, j))
+            first = min(first, self.starts[i])
+            last = max(last, self.ends[j-1])
+            
+        self.starts[i:j] = [first]
+        self.ends[i:j] = [last]
+        self.count += last - first + 1
+        
+    def add_all(self, intervals):
+        """
+        Adds many sorted intervals with a single linear merge
+        """
+        starts = []
+        ends = []
+        for first, last in heapq.merge(zip(self.starts, self.ends), intervals):
+            if ends and first <= ends[-1] + 1:
+                if last > ends[-1]:
+                    ends[-1] = last
+            else:
+                starts.append(first)
+                ends.append(last)
+                
+        self.assign(starts, ends)
+        
+    def assign(self, starts, ends):
+        """
+        Replaces the content with sorted, disjoint and non-adjacent intervals (not checked)
+        """
+        self.starts = starts
+        self.ends = ends
+        self.count = sum(ends) - sum(starts) + len(starts)
+        
+    def remove(self, first, last):
+        i = bisect_left(self.ends, first)
+        j = bisect_right(self.starts, last)
+        
+        if i >= j:
+            return
+        
+        starts = []
+        ends = []
+        if self.starts[i] < first:
+            starts.append(self.starts[i])
+            ends.append(first - 1)
+        if self.ends[j-1] > last:
+            starts.append(last + 1)
+            ends.append(self.ends[j-1])
+            
+        self.count -= sum(self.ends[k] - self.starts[k] + 1 for k in range(i, j))
+        self.count += sum(end - start + 1 for start, end in zip(starts, ends))
+        self.starts[i:j] = starts
+        self.ends[i:j] = ends
+        
+    def __len__(self):
+        return self.count
+    
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+    
+    def __contains__(self, number):
+        i = bisect_right(self.starts, number) - 1
+        return i >= 0 and number <= self.ends[i]
+    
+    def max(self):
+        return self.ends[-1] if self.ends else None
+    
+    def numbers(self):
+        return [n for first, last in zip(self.starts, self.ends) for n in range(first, last + 1)]
+    
+    def intervals(self):
+        return list(zip(self.starts, self.ends))
+    
+
+def numbers_to_intervals(numbers):
+    intervals = []
+    for number in sorted(numbers):
+        if intervals and number <= intervals[-1][1] + 1:
+            intervals[-1][1] = max(intervals[-1][1], number)
+        else:
+            intervals.append([number, number])
+    return [(first, last) for first, last in intervals]
+
 """
 Other
 """